@@ -62,6 +62,38 @@ generate_window_data <- function(serie, width, datacols) {
     return(res)
 }
 
+#' ### CRBM export
+#'
+#' Writes the CRBM parameters as CSV files in folder: W, B, A, hbias, vbias and
+#' meta.csv (delay, n_visible, n_hidden). They are read by crbmfunctions.py.
+
+export_crbm <- function(crbm, folder)
+{
+    dir.create(folder, showWarnings = FALSE, recursive = TRUE);
+    write_param <- function(x, name) {
+        write.table(x, file = file.path(folder, paste(name, ".csv", sep = "")),
+                    sep = ",", row.names = F, col.names = F);
+    }
+    write_param(crbm$W, "W");
+    write_param(crbm$B, "B");
+    write_param(crbm$A, "A");
+    write_param(matrix(crbm$hbias, nrow = 1), "hbias");
+    write_param(matrix(crbm$vbias, nrow = 1), "vbias");
+    write.table(data.frame(delay = crbm$delay, n_visible = crbm$n_visible,
+                           n_hidden = crbm$n_hidden),
+                file = file.path(folder, "meta.csv"), sep = ",", row.names = F);
+}
+
+#' Writes the k-means centres (one row per cluster) as a CSV read by
+#' phasefunctions.py.
+
+export_kmeans <- function(kc, file)
+{
+    centers <- kc$centers;
+    colnames(centers) <- paste("activations.", 1:ncol(centers), sep = "");
+    write.table(centers, file = file, sep = ",", row.names = F);
+}
+
 #' ### Plotting functions
 #'
 #' Functions to plot:
@@ -0,0 +1,102 @@
+# # CRBM training
+#
+# Python version of the training step of ALOJA_DBN_CRBM-ActivationDatasetGen.r
+# (train.crbm of rrbm) with checkpoints, so long runs can be resumed, and
+# sweeps over n_hidden and delay. -n and -d take comma separated lists and
+# every combination is trained, in parallel with -j:
+#
+#     python CRBM_training.py -i ships.csv -n 5,10,20 -d 10,20 -j 4 \
+#         --crbm_output crbms
+#
+# Each combination ends in crbms/h<n_hidden>-d<delay>: crbm (export_crbm
+# format, for crbmfunctions.py), log.csv (reconstruction error and time per
+# epoch) and checkpoint.npz. Running it again resumes unfinished ones.
+#
+# As in the R script, ships are split 66/34 between training and test with a
+# fixed seed, but NumPy's generator does not draw the same ships as R's.
+
+import itertools
+import os
+
+from argparse import ArgumentParser
+
+import numpy as np
+import pandas as pd
+
+from crbmfunctions import generateData, trainSweep
+from tracefunctions import TraceStore
+
+
+parser = ArgumentParser()
+parser.add_argument("-n", "--n_hidden", default="10",
+        help = "Number of hidden units (comma separated list). Default 10.")
+parser.add_argument("-d", "--delay", default="20",
+        help = "Delay (comma separated list). Number of samples to include "
+               "in CRBMs window. Default 20.")
+parser.add_argument("-e", "--training_epochs", type=int, default=300,
+        help = "Number of training epochs. Default 300.")
+parser.add_argument("-b", "--batch_size", type=int, default=200,
+        help = "Batchdata size. Default 200.")
+parser.add_argument("-m", "--momentum", type=float, default=0.1,
+        help = "Momentum for CRBM. Default 0.1.")
+parser.add_argument("-l", "--learning_rate", type=float, default=1e-6,
+        help = "Learning rate for CRBM. Default 1e-6.")
+parser.add_argument("-k", "--cd_steps", type=int, default=1,
+        help = "Gibbs steps of contrastive divergence. Default 1.")
+parser.add_argument("-i", "--data_file", metavar="FILE", required=True,
+        help = "Ship samples CSV (the `ships` data of the R scripts) or "
+               "trace store folder (tracefunctions.py).")
+parser.add_argument("-c", "--datacols", default="rotationGPS,sog,bathymetry3",
+        help = "Comma separated data columns (reqcols in R).")
+parser.add_argument("-f", "--fast_test", type=int, default=-1,
+        help = "Use only N random series to do a fast test.")
+parser.add_argument("--crbm_output", metavar="FOLDER", default="crbms",
+        help = "Output folder. Default: crbms.")
+parser.add_argument("--checkpoint_every", type=int, default=10,
+        help = "Epochs between checkpoints. Default 10.")
+parser.add_argument("-j", "--n_jobs", type=int, default=1,
+        help = "Configurations trained in parallel. Default 1.")
+parser.add_argument("--blas_threads", type=int,
+        help = "BLAS threads per configuration (needs threadpoolctl).")
+parser.add_argument("-s", "--seed", type=int, default=1234,
+        help = "Seed of the weight initialization and minibatches.")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    id_var = "imo"
+    reqcols = args.datacols.split(",")
+
+    # # Data preparation
+
+    if os.path.isdir(args.data_file):
+        dataset = TraceStore(args.data_file)
+        targets = dataset.ships
+    else:
+        dataset = pd.read_csv(args.data_file)
+        targets = dataset[id_var].unique()
+    rng = np.random.RandomState(1337)
+    if args.fast_test != -1:
+        print("Test mode. Limiting the data to the", args.fast_test,
+              "random series")
+        targets = rng.choice(targets, size=args.fast_test, replace=False)
+    tr_idx = rng.choice(len(targets), int(np.ceil(len(targets)*0.66)),
+                        replace=False)
+    series_train = generateData(dataset, reqcols, targets[np.sort(tr_idx)],
+                                id_var)
+
+    # # Training
+
+    configs = [{'n_hidden': n, 'delay': d,
+                'training_epochs': args.training_epochs,
+                'learning_rate': args.learning_rate,
+                'momentum': args.momentum, 'batch_size': args.batch_size,
+                'k': args.cd_steps, 'seed': args.seed,
+                'checkpoint_every': args.checkpoint_every}
+               for n, d in itertools.product(
+                   [int(x) for x in args.n_hidden.split(",")],
+                   [int(x) for x in args.delay.split(",")])]
+    res = trainSweep(series_train['batchdata'], series_train['seqlen'],
+                     configs, args.crbm_output, n_jobs=args.n_jobs,
+                     blas_threads=args.blas_threads)
+    res.to_csv(args.crbm_output + "/sweep.csv", index=False)
+    print(res[['n_hidden', 'delay', 'epochs', 'recon_error', 'train_time']])
@@ -0,0 +1,126 @@
+# # Benchmarks
+#
+# Throughput checks for the Python versions of the dataset generation steps.
+# Run it from this folder with `python benchmarks.py`. The values are checked
+# against the R ports by the tests (python -m pytest tests, from the root).
+
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from crbmfunctions import crbmActivations, normalizeShips, trainCRBM
+from phasefunctions import nearestCentroids
+from tracefunctions import buildTraceStore
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                             'tests'))
+from testtools import crbmSeries, randomCRBM, referencePhases, timeit
+
+
+# ## CRBM activations
+
+def benchActivations(sizes=(100, 1000, 10000), n_hidden=10, delay=20):
+    crbm = randomCRBM(n_hidden=n_hidden, delay=delay)
+    rows = []
+    for nships in sizes:
+        values, codes = crbmSeries(nships)
+        act, act_time = timeit(crbmActivations, crbm, values, codes)
+        windows = int((~np.isnan(act[:, 0]) & (act[:, 0] != -1)).sum())
+        rows.append({'ships': nships, 'samples': len(codes),
+                     'windows': windows, 'time': act_time,
+                     'windows_per_sec': windows/act_time})
+    return pd.DataFrame(rows)
+
+
+# ## CRBM training
+
+def benchTraining(sizes=(100, 1000), n_hidden=10, delay=20, epochs=2):
+    rows = []
+    for nships in sizes:
+        values, codes = crbmSeries(nships)
+        batchdata = normalizeShips(values, codes)[0]
+        seqlen = np.bincount(codes)
+        (_, log), train_time = timeit(lambda: trainCRBM(
+            batchdata, seqlen, n_hidden, delay, epochs, verbose=0))
+        windows = int(np.maximum(seqlen - delay, 0).sum())
+        rows.append({'ships': nships, 'windows': windows, 'epochs': epochs,
+                     'time': train_time,
+                     'windows_per_sec': windows*epochs/train_time,
+                     'recon_error': log['recon_error'].iloc[-1]})
+    return pd.DataFrame(rows)
+
+
+# ## Phase assignment
+#
+# Rows per second of closest.cluster (one row at a time, as apply in R) and of
+# the blocked and KD-tree assignments.
+
+def benchPhases(nrows=1000000, n_hidden=10, ks=(5, 50, 500), seed=0):
+    rng = np.random.RandomState(seed)
+    X = rng.uniform(size=(nrows, n_hidden))
+    rows = []
+    for k in ks:
+        centers = rng.uniform(size=(k, n_hidden))
+        _, ref_time = timeit(referencePhases, X[:2000], centers)
+        row = {'k': k, 'reference_rows_per_sec': 2000/ref_time}
+        for method in ['brute', 'kdtree']:
+            _, method_time = timeit(nearestCentroids, X, centers, method)
+            row[method + '_rows_per_sec'] = nrows/method_time
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+# ## Trace store
+#
+# Time to select every ship from a table with a boolean scan (as in R) and as
+# a slice of the store. The scans are timed on nscan ships and extrapolated.
+# The CSV is shuffled and read in several chunks, with numeric and with text
+# timestamps, and the store must hold every ship sorted by time.
+
+def benchTraceStore(nships=10000, mean_length=100, nscan=50):
+    values, codes = crbmSeries(nships, mean_length)
+    dataset = pd.DataFrame(values, columns=['rotationGPS', 'sog',
+                                            'bathymetry3'])
+    dataset.insert(0, 'imo', codes + 9000000)
+    dataset.insert(1, 'fechahora', np.arange(len(dataset)))
+    text = dataset.assign(fechahora=(pd.Timestamp('2017-05-22') +
+        pd.to_timedelta(dataset['fechahora'], unit='s'))
+        .dt.strftime('%Y-%m-%d %H:%M:%S'))
+    rows = []
+    folder = tempfile.mkdtemp()
+    try:
+        for name, data in [('numeric', dataset), ('text', text)]:
+            path = os.path.join(folder, name + '.csv')
+            data.sample(frac=1, random_state=0).to_csv(path, index=False)
+            store, build_time = timeit(lambda: buildTraceStore(
+                path, os.path.join(folder, name), verbose=False,
+                chunksize=len(data)//4 + 1))
+            sorted_ = store.frame(['imo', 'fechahora']).astype(str)
+            expected = data.sort_values(['imo', 'fechahora'])[
+                ['imo', 'fechahora']].astype(str)
+            if not np.array_equal(sorted_.values, expected.values):
+                raise ValueError("Trace store ({} time) is not sorted by "
+                                 "ship and time".format(name))
+            ships = store.ships.tolist()
+            _, slice_time = timeit(lambda: [store.ship(imo, ['sog'])
+                                            for imo in ships])
+            _, scan_time = timeit(lambda: [data.loc[data.imo == imo, 'sog']
+                                           for imo in ships[:nscan]])
+            rows.append({'time': name, 'rows': len(data), 'ships': nships,
+                         'build_time': build_time,
+                         'slice_all_time': slice_time,
+                         'scan_all_time': scan_time*nships/nscan})
+    finally:
+        shutil.rmtree(folder)
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    print(benchActivations())
+    print(benchTraining())
+    print(benchPhases())
+    print(benchTraceStore())
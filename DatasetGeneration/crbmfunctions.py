@@ -0,0 +1,477 @@
+# # CRBM inference
+#
+# NumPy version of the CRBM activations computed with rrbm's
+# `predict(crbm, batchdata)` in ALOJA_DBN_CRBM-ActivationDatasetGen.r. The
+# CRBM parameters are read from the CSV files written by `export_crbm`
+# (CRBM-tools.r):
+#
+# - W: visible to hidden weights (n_visible x n_hidden)
+# - B: history to hidden weights (delay*n_visible x n_hidden)
+# - A: history to visible weights (delay*n_visible x n_visible)
+# - hbias, vbias and meta.csv (delay, n_visible, n_hidden)
+#
+# The history of sample t is the concatenation of samples t-1, t-2, ...,
+# t-delay (as hist_idx in CRBM-tools.r). The activation of t is the hidden
+# mean sigmoid(x_t W + history_t B + hbias), on data normalized per ship with
+# its mean and standard deviation (generate_data).
+#
+# All the windows of all the ships are computed together: the samples are
+# sorted by ship and normalized at once, the histories are strided views of
+# that table and the activations are a few matrix products per block.
+
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from numpy.lib.stride_tricks import as_strided
+
+from tracefunctions import TraceStore, readShips
+
+
+# ## Parameters
+
+class CRBM:
+    def __init__(self, W, B, A, hbias, vbias, delay):
+        self.W = np.asarray(W, dtype=np.float64)
+        self.B = np.asarray(B, dtype=np.float64)
+        self.A = np.asarray(A, dtype=np.float64)
+        self.hbias = np.ravel(hbias).astype(np.float64)
+        self.vbias = np.ravel(vbias).astype(np.float64)
+        self.delay = int(delay)
+        self.n_visible, self.n_hidden = self.W.shape
+
+        shapes = {'B': (self.delay*self.n_visible, self.n_hidden),
+                  'A': (self.delay*self.n_visible, self.n_visible),
+                  'hbias': (self.n_hidden,), 'vbias': (self.n_visible,)}
+        for name, shape in shapes.items():
+            if getattr(self, name).shape != shape:
+                raise ValueError("CRBM {} has shape {}, expected {}".format(
+                                 name, getattr(self, name).shape, shape))
+
+    # The history weights in the order of a window read forward (t-delay
+    # first), so a window of contiguous samples multiplies them directly.
+    def forwardWeights(self, M):
+        return(M.reshape(self.delay, self.n_visible, -1)[::-1]
+                .reshape(self.delay*self.n_visible, -1))
+
+
+def readMatrix(folder, name):
+    return(np.loadtxt(os.path.join(folder, name + '.csv'), delimiter=',',
+                      ndmin=2))
+
+
+def loadCRBM(folder):
+    meta = pd.read_csv(os.path.join(folder, 'meta.csv'))
+    return(CRBM(readMatrix(folder, 'W'), readMatrix(folder, 'B'),
+                readMatrix(folder, 'A'), readMatrix(folder, 'hbias'),
+                readMatrix(folder, 'vbias'), meta['delay'].iloc[0]))
+
+
+# Same files as export_crbm, so R can read a CRBM trained in Python
+def saveCRBM(crbm, folder):
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    for name in ['W', 'B', 'A']:
+        np.savetxt(os.path.join(folder, name + '.csv'), getattr(crbm, name),
+                   delimiter=',', fmt='%.17g')
+    for name in ['hbias', 'vbias']:
+        np.savetxt(os.path.join(folder, name + '.csv'),
+                   getattr(crbm, name)[None, :], delimiter=',', fmt='%.17g')
+    pd.DataFrame({'delay': [crbm.delay], 'n_visible': [crbm.n_visible],
+                  'n_hidden': [crbm.n_hidden]}).to_csv(
+                  os.path.join(folder, 'meta.csv'), index=False)
+
+
+def sigmoid(x):
+    return(1/(1 + np.exp(-x)))
+
+
+# ## Normalization
+
+# Per ship (codes 0..n-1, samples sorted by code) column means and standard
+# deviations as in generate_data: sample sd (n-1), 1 where it is not > 0.
+def shipStats(values, codes):
+    counts = np.bincount(codes).astype(np.float64)
+    sums = np.stack([np.bincount(codes, weights=values[:, j])
+                     for j in range(values.shape[1])], axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = sums/counts[:, None]
+        dev = values - mean[codes]
+        ss = np.stack([np.bincount(codes, weights=dev[:, j]**2)
+                       for j in range(values.shape[1])], axis=1)
+        std = np.sqrt(ss/(counts[:, None] - 1))
+    std[~(std > 0)] = 1
+    return(mean, std)
+
+
+def normalizeShips(values, codes):
+    mean, std = shipStats(values, codes)
+    return((values - mean[codes])/std[codes], mean, std)
+
+
+# ## Activations
+
+# Activations of the samples of a table sorted by ship (codes), normalized
+# per ship. Samples without a full history in their ship (the first `delay`
+# of each one) get `fill`. As predict_simulation does when rrbm's predict
+# returns NULL, all the samples of ships with no full window get -1.
+def crbmActivations(crbm, values, codes, fill=np.nan, block_size=65536,
+                    normalized=False):
+    values = np.asarray(values, dtype=np.float64)
+    if not normalized:
+        values = normalizeShips(values, codes)[0]
+    values = np.ascontiguousarray(values)
+    n, d = values.shape
+    delay = crbm.delay
+    act = np.full((n, crbm.n_hidden), fill, dtype=np.float64)
+
+    if n > delay:
+        # History windows: samples t-delay..t-1 of every t >= delay, as flat
+        # rows of delay*d values (no copy)
+        hist = as_strided(values, shape=(n - delay, delay*d),
+                          strides=(values.strides[0], values.strides[1]),
+                          writeable=False)
+        t = np.arange(delay, n)
+        inside = codes[t - delay] == codes[t]
+        B = crbm.forwardWeights(crbm.B)
+        for b in range(0, len(t), block_size):
+            rows = np.flatnonzero(inside[b:b + block_size]) + b
+            h = values[t[rows]] @ crbm.W + hist[rows] @ B + crbm.hbias
+            act[t[rows]] = sigmoid(h)
+
+    # Ships without any full window
+    counts = np.bincount(codes, minlength=codes.max() + 1 if n else 0)
+    act[counts[codes] <= delay] = -1
+    return(act)
+
+
+# Reconstruction of the visible units from the activations (Gaussian
+# visible units: their mean), for the samples with a full history.
+def crbmReconstruction(crbm, values, codes, act, normalized=True):
+    values = np.asarray(values, dtype=np.float64)
+    if not normalized:
+        values = normalizeShips(values, codes)[0]
+    values = np.ascontiguousarray(values)
+    n, d = values.shape
+    rec = np.full((n, d), np.nan)
+    if n > crbm.delay:
+        hist = as_strided(values, shape=(n - crbm.delay, crbm.delay*d),
+                          strides=values.strides, writeable=False)
+        t = np.arange(crbm.delay, n)
+        t = t[codes[t - crbm.delay] == codes[t]]
+        rec[t] = (act[t] @ crbm.W.T + hist[t - crbm.delay] @
+                  crbm.forwardWeights(crbm.A) + crbm.vbias)
+    return(rec)
+
+
+# Activation dataset of the samples of every ship: the original columns plus
+# activations.1..n_hidden (column names of the R dataset). Ships are sorted
+# by IMO, keeping the order of their samples.
+def activationDataset(dataset, crbm, datacols, id_var='imo', fill=np.nan):
+    dataset = dataset.sort_values(id_var, kind='mergesort') \
+                     .reset_index(drop=True)
+    codes = pd.factorize(dataset[id_var], sort=True)[0]
+    act = crbmActivations(crbm, dataset[datacols].values, codes, fill)
+    columns = ['activations.{}'.format(i + 1) for i in range(crbm.n_hidden)]
+    return(pd.concat([dataset, pd.DataFrame(act, columns=columns)], axis=1))
+
+
+# ## Training
+#
+# CD-k training of a CRBM with Gaussian visible and binary hidden units, as
+# rrbm's train.crbm: the data is the concatenation of the normalized series
+# of the ships (batchdata) with their lengths (seqlen), as generate_data
+# returns them, and every epoch goes through all the samples with a full
+# history in a random order, in minibatches of batch_size, with momentum.
+#
+# The minibatch histories are gathered from a strided view of batchdata, so
+# the (samples x delay*n_visible) history matrix is never built. While
+# training, B and A are kept in window order (see CRBM.forwardWeights).
+
+# Concatenated normalized series of each target (generate_data in R). The
+# rows of all the targets are gathered with one stable sort, instead of one
+# scan of the table per target. dataset can also be a TraceStore.
+def generateData(dataset, reqcols, targets=None, id_var='imo'):
+    if isinstance(dataset, TraceStore):
+        if targets is None:
+            targets = dataset.ships
+        targets = [t for t in targets if t in dataset]
+        values, codes = dataset.matrix(reqcols, targets)
+    else:
+        if targets is None:
+            targets = np.unique(dataset[id_var])
+        position = pd.Index(targets).get_indexer(dataset[id_var])
+        rows = np.flatnonzero(position >= 0)
+        rows = rows[np.argsort(position[rows], kind='stable')]
+        values = dataset[reqcols].values[rows].astype(np.float64)
+        codes = position[rows]
+    seqlen = np.bincount(codes, minlength=len(targets))
+    batchdata, mean, std = normalizeShips(values, codes)
+    return({'batchdata': batchdata, 'seqlen': seqlen, 'data_mean': mean,
+            'data_std': std})
+
+
+# Indices of the samples with delay previous samples in their series
+def windowIndex(seqlen, delay):
+    starts = np.cumsum(seqlen) - seqlen
+    return(np.concatenate([np.arange(s + delay, s + n)
+                           for s, n in zip(starts, seqlen) if n > delay]
+                          + [np.array([], dtype=np.int64)]))
+
+
+class CRBMTrainer:
+    def __init__(self, n_visible, n_hidden=10, delay=20, learning_rate=1e-3,
+                 momentum=0.5, batch_size=100, k=1, seed=1234):
+        self.config = {'n_visible': n_visible, 'n_hidden': n_hidden,
+                       'delay': delay, 'learning_rate': learning_rate,
+                       'momentum': momentum, 'batch_size': batch_size,
+                       'k': k, 'seed': seed}
+        rng = np.random.RandomState(seed)
+        self.params = {
+            'W': rng.normal(0, 0.01, (n_visible, n_hidden)),
+            'B': rng.normal(0, 0.01, (delay*n_visible, n_hidden)),
+            'A': rng.normal(0, 0.01, (delay*n_visible, n_visible)),
+            'hbias': np.zeros(n_hidden), 'vbias': np.zeros(n_visible)}
+        self.velocity = {name: np.zeros_like(p)
+                         for name, p in self.params.items()}
+        self.rng = rng
+        self.epoch = 0
+        self.log = []
+
+    # CD-k update on one minibatch, returns its reconstruction error (mean
+    # squared error per sample)
+    def update(self, v, hist):
+        c = self.config
+        p = self.params
+        hv = hist @ p['B'] + p['hbias'] # History terms are fixed in CD
+        vh = hist @ p['A'] + p['vbias']
+
+        ph = sigmoid(v @ p['W'] + hv)
+        h = (self.rng.uniform(size=ph.shape) < ph).astype(np.float64)
+        for _ in range(c['k']):
+            nv = h @ p['W'].T + vh # Gaussian visible: the mean
+            nh = sigmoid(nv @ p['W'] + hv)
+            h = (self.rng.uniform(size=nh.shape) < nh).astype(np.float64)
+
+        n = len(v)
+        grads = {'W': (v.T @ ph - nv.T @ nh)/n,
+                 'B': hist.T @ (ph - nh)/n,
+                 'A': hist.T @ (v - nv)/n,
+                 'hbias': (ph - nh).mean(axis=0),
+                 'vbias': (v - nv).mean(axis=0)}
+        for name, g in grads.items():
+            self.velocity[name] = (c['momentum']*self.velocity[name] +
+                                   c['learning_rate']*g)
+            p[name] += self.velocity[name]
+        return(np.mean(np.sum((v - nv)**2, axis=1)))
+
+    def trainEpoch(self, batchdata, hist, index):
+        delay, batch_size = self.config['delay'], self.config['batch_size']
+        order = index[self.rng.permutation(len(index))]
+        errors = []
+        for b in range(0, len(order), batch_size):
+            t = order[b:b + batch_size]
+            errors.append(self.update(batchdata[t], hist[t - delay]))
+        self.epoch += 1
+        return(np.mean(errors))
+
+    def crbm(self):
+        p = self.params
+        forward = CRBM(p['W'], p['B'], p['A'], p['hbias'], p['vbias'],
+                       self.config['delay'])
+        # Back from window order to the order of rrbm (t-1 first)
+        return(CRBM(p['W'], forward.forwardWeights(p['B']),
+                    forward.forwardWeights(p['A']), p['hbias'], p['vbias'],
+                    self.config['delay']))
+
+    # Checkpoint: parameters, momentum, RNG state, epoch and log. Written to a
+    # temporary file and renamed.
+    def save(self, path):
+        state = {'config': self.config, 'epoch': self.epoch, 'log': self.log,
+                 'rng': self.rng.get_state()}
+        arrays = {'param_' + k: v for k, v in self.params.items()}
+        arrays.update({'velocity_' + k: v for k, v in self.velocity.items()})
+        tmp = path + '.tmp.npz'
+        np.savez(tmp, state=np.array([state], dtype=object), **arrays)
+        os.replace(tmp, path)
+
+    def restore(self, path):
+        with np.load(path, allow_pickle=True) as f:
+            state = f['state'][0]
+            if state['config'] != self.config:
+                raise ValueError("Checkpoint {} was made with {}".format(
+                                 path, state['config']))
+            for k in self.params:
+                self.params[k] = f['param_' + k]
+                self.velocity[k] = f['velocity_' + k]
+        self.epoch = state['epoch']
+        self.log = state['log']
+        self.rng.set_state(state['rng'])
+
+
+# Trains for training_epochs (in total, counting the ones of the checkpoint
+# it resumes from). With checkpoint set, the trainer state is saved there
+# every checkpoint_every epochs and at the end, and training resumes from it
+# if it exists. The per-epoch reconstruction error and time go to the log
+# (and to log_file as CSV).
+def trainCRBM(batchdata, seqlen, n_hidden=10, delay=20, training_epochs=300,
+              learning_rate=1e-3, momentum=0.5, batch_size=100, k=1,
+              seed=1234, checkpoint=None, checkpoint_every=10, log_file=None,
+              verbose=50):
+    batchdata = np.ascontiguousarray(batchdata, dtype=np.float64)
+    n, d = batchdata.shape
+    trainer = CRBMTrainer(d, n_hidden, delay, learning_rate, momentum,
+                          batch_size, k, seed)
+    if checkpoint is not None and os.path.isfile(checkpoint):
+        trainer.restore(checkpoint)
+        if verbose:
+            print("Resuming from epoch", trainer.epoch)
+
+    index = windowIndex(seqlen, delay)
+    hist = as_strided(batchdata, shape=(max(n - delay, 0), delay*d),
+                      strides=batchdata.strides, writeable=False)
+    while trainer.epoch < training_epochs:
+        start_time = time.time()
+        error = trainer.trainEpoch(batchdata, hist, index)
+        trainer.log.append({'epoch': trainer.epoch, 'recon_error': error,
+                            'time': time.time() - start_time})
+        if verbose and (trainer.epoch % verbose == 1 or verbose == 1):
+            print("Training epoch {}, cost is {}".format(trainer.epoch,
+                                                         error))
+        done = trainer.epoch == training_epochs
+        if checkpoint is not None and (trainer.epoch % checkpoint_every == 0
+                                       or done):
+            trainer.save(checkpoint)
+        if log_file is not None and (trainer.epoch % checkpoint_every == 0
+                                     or done):
+            pd.DataFrame(trainer.log).to_csv(log_file, index=False)
+    return(trainer.crbm(), pd.DataFrame(trainer.log))
+
+
+# ## Sweeps
+#
+# Every configuration (dict of trainCRBM arguments, e.g. n_hidden and delay)
+# is trained in its own process, with its CRBM, checkpoint and log in
+# folder/h<n_hidden>-d<delay>. Finished configurations (with a saved CRBM
+# trained for as many epochs) are not trained again, and interrupted ones (or
+# ones asked for more epochs) resume from their checkpoint.
+# Each process uses blas_threads BLAS threads if threadpoolctl is installed.
+
+def sweepFolder(folder, config):
+    return(os.path.join(folder, 'h{}-d{}'.format(config.get('n_hidden', 10),
+                                                 config.get('delay', 20))))
+
+
+def trainConfig(batchdata, seqlen, config, folder, blas_threads=None):
+    os.makedirs(folder, exist_ok=True)
+    crbm_folder = os.path.join(folder, 'crbm')
+    log_file = os.path.join(folder, 'log.csv')
+    if os.path.isfile(os.path.join(crbm_folder, 'meta.csv')):
+        log = pd.read_csv(log_file)
+        if len(log) >= config.get('training_epochs', 300):
+            return(log)
+    try:
+        from threadpoolctl import threadpool_limits
+        limits = threadpool_limits(blas_threads)
+    except ImportError:
+        limits = None
+    try:
+        crbm, log = trainCRBM(batchdata, seqlen,
+                              checkpoint=os.path.join(folder, 'checkpoint.npz'),
+                              log_file=log_file, verbose=0, **config)
+    finally:
+        if limits is not None:
+            limits.unregister()
+    saveCRBM(crbm, crbm_folder)
+    return(log)
+
+
+def trainSweep(batchdata, seqlen, configs, folder, n_jobs=1,
+               blas_threads=None):
+    folders = [sweepFolder(folder, config) for config in configs]
+    if n_jobs == 1:
+        logs = [trainConfig(batchdata, seqlen, config, f, blas_threads)
+                for config, f in zip(configs, folders)]
+    else:
+        import concurrent.futures
+
+        with concurrent.futures.ProcessPoolExecutor(n_jobs) as pool:
+            logs = list(pool.map(trainConfig, [batchdata]*len(configs),
+                                 [seqlen]*len(configs), configs, folders,
+                                 [blas_threads]*len(configs)))
+    rows = []
+    for config, f, log in zip(configs, folders, logs):
+        rows.append(dict(config, folder=f, epochs=len(log),
+                         recon_error=log['recon_error'].iloc[-1],
+                         train_time=log['time'].sum()))
+    return(pd.DataFrame(rows))
+
+
+# ## Comparison
+
+# Compares activations (n x n_hidden) with the ones written by R (e.g. the
+# activations.* columns of the activation dataset), on the samples with a
+# full history.
+def compareActivations(act, expected, rtol=1e-8):
+    act = np.asarray(act, dtype=np.float64)
+    expected = np.asarray(expected, dtype=np.float64)
+    if act.shape != expected.shape:
+        raise ValueError("Shapes differ: {} vs {}".format(act.shape,
+                                                          expected.shape))
+    rows = ~np.isnan(act).any(axis=1)
+    if not np.allclose(act[rows], expected[rows], rtol=rtol, atol=1e-12):
+        raise ValueError("Activations differ")
+    return(True)
+
+
+# Rows of a table sorted by ship (ids) matching activations written per ship
+# by R (expected_ids, sorted the same way). predict may leave out the first
+# samples of a ship, the ones without a full history, so the R rows of each
+# ship are matched with its last rows.
+def shipTailRows(ids, expected_ids):
+    ships, starts, counts = np.unique(ids, return_index=True,
+                                      return_counts=True)
+    position = np.searchsorted(ships, expected_ids)
+    if len(ships) == 0 or np.any(position >= len(ships)) or \
+       np.any(ships[np.minimum(position, len(ships) - 1)] != expected_ids):
+        raise ValueError("Ships of the R activations missing in the dataset")
+    expected_counts = np.bincount(position, minlength=len(ships))
+    if np.any(expected_counts > counts):
+        raise ValueError("More R activations than samples in some ships")
+    first = np.cumsum(expected_counts) - expected_counts
+    return(starts[position] + counts[position] - expected_counts[position] +
+           np.arange(len(expected_ids)) - first[position])
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument("-i", "--input", metavar="FILE", required=True,
+            help = "Ship samples CSV (the `ships` data of the R scripts) or "
+                   "trace store folder (tracefunctions.py).")
+    parser.add_argument("-c", "--crbm", metavar="FOLDER", required=True,
+            help = "CRBM exported with export_crbm (CRBM-tools.r).")
+    parser.add_argument("-o", "--output", metavar="FILE",
+            help = "Output CSV: input columns plus activations.*.")
+    parser.add_argument("-d", "--datacols", default="rotationGPS,sog,bathymetry3",
+            help = "Comma separated data columns (reqcols in R).")
+    parser.add_argument("--check", metavar="FILE",
+            help = "Activation dataset written by R to compare with (same "
+                   "ships; a ship can leave out its first samples).")
+    args = parser.parse_args()
+
+    crbm = loadCRBM(args.crbm)
+    res = activationDataset(readShips(args.input), crbm,
+                            args.datacols.split(","))
+    if args.output is not None:
+        res.to_csv(args.output, index=False)
+    if args.check is not None:
+        expected = pd.read_csv(args.check).sort_values('imo', kind='mergesort')
+        columns = ['activations.{}'.format(i + 1) for i in range(crbm.n_hidden)]
+        rows = shipTailRows(res['imo'].values, expected['imo'].values)
+        compareActivations(res[columns].values[rows],
+                           expected[columns].values)
+        print("Same activations as", args.check)
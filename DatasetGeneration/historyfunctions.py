@@ -0,0 +1,170 @@
+# # History dataset
+#
+# Python version of generate_window_data (CRBM-tools.r): for every sample of a
+# ship with at least `delay` samples, the values of each data column in the
+# last `delay` samples, as columns <col>delay..<col>1 (<col>1 is the oldest,
+# <col>delay the current sample). The data columns themselves are dropped and
+# every other column of the current sample is kept.
+#
+# Instead of one cell at a time, the windows are strided views over the whole
+# table sorted by ship, and only the windows that do not cross two ships are
+# kept. Output is written in blocks of rows as they are built, as CSV (same
+# table as R) or, much faster to write and read back, as Parquet when the
+# output ends in .parquet (needs pyarrow):
+#
+#     python historyfunctions.py -i ships.csv -o history.parquet -d 20
+#
+# Differences with the R version: ships with fewer than `delay` samples give
+# no rows (R gives rows with NA history for them) and samples without IMO
+# (NA or 0) are dropped, as in ALOJA_DBN_CRBM-ActivationDatasetGen.r.
+
+import os
+import time
+
+from argparse import ArgumentParser
+
+import numpy as np
+import pandas as pd
+
+from numpy.lib.stride_tricks import as_strided
+
+from tracefunctions import readShips
+
+
+def historyColumns(datacols, delay):
+    return([dc + str(i) for dc in datacols for i in range(delay, 0, -1)])
+
+
+# Strided (n-delay+1, delay) view of a column: no copy
+def slidingWindows(values, delay):
+    values = np.ascontiguousarray(values)
+    return(as_strided(values, shape=(len(values) - delay + 1, delay),
+                      strides=values.strides*2, writeable=False))
+
+
+# Ships sorted by IMO (stable: each ship keeps its sample order, as split()
+# in R), without the samples with no IMO
+def sortShips(dataset, id_var='imo'):
+    dataset = dataset[dataset[id_var].notna() & (dataset[id_var] != 0)]
+    return(dataset.sort_values(id_var, kind='mergesort')
+                  .reset_index(drop=True))
+
+
+# Generator of history blocks (DataFrames of at most block_size rows) of a
+# dataset sorted by ship.
+def historyBlocks(dataset, delay, datacols, id_var='imo', block_size=100000):
+    if len(dataset) < delay:
+        return
+    ships = dataset[id_var].values
+    # Columns are windowed one by one to keep their dtypes
+    windows = [slidingWindows(dataset[dc].values, delay) for dc in datacols]
+    # A window is inside one ship iff its first and last samples are
+    starts = np.flatnonzero(ships[:len(ships) - delay + 1] ==
+                            ships[delay - 1:])
+    keep = [col for col in dataset.columns if col not in datacols]
+
+    for b in range(0, len(starts), block_size):
+        s = starts[b:b + block_size]
+        block = [dataset[keep].iloc[s + delay - 1].reset_index(drop=True)]
+        for dc, w in zip(datacols, windows):
+            # Newest sample first: <dc>delay .. <dc>1
+            block.append(pd.DataFrame(w[s, ::-1],
+                                      columns=historyColumns([dc], delay)))
+        yield(pd.concat(block, axis=1))
+
+
+def historyDataset(dataset, delay, datacols, id_var='imo'):
+    blocks = list(historyBlocks(sortShips(dataset, id_var), delay, datacols,
+                                id_var))
+    if not blocks:
+        return(pd.DataFrame(columns=[col for col in dataset.columns
+                                     if col not in datacols] +
+                                    historyColumns(datacols, delay)))
+    return(pd.concat(blocks, ignore_index=True))
+
+
+# Builds the history dataset of the CSV at path into output, block by block.
+# The output is written to a temporary file and renamed when complete.
+def writeHistoryDataset(path, output, delay, datacols, id_var='imo',
+                        block_size=100000, verbose=True):
+    start_time = time.time()
+    dataset = sortShips(readShips(path), id_var)
+    blocks = historyBlocks(dataset, delay, datacols, id_var, block_size)
+    tmp = output + '.tmp'
+    nrows = 0
+    if output.endswith('.parquet'):
+        import pyarrow
+        import pyarrow.parquet
+
+        writer = None
+        for block in blocks:
+            table = pyarrow.Table.from_pandas(block, preserve_index=False)
+            if writer is None:
+                writer = pyarrow.parquet.ParquetWriter(tmp, table.schema)
+            writer.write_table(table)
+            nrows += len(block)
+        if writer is None:
+            historyDataset(dataset, delay, datacols, id_var).to_parquet(tmp)
+        else:
+            writer.close()
+    else:
+        with open(tmp, 'w') as f:
+            header = True
+            for block in blocks:
+                block.to_csv(f, index=False, header=header)
+                header = False
+                nrows += len(block)
+    os.replace(tmp, output)
+    if verbose:
+        print("History dataset ({} rows, delay {}) written to {} in {:.1f}s"
+              .format(nrows, delay, output, time.time() - start_time))
+    return(nrows)
+
+
+# ## Comparison
+
+# Compares two history datasets (e.g. this one and the one written by R) by
+# value. Raises ValueError on the first difference.
+def compareHistory(res, expected, rtol=1e-12):
+    if list(res.columns) != list(expected.columns):
+        raise ValueError("Columns differ: {} vs {}".format(
+                         list(res.columns), list(expected.columns)))
+    if len(res) != len(expected):
+        raise ValueError("Rows differ: {} vs {}".format(len(res),
+                                                        len(expected)))
+    for col in res.columns:
+        a, b = res[col], expected[col]
+        if pd.api.types.is_numeric_dtype(a) and \
+           pd.api.types.is_numeric_dtype(b):
+            same = np.allclose(a.values.astype(float), b.values.astype(float),
+                               rtol=rtol, atol=0, equal_nan=True)
+        else:
+            same = np.array_equal(a.astype(str).values, b.astype(str).values)
+        if not same:
+            raise ValueError("Column {} differs".format(col))
+    return(True)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-i", "--input", metavar="FILE", required=True,
+            help = "Ship samples CSV (the `ships` data of the R scripts) or "
+                   "trace store folder (tracefunctions.py).")
+    parser.add_argument("-o", "--output", metavar="FILE",
+            help = "Output CSV for the history dataset.")
+    parser.add_argument("-d", "--delay", type=int, default=20,
+            help = "Number of samples per window. Default 20.")
+    parser.add_argument("-c", "--datacols", default="rotationGPS,sog,bathymetry3",
+            help = "Comma separated data columns.")
+    parser.add_argument("--check", metavar="FILE",
+            help = "History CSV written by R (write.table of historyDataset) "
+                   "to compare with.")
+    args = parser.parse_args()
+    datacols = args.datacols.split(",")
+
+    if args.output is not None:
+        writeHistoryDataset(args.input, args.output, args.delay, datacols)
+    if args.check is not None:
+        res = historyDataset(readShips(args.input), args.delay, datacols)
+        compareHistory(res, pd.read_csv(args.check))
+        print("Same history dataset as", args.check)
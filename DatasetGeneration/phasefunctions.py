@@ -0,0 +1,251 @@
+# # Phase assignment
+#
+# Python version of the clustering step of CRBMAnalysis_ClusterDataset.r: the
+# CRBM activations are clustered with k-means and every sample gets the phase
+# (cluster) of its closest centre, as closest.cluster (CRBM-tools.r).
+#
+# In R, produce_data_phases assigns the whole activation matrix again for each
+# ship and then keeps the rows of that ship. Here all the rows are assigned
+# once, with blocked matrix distances (or a KD-tree for many centres in few
+# dimensions), and the labels of each ship are slices given by its offsets.
+# The centres can be exported from R (export_kmeans in CRBM-tools.r) or
+# fitted here with minibatch k-means over an activation file read in chunks:
+#
+#     python phasefunctions.py -i activations.csv -k 5 -o phases.csv
+#     python phasefunctions.py -i activations.csv --centers centers.csv -o phases.csv
+#
+# Phases are 1..k, as the `cluster` column of the R dataset. Samples without
+# activations (no full history, or ships with no full window, which have -1)
+# get no phase, as detect_phases_series gives NA to ships shorter than delay.
+
+import os
+import time
+
+from argparse import ArgumentParser
+
+import numpy as np
+import pandas as pd
+
+
+def activationColumns(columns):
+    return([col for col in columns if col.startswith('activations.')])
+
+
+# Rows with activations: finite and not the -1 of ships with no full window
+def validActivations(act):
+    return(np.isfinite(act).all(axis=1) & ~(act == -1).all(axis=1))
+
+
+# ## Nearest centre
+
+# Index (0..k-1) of the closest centre of every row, ties to the first one as
+# which.min. Squared distances |x|^2 - 2 x.c + |c|^2 are computed a block of
+# rows at a time. The KD-tree (scipy) is only faster with hundreds of centres
+# in few dimensions (5x with 1000 centres of up to 5 dimensions, slower with
+# 10). Rows that are not valid get -1.
+def nearestCentroids(X, centers, method='auto', block_size=65536):
+    X = np.asarray(X, dtype=np.float64)
+    centers = np.asarray(centers, dtype=np.float64)
+    labels = np.full(len(X), -1, dtype=np.int64)
+    rows = np.flatnonzero(validActivations(X))
+    if method == 'auto':
+        method = ('kdtree' if len(centers) >= 500 and centers.shape[1] <= 6
+                  else 'brute')
+
+    if method == 'kdtree':
+        from scipy.spatial import cKDTree
+
+        labels[rows] = cKDTree(centers).query(X[rows])[1]
+        return(labels)
+
+    c2 = np.sum(centers**2, axis=1)
+    for b in range(0, len(rows), block_size):
+        r = rows[b:b + block_size]
+        # |x|^2 is the same for all the centres of a row
+        labels[r] = np.argmin(c2 - 2*(X[r] @ centers.T), axis=1)
+    return(labels)
+
+
+# Phases 1..k of the labels, NA without phase
+def phases(labels):
+    res = pd.array(labels + 1, dtype='Int64')
+    res[labels < 0] = pd.NA
+    return(res)
+
+
+# Phases of every ship as slices of the phases of all the rows (offsets as
+# shipOffsets or TraceStore.offsets)
+def phasesByShip(labels, offsets):
+    res = phases(labels)
+    return([res[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)])
+
+
+# Phase dataset: an activation dataset (crbmfunctions.activationDataset)
+# plus its `cluster` column
+def phaseDataset(dataset, centers, method='auto'):
+    act = dataset[activationColumns(dataset.columns)].values
+    labels = nearestCentroids(act, centers, method)
+    res = dataset.copy()
+    res['cluster'] = phases(labels)
+    return(res)
+
+
+# ## Minibatch k-means
+#
+# Sculley's minibatch k-means: every centre moves towards the rows of a
+# minibatch assigned to it with a step of 1/(rows assigned so far). Centres
+# are initialized with k-means++ on the first init_size valid rows. chunks
+# is a function returning a new iterator of activation arrays (one pass over
+# the file), so files larger than memory are read once per epoch.
+
+def kmeansPlusPlus(X, k, rng):
+    centers = [X[rng.randint(len(X))]]
+    d2 = np.sum((X - centers[0])**2, axis=1)
+    for _ in range(1, k):
+        total = d2.sum()
+        if total > 0:
+            i = rng.choice(len(X), p=d2/total)
+        else:
+            i = rng.randint(len(X))
+        centers.append(X[i])
+        d2 = np.minimum(d2, np.sum((X - X[i])**2, axis=1))
+    return(np.array(centers))
+
+
+def miniBatchKMeans(chunks, k, batch_size=1024, epochs=3, init_size=None,
+                    seed=1337, verbose=True):
+    rng = np.random.RandomState(seed)
+    init_size = init_size or max(3*k, 10*batch_size)
+    sample = []
+    nsample = 0
+    for chunk in chunks():
+        chunk = chunk[validActivations(chunk)]
+        sample.append(chunk[:init_size - nsample])
+        nsample += len(sample[-1])
+        if nsample >= init_size:
+            break
+    sample = np.concatenate(sample)
+    if len(sample) < k:
+        raise ValueError("Fewer valid rows ({}) than clusters ({})".format(
+                         len(sample), k))
+    centers = kmeansPlusPlus(sample, k, rng)
+    counts = np.zeros(k)
+
+    for epoch in range(epochs):
+        start_time = time.time()
+        for chunk in chunks():
+            chunk = chunk[validActivations(chunk)]
+            chunk = chunk[rng.permutation(len(chunk))]
+            for b in range(0, len(chunk), batch_size):
+                batch = chunk[b:b + batch_size]
+                labels = nearestCentroids(batch, centers, 'brute')
+                n = np.bincount(labels, minlength=k)
+                sums = np.stack([np.bincount(labels, weights=batch[:, j],
+                                             minlength=k)
+                                 for j in range(batch.shape[1])], axis=1)
+                counts += n
+                moved = n > 0
+                # Per-row 1/count steps of a minibatch, in closed form
+                centers[moved] += ((sums[moved] - n[moved, None] *
+                                    centers[moved]) / counts[moved, None])
+        if verbose:
+            print("Epoch {}: {:.1f}s".format(epoch + 1,
+                                              time.time() - start_time))
+    return(centers)
+
+
+# Within-cluster sums of squares (kc$withinss) and sizes (kc$size)
+def clusterStats(chunks, centers):
+    k = len(centers)
+    withinss = np.zeros(k)
+    size = np.zeros(k, dtype=np.int64)
+    for chunk in chunks():
+        labels = nearestCentroids(chunk, centers)
+        rows = labels >= 0
+        d2 = np.sum((chunk[rows] - centers[labels[rows]])**2, axis=1)
+        withinss += np.bincount(labels[rows], weights=d2, minlength=k)
+        size += np.bincount(labels[rows], minlength=k)
+    return(pd.DataFrame({'cluster': np.arange(1, k + 1), 'size': size,
+                         'withinss': withinss}))
+
+
+# ## Files
+
+# Chunks of the activation columns of a CSV (as a function, for several
+# passes)
+def activationChunks(path, chunksize=200000):
+    columns = activationColumns(pd.read_csv(path, nrows=0).columns)
+
+    def chunks():
+        for chunk in pd.read_csv(path, usecols=columns, chunksize=chunksize):
+            yield(chunk[columns].values.astype(np.float64))
+    return(chunks)
+
+
+# Centres as written by export_kmeans: one row per cluster
+def readCenters(path):
+    return(pd.read_csv(path).values.astype(np.float64))
+
+
+def writeCenters(centers, path):
+    columns = ['activations.{}'.format(i + 1) for i in range(centers.shape[1])]
+    pd.DataFrame(centers, columns=columns).to_csv(path, index=False)
+
+
+# Writes the phase dataset of the activation CSV at path chunk by chunk to a
+# temporary file renamed when complete
+def writePhaseDataset(path, output, centers, chunksize=200000,
+                      method='auto', verbose=True):
+    start_time = time.time()
+    tmp = output + '.tmp'
+    nrows = 0
+    with open(tmp, 'w') as f:
+        header = True
+        for chunk in pd.read_csv(path, chunksize=chunksize):
+            phaseDataset(chunk, centers, method).to_csv(f, index=False,
+                                                        header=header)
+            header = False
+            nrows += len(chunk)
+    os.replace(tmp, output)
+    if verbose:
+        print("Phases of {} rows written to {} in {:.1f}s".format(
+              nrows, output, time.time() - start_time))
+    return(nrows)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-i", "--input", metavar="FILE", required=True,
+            help = "Activation dataset CSV (crbmfunctions.py output).")
+    parser.add_argument("-o", "--output", metavar="FILE",
+            help = "Output CSV: input columns plus cluster.")
+    parser.add_argument("-k", "--clusters", type=int, default=5,
+            help = "Number of clusters (clusterK). Default 5.")
+    parser.add_argument("--centers", metavar="FILE",
+            help = "Centres exported with export_kmeans. If not given, they "
+                   "are fitted with minibatch k-means and written next to "
+                   "the output.")
+    parser.add_argument("-b", "--batch_size", type=int, default=1024,
+            help = "Minibatch size. Default 1024.")
+    parser.add_argument("-e", "--epochs", type=int, default=3,
+            help = "Passes over the file. Default 3.")
+    parser.add_argument("--chunksize", type=int, default=200000,
+            help = "Rows read per chunk. Default 200000.")
+    parser.add_argument("--method", default="auto",
+            choices=["auto", "brute", "kdtree"],
+            help = "Nearest centre search. Default: auto.")
+    args = parser.parse_args()
+
+    chunks = activationChunks(args.input, args.chunksize)
+    if args.centers is not None:
+        centers = readCenters(args.centers)
+    else:
+        centers = miniBatchKMeans(chunks, args.clusters, args.batch_size,
+                                  args.epochs)
+        if args.output is not None:
+            writeCenters(centers, os.path.splitext(args.output)[0] +
+                         "-centers.csv")
+    print(clusterStats(chunks, centers))
+    if args.output is not None:
+        writePhaseDataset(args.input, args.output, centers, args.chunksize,
+                          args.method)
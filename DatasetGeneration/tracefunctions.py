@@ -0,0 +1,282 @@
+# # Trace store
+#
+# AIS samples sorted once by ship and time (imo, fechahora) and stored as one
+# .npy file per column, plus the sorted IMOs and the offsets of their first
+# rows. The R scripts select a ship with a scan of the whole table
+# (dataset[dataset[[id_var]] == target, ] in generate_data,
+# AISData[AISData$imo == shipIMO, ] in singleShipEstimation), which is
+# quadratic over all the ships. Here the samples of a ship are a slice of
+# the memory-mapped columns:
+#
+#     store = TraceStore("ais-store")
+#     sog = store.ship(9100002)['sog']     # view, no copy
+#
+# The store is built from a CSV read in chunks: the chunks are spilled to
+# disk and sorted column by column, so it is not held in memory at once:
+#
+#     python tracefunctions.py -i AISData.csv -o ais-store
+#
+# Samples without IMO (NA or 0) are dropped, as in sortShips. Text columns
+# are stored as category codes.
+
+import json
+import os
+import shutil
+import time
+
+from argparse import ArgumentParser
+
+import numpy as np
+import pandas as pd
+
+
+# Offsets of the first row of each ship (and the number of rows at the end)
+# of a table sorted by ship
+def shipOffsets(ships):
+    ships = np.asarray(ships)
+    starts = np.flatnonzero(np.r_[True, ships[1:] != ships[:-1]])
+    return(np.r_[starts, len(ships)])
+
+
+# ## Build
+
+def dropNoIMO(dataset, id_var='imo'):
+    dataset = dataset[dataset[id_var].notna() & (dataset[id_var] != 0)]
+    return(dataset.astype({id_var: np.int64}))
+
+
+# Columns of a chunk as arrays: text as codes of categories, which grow with
+# the new values found in each chunk
+def chunkColumns(chunk, categories):
+    res = {}
+    for col in chunk.columns:
+        values = chunk[col]
+        if col in categories or not (pd.api.types.is_numeric_dtype(values) or
+                                     pd.api.types.is_bool_dtype(values)):
+            known = categories.setdefault(col, [])
+            seen = set(known)
+            known.extend(v for v in pd.unique(values.dropna())
+                         if v not in seen)
+            values = pd.Categorical(values, categories=known).codes
+            values = values.astype(np.int32)
+        res[col] = np.asarray(values)
+    return(res)
+
+
+# Writes the sorted columns (column(name) returns the whole sorted array of
+# a column, which is written before the next one is computed), the ships and
+# their offsets to tmp and renames it to folder
+def writeStore(tmp, folder, names, column, categories, id_var, time_var):
+    meta = {'id_var': id_var, 'time_var': time_var, 'nrows': 0,
+            'columns': []}
+    for i, col in enumerate(names):
+        values = column(col)
+        np.save(os.path.join(tmp, 'col_{}.npy'.format(i)), values)
+        meta['nrows'] = len(values)
+        meta['columns'].append({'name': col, 'dtype': str(values.dtype),
+                                'categories': categories.get(col)})
+        del values
+    ships = np.load(os.path.join(tmp, 'col_{}.npy'.format(
+                    names.index(id_var))), mmap_mode='r')
+    offsets = shipOffsets(ships)
+    np.save(os.path.join(tmp, 'offsets.npy'), offsets)
+    np.save(os.path.join(tmp, 'ships.npy'), np.asarray(ships[offsets[:-1]]))
+    del ships
+
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f, default=str)
+    shutil.rmtree(folder, ignore_errors=True)
+    os.rename(tmp, folder)
+    return(TraceStore(folder))
+
+
+# Values of a column in the order of its values: the codes of a text column
+# follow the order in which its values first appeared, so they are replaced
+# by the rank of their category (missing values last)
+def sortKey(values, categories=None):
+    if categories is None:
+        return(values)
+    ranks = np.empty(len(categories) + 1, dtype=np.int64)
+    ranks[np.argsort(np.array(categories, dtype=object), kind='stable')] = \
+        np.arange(len(categories))
+    ranks[-1] = len(categories) # Code -1
+    return(ranks[values])
+
+
+# Store of a CSV read in chunks. Every chunk is spilled column by column;
+# then each column is read back, promoted to a common dtype (an int column
+# can have NA, i.e. floats, in some chunks) and sorted.
+def buildTraceStore(path, folder, id_var='imo', time_var='fechahora',
+                    usecols=None, chunksize=1000000, verbose=True):
+    start_time = time.time()
+    tmp = folder + '.tmp'
+    spill = os.path.join(tmp, 'spill')
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(spill)
+
+    categories = {}
+    dtypes = {}
+    for c, chunk in enumerate(pd.read_csv(path, usecols=usecols,
+                                          chunksize=chunksize)):
+        chunk = dropNoIMO(chunk, id_var)
+        for col, values in chunkColumns(chunk, categories).items():
+            dtypes.setdefault(col, []).append(values.dtype)
+            values.tofile(os.path.join(spill, '{}.{}.bin'.format(col, c)))
+
+    def spilled(col):
+        dtype = np.result_type(*dtypes[col])
+        return(np.concatenate([np.fromfile(
+                   os.path.join(spill, '{}.{}.bin'.format(col, c)),
+                   dtype=d).astype(dtype)
+                   for c, d in enumerate(dtypes[col])]))
+
+    # Stable sort by ship, then time
+    keys = [spilled(id_var)]
+    if time_var in dtypes:
+        keys.insert(0, sortKey(spilled(time_var), categories.get(time_var)))
+    order = np.lexsort(keys)
+    del keys
+    store = writeStore(tmp, folder, list(dtypes),
+                       lambda col: spilled(col)[order], categories, id_var,
+                       time_var)
+    if verbose:
+        print("Trace store of {} rows and {} ships written to {} in {:.1f}s"
+              .format(len(store), len(store.ships), folder,
+                      time.time() - start_time))
+    return(store)
+
+
+# Store of a DataFrame already in memory
+def saveTraceStore(dataset, folder, id_var='imo', time_var='fechahora'):
+    dataset = dropNoIMO(dataset, id_var)
+    keys = [dataset[id_var].values]
+    if time_var in dataset.columns:
+        keys.insert(0, dataset[time_var].values)
+    order = np.lexsort(keys)
+
+    tmp = folder + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    categories = {}
+    arrays = chunkColumns(dataset, categories)
+    return(writeStore(tmp, folder, list(arrays),
+                      lambda col: arrays[col][order], categories, id_var,
+                      time_var))
+
+
+# ## Store
+#
+# Columns are memory mapped, so opening a store costs nothing and worker
+# processes share its pages. Text columns are returned as codes by ship()
+# and columns(); frame() decodes them.
+
+class TraceStore:
+    def __init__(self, folder, mmap_mode='r'):
+        self.folder = folder
+        with open(os.path.join(folder, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.id_var = self.meta['id_var']
+        self.time_var = self.meta['time_var']
+        self.names = [col['name'] for col in self.meta['columns']]
+        self.data = {col['name']: np.load(
+                         os.path.join(folder, 'col_{}.npy'.format(i)),
+                         mmap_mode=mmap_mode)
+                     for i, col in enumerate(self.meta['columns'])}
+        self.categories = {col['name']: col['categories']
+                           for col in self.meta['columns']
+                           if col['categories'] is not None}
+        self.ships = np.load(os.path.join(folder, 'ships.npy'))
+        self.offsets = np.load(os.path.join(folder, 'offsets.npy'))
+        self.position = {imo: i for i, imo in enumerate(self.ships.tolist())}
+
+    def __len__(self):
+        return(self.meta['nrows'])
+
+    def __contains__(self, imo):
+        return(imo in self.position)
+
+    # Rows of a ship as a slice
+    def rows(self, imo):
+        i = self.position[imo]
+        return(slice(self.offsets[i], self.offsets[i + 1]))
+
+    def seqlen(self):
+        return(np.diff(self.offsets))
+
+    # Ship number (0..nships-1) of every row
+    def codes(self):
+        return(np.repeat(np.arange(len(self.ships)), self.seqlen()))
+
+    # Column views of a ship
+    def ship(self, imo, columns=None):
+        rows = self.rows(imo)
+        return({col: self.data[col][rows] for col in (columns or self.names)})
+
+    # Rows of some ships, in the given order (ships not in the store are
+    # skipped), and the number (0..) of their ship in that order
+    def select(self, ships):
+        pos = np.array([self.position[imo] for imo in ships if imo in self],
+                       dtype=np.int64)
+        lengths = self.offsets[pos + 1] - self.offsets[pos]
+        starts = np.cumsum(lengths) - lengths
+        index = (np.repeat(self.offsets[pos] - starts, lengths) +
+                 np.arange(lengths.sum()))
+        return(index, np.repeat(np.arange(len(pos)), lengths))
+
+    # Columns of all the rows, or of the rows of some ships, as one array
+    # per column
+    def columns(self, columns=None, ships=None):
+        columns = columns or self.names
+        if ships is None:
+            return({col: self.data[col] for col in columns})
+        index = self.select(ships)[0]
+        return({col: self.data[col][index] for col in columns})
+
+    # Values of data columns (n x len(columns) float64) with the number of
+    # their ship, the input of crbmfunctions
+    def matrix(self, columns, ships=None):
+        if ships is None:
+            index, codes = slice(None), self.codes()
+        else:
+            index, codes = self.select(ships)
+        values = np.column_stack([np.asarray(self.data[col][index],
+                                             dtype=np.float64)
+                                  for col in columns])
+        return(values, codes)
+
+    def frame(self, columns=None, ships=None):
+        data = self.columns(columns, ships)
+        for col, cats in self.categories.items():
+            if col in data:
+                data[col] = pd.Categorical.from_codes(np.asarray(data[col]),
+                                                      cats)
+        return(pd.DataFrame(data))
+
+    def iterShips(self, columns=None):
+        for imo in self.ships.tolist():
+            yield(imo, self.ship(imo, columns))
+
+
+# Ship samples of a CSV or of a store folder as a DataFrame (the store is
+# already sorted by ship and time)
+def readShips(path, columns=None):
+    if os.path.isdir(path):
+        return(TraceStore(path).frame(columns))
+    return(pd.read_csv(path, usecols=columns))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-i", "--input", metavar="FILE", required=True,
+            help = "AIS CSV.")
+    parser.add_argument("-o", "--output", metavar="FOLDER", required=True,
+            help = "Store folder.")
+    parser.add_argument("-c", "--columns",
+            help = "Comma separated columns to keep. Default: all.")
+    parser.add_argument("--chunksize", type=int, default=1000000,
+            help = "Rows read per chunk. Default 1000000.")
+    args = parser.parse_args()
+
+    usecols = args.columns.split(",") if args.columns else None
+    buildTraceStore(args.input, args.output, usecols=usecols,
+                    chunksize=args.chunksize)
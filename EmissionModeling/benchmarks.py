@@ -0,0 +1,190 @@
+# # Benchmarks
+#
+# Throughput checks for the Python emission estimation. Run it from this
+# folder with `python benchmarks.py`. The values are checked against the R
+# ports by the tests (python -m pytest tests, from the root).
+
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from emissionfunctions import estimateEmissions
+from interpolationfunctions import interpolateShips
+from scenariofunctions import estimateScenarios
+from sinkfunctions import ResultSink
+from reducerfunctions import (FleetTotals, GridInventory, ShipTotals,
+                              TimeSeries, pollutants, streamEmissions)
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                             'tests'))
+from testtools import (fleetData, referenceFillSerie, referenceScenarios,
+                       referenceShipEmissions, timeit, traced, weekTraces)
+
+
+# ## Emissions
+#
+# Samples per second of the fleet estimation and of the per-ship version
+# (one ship at a time, as singleShipEstimation), timed on nref ships.
+
+def benchEmissions(sizes=(100, 1000, 10000), nref=50):
+    rows = []
+    for nships in sizes:
+        ais, ihs = fleetData(nships)
+        (res, _, _), fleet_time = timeit(lambda: estimateEmissions(
+            ais, ihs, sampleGranularity=10, verbose=False))
+
+        params = ihs.set_index('LRIMOShipNO')
+        ships = ihs['LRIMOShipNO'].values[:nref]
+        start_time = time.time()
+        nref_samples = 0
+        for imo in ships:
+            sog = ais.loc[ais['imo'] == imo, 'sog'].values
+            referenceShipEmissions(sog, params.loc[imo].to_dict(), 10)
+            nref_samples += len(sog)
+        ref_time = time.time() - start_time
+        rows.append({'ships': nships, 'samples': len(res),
+                     'time': fleet_time,
+                     'samples_per_sec': len(res)/fleet_time,
+                     'per_ship_samples_per_sec': nref_samples/ref_time})
+    return pd.DataFrame(rows)
+
+
+# ## Interpolation
+#
+# Time and peak memory (tracemalloc) of the interpolation of one-week traces
+# (a sample every 1 to 10 minutes, some gaps of hours or days) with direct
+# resampling and with the per-second grid of fillSerieLinearly in R.
+
+def benchInterpolation(nships=20, sampleTime=10, maxTimeGap=24*60*60):
+    ais = weekTraces(nships)
+    series = [serie for _, serie in ais.groupby('imo')]
+
+    expected, ref_time, ref_peak = traced(lambda: [
+        referenceFillSerie(serie, sampleTime=sampleTime,
+                           maxTimeGap=maxTimeGap) for serie in series])
+    traces, time_, peak = traced(lambda: [
+        trace for _, trace in interpolateShips(ais, sampleTime=sampleTime,
+                                               maxTimeGap=maxTimeGap)])
+    return pd.DataFrame([{
+        'ships': nships, 'samples': len(ais),
+        'rows': sum(len(trace) for trace in traces),
+        'grid_rows': sum(rows for _, rows in expected),
+        'grid_time': ref_time, 'grid_peak_mb': ref_peak,
+        'time': time_, 'peak_mb': peak}])
+
+
+# ## Reducers
+#
+# Peak memory of the fleet totals of CRBMEmissions.R (every interpolated
+# sample in one table, then colSums) and of the streaming reducers, with
+# the same totals (also summed over the ships, hours and cells).
+
+def benchReducers(nships=100, batch_size=10):
+    ais = weekTraces(nships)
+    ihs = fleetData(nships)[1]
+    ihs['LRIMOShipNO'] = np.arange(9000001, 9000001 + nships)
+
+    totals, full_time, full_peak = traced(lambda: estimateEmissions(
+        ais, ihs, interpolation=10, verbose=False)[0][pollutants].sum())
+    (reducers, _), time_, peak = traced(lambda: streamEmissions(
+        ais, ihs, {'fleet': FleetTotals(), 'ships': ShipTotals(),
+                   'hourly': TimeSeries(), 'grid': GridInventory()},
+        batch_size=batch_size, interpolation=10, verbose=False))
+    if not np.allclose(reducers['fleet'].result(), totals):
+        raise ValueError("Fleet totals differ")
+    # Every sample is in one ship, hour and cell
+    for name in ['ships', 'hourly', 'grid']:
+        if not np.allclose(reducers[name].sums.sum(axis=0), totals):
+            raise ValueError("{} totals differ".format(name))
+    # Raw samples without coordinates are not in any cell, but in unlocated
+    raw = ais.copy()
+    raw.loc[::50, 'longitude'] = np.nan
+    raw.loc[1::50, 'latitude'] = np.nan
+    raw_totals = estimateEmissions(raw, ihs, verbose=False)[0][pollutants].sum()
+    grid = streamEmissions(raw, ihs, {'grid': GridInventory()},
+                           batch_size=batch_size, verbose=False)[0]['grid']
+    cells = grid.result()
+    if not np.isfinite(cells[['longitude', 'latitude']].values).all() or \
+       cells['latitude'].abs().max() > 90:
+        raise ValueError("Grid cells of samples without coordinates")
+    if grid.unlocated.samples != raw[['longitude', 'latitude']].isna() \
+                                 .any(axis=1).sum() or \
+       not np.allclose(grid.sums.sum(axis=0) + grid.unlocated.sums,
+                       raw_totals):
+        raise ValueError("Grid and unlocated totals differ")
+    return pd.DataFrame([{
+        'ships': nships, 'samples': reducers['fleet'].samples,
+        'table_time': full_time, 'table_peak_mb': full_peak,
+        'time': time_, 'peak_mb': peak}])
+
+
+# ## Result sink
+#
+# Rows per second stored by writeDFToSQLite in tools/db.R (a connection and
+# an insert per ship result, journal_mode MEMORY) and by the batched sink.
+
+def connectionPerTable(tables, path):
+    for table in tables:
+        con = sqlite3.connect(path, timeout=600)
+        con.execute('PRAGMA journal_mode = MEMORY')
+        table.to_sql('emissions', con, if_exists='append', index=False)
+        con.commit()
+        con.close()
+
+
+def sinkTables(tables, path):
+    with ResultSink(path, indexes={'emissions': ['shipIMO']}) as sink:
+        for table in tables:
+            sink.put('emissions', table)
+
+
+def benchSink(nships=500, mean_length=1000):
+    ais, ihs = fleetData(nships, mean_length)
+    res = estimateEmissions(ais, ihs, verbose=False)[0]
+    tables = [table for _, table in res.groupby('shipIMO', sort=False)]
+    rows = []
+    with tempfile.TemporaryDirectory() as folder:
+        for name, write in [('per_ship_connection', connectionPerTable),
+                            ('sink', sinkTables)]:
+            _, elapsed = timeit(write, tables,
+                                os.path.join(folder, name + '.sqlite'))
+            rows.append({'writer': name, 'tables': len(tables),
+                         'rows': len(res), 'time': elapsed,
+                         'rows_per_sec': len(res)/elapsed})
+    return pd.DataFrame(rows)
+
+
+# ## Power scenarios
+#
+# The real power and three predictions, estimated in one pass and as four
+# estimations (CRBMEmissions.R).
+
+def benchScenarios(nships=200, interpolation=10):
+    ais = weekTraces(nships)
+    ihs = fleetData(nships)[1]
+    ihs['LRIMOShipNO'] = np.arange(9000001, 9000001 + nships)
+    rng = np.random.RandomState(0)
+    real = ihs.set_index('LRIMOShipNO')['installedPowerME']
+    power = pd.DataFrame({name: real*rng.uniform(0.5, 1.5, nships)
+                          for name in ['act', 'his', 'avg']})
+    power.insert(0, 'rea', real)
+    (results, _, _), time_ = timeit(lambda: estimateScenarios(
+        ais, ihs, power, interpolation=interpolation, verbose=False))
+    _, ref_time = timeit(lambda: referenceScenarios(
+        ais, ihs, power, interpolation=interpolation))
+    return pd.DataFrame([{'ships': nships, 'samples': len(ais),
+                          'time': time_, 'reference_time': ref_time,
+                          'speedup': ref_time/time_}])
+
+
+if __name__ == "__main__":
+    print(benchEmissions())
+    print(benchInterpolation())
+    print(benchReducers())
+    print(benchSink())
+    print(benchScenarios())
@@ -0,0 +1,368 @@
+# # Emission functions
+#
+# NumPy version of the Jalkanen 2009 estimation (estimateShipEmissions2009 in
+# jalkanen2009/, with the PM and engine load equations of jalkanen2012/).
+# The R code estimates one ship at a time; here every equation is an array
+# operation over all the AIS samples of all the ships at once, and the ship
+# parameters (IHS) are broadcast to the samples by IMO:
+#
+#     python emissionfunctions.py -a AIS1week.csv -s IHSTestData.csv \
+#         -g 10 -o emissions.csv
+#
+# -g is the interpolation step (interpolationfunctions.py).
+#
+# Results are the same as the R functions (tests/test_emissions.py compares
+# them with a literal per-ship port). Ships with missing parameters get no emissions
+# and are reported as errors: in R, NA engine rpm makes calcNOxEmissionFactor
+# fail and NA speed or power give NA emissions.
+
+import os
+import time
+
+from argparse import ArgumentParser
+
+import numpy as np
+import pandas as pd
+
+from interpolationfunctions import interpolateFleet
+
+units = {'g': 1, 'kg': 10**3, 't': 10**6}
+
+passenger_types = ["Passenger (Cruise) Ship", "Passenger/Ro-Ro Cargo Ship",
+                   "Passenger Ship"]
+
+# IHS columns used by the estimation
+ihs_columns = ['designSpeed', 'installedPowerME', 'installedPowerAE', 'type',
+               'n_installed_me', 'MainEngineRPM', 'AuxiliaryEngineRPM']
+
+
+# ## 5. ME transient power (Eq. 3 and 4, speeds in knots)
+
+def transientPowerME(VTransient, VDesign, PInstalled, EpsilonP=0.8,
+                     VSafety=0.5):
+    k = (EpsilonP*PInstalled)/(VDesign + VSafety)**3
+    return(k*VTransient**3)
+
+
+# ## 6. AE transient power
+#
+# Hotelling (< 1 knot) 1000 kW, manoeuvring (1-5 knots) 1250 kW and cruising
+# (> 5 knots) 750 kW, at most the installed AE power. Passenger ships 4000 kW
+# (or the installed power, if lower). maxPower NaN or <= 0 is unknown: no
+# limit.
+
+def speedToUsedBasePower(speed, maxPower=None):
+    res = np.full(np.shape(speed), 1000.0)
+    res[(speed > 1) & (speed <= 5)] = 1250
+    res[speed > 5] = 750
+    if maxPower is not None:
+        maxPower = np.broadcast_to(maxPower, res.shape)
+        limit = maxPower > 0 # False for NaN
+        res[limit] = np.minimum(res[limit], maxPower[limit])
+    return(res)
+
+
+def transientPowerAE(speed, passenger, instPow=None):
+    res = speedToUsedBasePower(speed, instPow)
+    passenger = np.broadcast_to(passenger, res.shape)
+    if instPow is None:
+        res[passenger] = 4000
+    else:
+        instPow = np.broadcast_to(instPow, res.shape)
+        limit = instPow > 0
+        res[passenger] = np.where(limit[passenger],
+                                  np.minimum(4000, instPow[passenger]), 4000)
+    return(res)
+
+
+# ## Emission factors (g/kWh)
+
+# IMO NOx Tier 1 curve: 17 below 130 rpm, 45*n^-0.2 up to 2000 rpm, 9.8
+# above, 0 for engines with 0 rpm. NaN for unknown rpm.
+def calcNOxEmissionFactor(rpm):
+    rpm = np.asarray(rpm, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        res = np.where(rpm < 130, 17.0,
+                       np.where(rpm < 2000, 45*rpm**-0.2, 9.8))
+    res[rpm <= 0] = 0
+    res[np.isnan(rpm)] = np.nan
+    return(res)
+
+
+def calcSOxEmissionFactor(SFOC=200, SC=0.001):
+    nS = (SFOC*SC)/32.0655
+    return(64.06436*nS)
+
+
+def calcCO2EmissionFactor(SFOC=200, CC=0.85):
+    nC = (SFOC*CC)/12.01
+    return(44.00886*nC)
+
+
+# ## Particulate matter (Jalkanen 2012, Eq. 13 and 14)
+
+def calcEmissionFactorSO4(S=0.001):
+    return(0.312*S)
+
+
+def calcEmissionFactorH2O(S=0.001):
+    return(0.244*S)
+
+
+def calcOCELFactor(EL, a=1.024, b=-47.660, c=32.547):
+    EL = np.asarray(EL, dtype=np.float64)
+    with np.errstate(over='ignore'):
+        return(np.where(EL >= 0.15, a/(1 + b*np.exp(-c*EL)), 3.333))
+
+
+def calcEmissionFactorPM(relSFOC, EFSO4, EFH2O, OCEL, EFOC=0.02, EFEC=0.08,
+                         EFAsh=0.06):
+    return(relSFOC*(EFSO4 + EFH2O + (EFOC*OCEL) + EFEC + EFAsh))
+
+
+# Acceleration based component (Eq. 16) of samples sorted by ship and time:
+# alpha*|dv|/dt capped to 1, NaN for the first sample of each ship (it has
+# no previous one; R returns one value less per ship).
+def calcABC(speed, timestamps, ships, alpha=582):
+    speed = np.asarray(speed, dtype=np.float64)
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    res = np.full(len(speed), np.nan)
+    same = np.asarray(ships[1:]) == np.asarray(ships[:-1])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        abc = alpha*(np.abs(np.diff(speed))/np.diff(timestamps))
+    abc[abc > 1] = 1
+    res[1:][same] = abc[same]
+    return(res)
+
+
+def calcEmissionFactorCO(COBase, ABC):
+    return(COBase*ABC)
+
+
+# ## Engine load balancing (Eq. 9 and 10): identical main engines
+
+def calcNumOperativeEngines(totalPower, enginePower):
+    return(np.trunc(totalPower/enginePower + 1))
+
+
+def calcEngineLoad(totalPower, enginePower, nOperationalEngines):
+    return(totalPower/(enginePower*nOperationalEngines))
+
+
+def calcRelativeSFOC(EL):
+    return(0.455*EL**2 - 0.71*EL + 1.28)
+
+
+# ## Fleet estimation
+
+# Parameters of each ship (first row of its IMO, as singleShipEstimation)
+# broadcast to the samples: one array per IHS column, and whether each
+# sample has parameters.
+def shipParameters(ihs, imo, id_var='LRIMOShipNO'):
+    ihs = ihs.drop_duplicates(id_var, keep='first')
+    position = pd.Index(ihs[id_var]).get_indexer(imo)
+    found = position >= 0
+    params = {}
+    for col in ihs_columns:
+        values = ihs[col].values
+        if col == 'type':
+            values = np.isin(values.astype(str), passenger_types)
+            params['passenger'] = np.where(found, values[position], False)
+        else:
+            values = values.astype(np.float64)
+            params[col] = np.where(found, values[position], np.nan)
+    return(params, found)
+
+
+# Main engine power and PM emission factor of the samples. Arrays broadcast:
+# installedPowerME can be (samples x scenarios) with the other parameters
+# as (samples x 1) columns (scenariofunctions.py).
+def mainEngine(sog, params, installedPowerME):
+    transPME = transientPowerME(sog, params['designSpeed'], installedPowerME)
+    enginePowerME = installedPowerME/params['n_installed_me']
+    nOperationalEngines = calcNumOperativeEngines(transPME, enginePowerME)
+    EL = calcEngineLoad(transPME, enginePowerME, nOperationalEngines)
+    relSFOC = calcRelativeSFOC(EL)
+    PMFactME = calcEmissionFactorPM(relSFOC, calcEmissionFactorSO4(),
+                                    calcEmissionFactorH2O(),
+                                    calcOCELFactor(EL))
+    return(transPME, PMFactME)
+
+
+# Emissions of every sample (columns of estimateShipEmissions2009) and the
+# per-sample emission factors. sampleGranularity is the seconds represented
+# by each sample (the interpolation step).
+def emissions2009(sog, params, sampleGranularity=1, unit='g'):
+    sog = np.asarray(sog, dtype=np.float64)
+    unit = units[unit]
+
+    # g/kWh * kW / 3600 s/h: grams per second, times the seconds per sample
+    def emission(factor, power):
+        return((factor*power/3600)/unit*sampleGranularity)
+
+    transPME, PMFactME = mainEngine(sog, params, params['installedPowerME'])
+    transPAE = transientPowerAE(sog, params['passenger'],
+                                params['installedPowerAE'])
+
+    SOxFact = calcSOxEmissionFactor(SC=0.001)
+    CO2Fact = calcCO2EmissionFactor()
+
+    NOxFactME = calcNOxEmissionFactor(params['MainEngineRPM'])
+    NOxFactAE = calcNOxEmissionFactor(params['AuxiliaryEngineRPM'])
+
+    emissions = {
+        'SOxME': emission(SOxFact, transPME),
+        'SOxAE': emission(SOxFact, transPAE),
+        'CO2ME': emission(CO2Fact, transPME),
+        'CO2AE': emission(CO2Fact, transPAE),
+        'NOxME': emission(NOxFactME, transPME),
+        'NOxAE': emission(NOxFactAE, transPAE),
+        'PMME': emission(PMFactME, transPME),
+        'transPME': transPME, 'transPAE': transPAE}
+    factors = {'SOXFactME': np.full(len(sog), SOxFact),
+               'SOxFactAE': np.full(len(sog), SOxFact),
+               'CO2Fact': np.full(len(sog), CO2Fact),
+               'NOxFactME': np.broadcast_to(NOxFactME, sog.shape),
+               'NOxFactAE': np.broadcast_to(NOxFactAE, sog.shape),
+               'PMFactME': PMFactME}
+    return(emissions, factors)
+
+
+# Estimation of the AIS samples (a DataFrame or a TraceStore, as
+# estimateEmissions) of the ships in both AIS and IHS (or in shipIMOList).
+# With interpolation, the traces are first resampled every interpolation
+# seconds (fillSerieLinearly, as singleShipEstimation) and each sample
+# represents that many seconds; otherwise each sample is sampleGranularity
+# seconds. Returns the emissions (shipIMO, the AIS columns and the emissions
+# of every sample), the mean emission factors of each ship
+# (meanEmissionFactors in R) and the ships with errors (missing parameters).
+def estimateEmissions(ships, ihs, shipIMOList=None, interpolation=None,
+                      maxTimeGap=24*60*60, sampleGranularity=1, unit='g',
+                      id_var='imo', ihs_id='LRIMOShipNO', verbose=True):
+    start_time = time.time()
+    store = hasattr(ships, 'ship')
+    if shipIMOList is None:
+        imos = ships.ships if store else ships[id_var].unique()
+        shipIMOList = np.intersect1d(imos, ihs[ihs_id])
+    if interpolation is not None:
+        ships = interpolateFleet(ships, shipIMOList, id_var,
+                                 sampleTime=interpolation,
+                                 maxTimeGap=maxTimeGap)
+        sampleGranularity = interpolation
+    elif store:
+        ships = ships.frame(ships=shipIMOList)
+    ships = ships[ships[id_var].isin(shipIMOList)]
+    # Samples grouped by ship, in the order of shipIMOList (as rbindlist)
+    order = pd.Index(shipIMOList).get_indexer(ships[id_var])
+    ships = ships.iloc[np.argsort(order, kind='stable')] \
+                 .reset_index(drop=True)
+    imo = ships[id_var].values
+
+    params, found = shipParameters(ihs, imo, ihs_id)
+    emissions, factors = emissions2009(ships['sog'].values, params,
+                                       sampleGranularity, unit)
+
+    # Ships whose emissions cannot be computed (NA in R: dropped)
+    valid = found.copy()
+    for col in ['designSpeed', 'installedPowerME', 'n_installed_me',
+                'MainEngineRPM', 'AuxiliaryEngineRPM']:
+        valid &= np.isfinite(params[col])
+    invalid = np.unique(imo[~valid])
+    keep = ~np.isin(imo, invalid)
+    errors = pd.DataFrame({'shipIMO': invalid, 'type': 'error',
+                           'message': 'missing or invalid IHS parameters'})
+
+    # Interpolated traces have no IMO column in R (only shipIMO)
+    if interpolation is not None:
+        ships = ships.drop(columns=id_var)
+    res = pd.concat([pd.DataFrame({'shipIMO': imo[keep]}),
+                     ships[keep].reset_index(drop=True),
+                     pd.DataFrame({col: values[keep]
+                                   for col, values in emissions.items()})],
+                    axis=1)
+    factors = pd.DataFrame({col: np.asarray(values)[keep]
+                            for col, values in factors.items()})
+    factors.insert(0, 'shipIMO', imo[keep])
+    factors = factors.groupby('shipIMO', sort=False).mean().reset_index()
+    if verbose:
+        print("Emissions of {} samples of {} ships in {:.2f}s ({} ships "
+              "with errors)".format(len(res), len(factors),
+                                    time.time() - start_time, len(invalid)))
+    return(res, factors, errors)
+
+
+# ## Comparison
+
+pollutants = ['SOxME', 'SOxAE', 'CO2ME', 'CO2AE', 'NOxME', 'NOxAE', 'PMME',
+              'transPME', 'transPAE']
+
+
+# Compares emissions (estimateEmissions or R's estimateEmissions written as
+# CSV) by value. Raises ValueError on the first difference.
+def compareEmissions(res, expected, rtol=1e-10):
+    if len(res) != len(expected):
+        raise ValueError("Rows differ: {} vs {}".format(len(res),
+                                                        len(expected)))
+    for col in pollutants:
+        if not np.allclose(res[col].values, expected[col].values, rtol=rtol,
+                           atol=0, equal_nan=True):
+            raise ValueError("Column {} differs".format(col))
+    return(True)
+
+
+# ## Input
+
+# AIS samples of a CSV, or a trace store (DatasetGeneration/
+# tracefunctions.py) if path is its folder
+def readAIS(path):
+    if os.path.isdir(path):
+        import sys
+        sys.path.append(os.path.join(os.path.dirname(
+            os.path.abspath(__file__)), '..', 'DatasetGeneration'))
+        from tracefunctions import TraceStore
+        return(TraceStore(path))
+    return(pd.read_csv(path, quotechar='"'))
+
+
+def readIHS(path):
+    ihs = pd.read_csv(path, sep='\t')
+    # CRBMEmissions.R: unknown main engine rpm (Jalkanen 2009)
+    ihs['MainEngineRPM'] = ihs['MainEngineRPM'].fillna(514)
+    return(ihs)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-a", "--ais", metavar="FILE", required=True,
+            help = "AIS samples CSV or trace store folder.")
+    parser.add_argument("-s", "--ihs", metavar="FILE", required=True,
+            help = "IHS data (tab separated, as IHSTestData.csv).")
+    parser.add_argument("-g", "--interpolation", type=int, default=10,
+            help = "Interpolation step in seconds (interpolationGranularity "
+                   "of CRBMEmissions.R). 0 to use the samples as they are, "
+                   "as 1 second each. Default 10.")
+    parser.add_argument("--max_gap", type=int, default=24*60*60,
+            help = "Longest gap to interpolate, in seconds. Default 1 day.")
+    parser.add_argument("-u", "--unit", default="g", choices=list(units),
+            help = "Unit of the emissions. Default g.")
+    parser.add_argument("-o", "--output", metavar="FILE",
+            help = "Output CSV with the emissions of every sample.")
+    parser.add_argument("--check", metavar="FILE",
+            help = "Emissions CSV written by R (estimateEmissions) to "
+                   "compare with.")
+    args = parser.parse_args()
+
+    interpolation = args.interpolation if args.interpolation > 0 else None
+    res, factors, errors = estimateEmissions(readAIS(args.ais),
+                                             readIHS(args.ihs),
+                                             interpolation=interpolation,
+                                             maxTimeGap=args.max_gap,
+                                             unit=args.unit)
+    if len(errors):
+        print("Errors:")
+        print(errors.to_string(index=False))
+    if args.output is not None:
+        res.to_csv(args.output, index=False)
+    if args.check is not None:
+        compareEmissions(res, pd.read_csv(args.check))
+        print("Same emissions as", args.check)
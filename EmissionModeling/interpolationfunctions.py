@@ -0,0 +1,126 @@
+# # Interpolation functions
+#
+# Python version of fillSerieLinearly (tools/interpolation.R). R merges the
+# trace of a ship with a grid of every second of its time span, fills the
+# gaps of up to maxTimeGap seconds with na.approx, drops the rest and then
+# keeps the seconds that are multiples of sampleTime: a week of one ship is
+# about 600k rows before the sampling.
+#
+# Here the trace is split in segments where consecutive samples are at most
+# maxTimeGap + 1 seconds apart (gaps na.approx fills) and the values are
+# interpolated directly at the multiples of sampleTime inside each segment,
+# with the same formula as R's approx. No per-second rows are built. Each
+# column is interpolated over its own non-NA samples, as na.approx does, and
+# the times where any column is not filled are dropped (na.omit).
+#
+# As zoo, samples are sorted by time; for repeated times the first sample is
+# kept.
+
+import numpy as np
+import pandas as pd
+
+
+# Target times (multiples of sampleTime) of the segments of the sorted,
+# unique times t: runs with steps of at most maxTimeGap + 1 seconds
+def segmentTimes(t, sampleTime=1, maxTimeGap=24*60*60):
+    if len(t) == 0:
+        return(np.array([], dtype=np.int64))
+    cuts = np.flatnonzero(np.diff(t) > maxTimeGap + 1) + 1
+    starts = t[np.r_[0, cuts]]
+    ends = t[np.r_[cuts - 1, len(t) - 1]]
+    first = -(-starts//sampleTime)*sampleTime # ceiling to a multiple
+    counts = np.maximum((ends - first)//sampleTime + 1, 0)
+    # Position of every target time inside its segment
+    step = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,
+                                               counts)
+    return(np.repeat(first, counts) + step*sampleTime)
+
+
+# Linear interpolation of (t, y) at tout as R's approx, NaN where the
+# samples around are more than maxTimeGap + 1 seconds apart (na.approx
+# maxgap) or outside of them
+def approxGaps(t, y, tout, maxTimeGap=24*60*60):
+    ok = ~np.isnan(y)
+    t, y = t[ok], y[ok]
+    res = np.full(len(tout), np.nan)
+    if len(t) == 0:
+        return(res)
+    j = np.searchsorted(t, tout, side='left')
+    exact = (j < len(t)) & (t[np.minimum(j, len(t) - 1)] == tout)
+    res[exact] = y[j[exact]]
+    inside = ~exact & (j > 0) & (j < len(t))
+    i, j = j[inside] - 1, j[inside]
+    fill = (t[j] - t[i] - 1) <= maxTimeGap
+    v = tout[inside]
+    with np.errstate(invalid='ignore'):
+        values = y[i] + (y[j] - y[i])*((v - t[i])/(t[j] - t[i]))
+    res[np.flatnonzero(inside)[fill]] = values[fill]
+    return(res)
+
+
+# Interpolated trace of one ship: fechahora plus the data columns, as the
+# data.frame returned by fillSerieLinearly
+def fillSerieLinearly(serie, timeAttribute='fechahora',
+                      dataAttributes=('latitude', 'longitude', 'sog'),
+                      sampleTime=1, maxTimeGap=24*60*60):
+    times = np.asarray(serie[timeAttribute], dtype=np.int64)
+    order = np.argsort(times, kind='stable')
+    times = times[order]
+    first = np.r_[True, times[1:] != times[:-1]]
+    times = times[first]
+    tout = segmentTimes(times, max(int(sampleTime), 1), maxTimeGap)
+
+    res = {'fechahora': tout}
+    keep = np.ones(len(tout), dtype=bool)
+    for col in dataAttributes:
+        y = np.asarray(serie[col], dtype=np.float64)[order][first]
+        res[col] = approxGaps(times, y, tout, maxTimeGap)
+        keep &= ~np.isnan(res[col])
+    return(pd.DataFrame({col: values[keep] for col, values in res.items()}))
+
+
+# Generator of the interpolated traces of every ship (imo, trace) of AIS
+# samples, one ship at a time. ships can be a DataFrame or a TraceStore
+# (DatasetGeneration/tracefunctions.py).
+def interpolateShips(ships, shipIMOList=None, id_var='imo',
+                     timeAttribute='fechahora',
+                     dataAttributes=('latitude', 'longitude', 'sog'),
+                     sampleTime=1, maxTimeGap=24*60*60):
+    columns = [timeAttribute] + list(dataAttributes)
+    if hasattr(ships, 'ship'):
+        if shipIMOList is None:
+            shipIMOList = ships.ships.tolist()
+        for imo in shipIMOList:
+            if imo in ships:
+                yield(imo, fillSerieLinearly(ships.ship(imo, columns),
+                                             timeAttribute, dataAttributes,
+                                             sampleTime, maxTimeGap))
+        return
+
+    codes, imos = pd.factorize(ships[id_var])
+    order = np.argsort(codes, kind='stable')
+    offsets = np.r_[0, np.cumsum(np.bincount(codes, minlength=len(imos)))]
+    values = {col: ships[col].values[order] for col in columns}
+    position = {imo: i for i, imo in enumerate(imos.tolist())}
+    if shipIMOList is None:
+        shipIMOList = imos.tolist()
+    for imo in shipIMOList:
+        if imo not in position:
+            continue
+        rows = slice(offsets[position[imo]], offsets[position[imo] + 1])
+        yield(imo, fillSerieLinearly({col: v[rows]
+                                      for col, v in values.items()},
+                                     timeAttribute, dataAttributes,
+                                     sampleTime, maxTimeGap))
+
+
+# Interpolated traces of all the ships in one DataFrame (imo first)
+def interpolateFleet(ships, shipIMOList=None, id_var='imo', **kwargs):
+    traces = [trace.assign(**{id_var: imo})
+              for imo, trace in interpolateShips(ships, shipIMOList, id_var,
+                                                 **kwargs)]
+    if not traces:
+        return(pd.DataFrame(columns=[id_var, 'fechahora']))
+    res = pd.concat(traces, ignore_index=True)
+    return(res[[id_var] + [col for col in res.columns if col != id_var]])
+
@@ -0,0 +1,359 @@
+# # Reducer functions
+#
+# Streaming aggregation of emissions. shipSubsetEstimation gathers the
+# emissions of every sample of every ship in one data.frame, and then
+# CRBMEmissions.R only keeps colSums(...)/10^6. Here the ships are estimated
+# in batches and every batch is folded into a set of reducers; workers only
+# return the reduced state, so memory depends on the reducers (ships, time
+# bins, grid cells), not on the number of AIS samples:
+#
+#     reducers = {'ships': ShipTotals(), 'fleet': FleetTotals(),
+#                 'daily': TimeSeries(bin=86400),
+#                 'grid': GridInventory(resolution=0.1)}
+#     res = streamEmissions(store, ihs, reducers, interpolation=10, n_jobs=8)
+#     res['fleet'].result()
+#
+# A reducer has fold(emissions) for a DataFrame of emissions (the output of
+# estimateEmissions), merge(other) for the state of another worker and
+# result(). Reducers start empty and are copied to every batch.
+
+import concurrent.futures
+import copy
+import time
+
+from argparse import ArgumentParser
+
+import numpy as np
+import pandas as pd
+
+from emissionfunctions import estimateEmissions, readAIS, readIHS, units
+from sinkfunctions import QueueSink
+
+
+pollutants = ['SOxME', 'SOxAE', 'CO2ME', 'CO2AE', 'NOxME', 'NOxAE', 'PMME']
+
+
+# Per group sums of the pollutants of a chunk as (groups, sums), with
+# sums a (groups x pollutants) array
+def groupSums(keys, values):
+    groups, inverse = np.unique(keys, return_inverse=True)
+    sums = np.stack([np.bincount(inverse, weights=v, minlength=len(groups))
+                     for v in values], axis=1)
+    return(groups, sums)
+
+
+# Sums of the pollutants by key, folded chunk by chunk. The state is the
+# sorted keys (groups) and their sums. Subclasses define name (the key
+# column of the result) and keys(emissions), the key of every sample.
+#
+# The groups of a chunk (sorted and unique, as groupSums and the state of
+# another reducer) are merged into the state with searchsorted: known groups
+# are added in place and only the new ones are inserted, so a fold does not
+# sort the whole state again.
+class GroupReducer:
+    def __init__(self, pollutants=pollutants):
+        self.pollutants = list(pollutants)
+        self.groups = np.array([], dtype=np.int64)
+        self.sums = np.zeros((0, len(self.pollutants)))
+
+    def add(self, groups, sums):
+        if not len(self.groups):
+            self.groups = np.array(groups)
+            self.sums = np.array(sums, dtype=np.float64).reshape(
+                len(groups), len(self.pollutants))
+            return
+        pos = np.searchsorted(self.groups, groups)
+        found = pos < len(self.groups)
+        found[found] = self.groups[pos[found]] == groups[found]
+        self.sums[pos[found]] += sums[found]
+        new = ~found
+        if new.any():
+            self.groups = np.insert(self.groups, pos[new], groups[new])
+            self.sums = np.insert(self.sums, pos[new], sums[new], axis=0)
+
+    def fold(self, emissions):
+        if len(emissions):
+            self.add(*groupSums(self.keys(emissions),
+                                [emissions[p].values
+                                 for p in self.pollutants]))
+
+    def merge(self, other):
+        self.add(other.groups, other.sums)
+
+    def result(self):
+        res = pd.DataFrame(self.sums, columns=self.pollutants)
+        res.insert(0, self.name, self.groups)
+        return(res)
+
+
+# Emissions of each ship (per-ship sums of estimateEmissions)
+class ShipTotals(GroupReducer):
+    name = 'shipIMO'
+
+    def keys(self, emissions):
+        return(emissions['shipIMO'].values)
+
+
+# Emissions per time bin of bin seconds (the start of the bin)
+class TimeSeries(GroupReducer):
+    name = 'fechahora'
+
+    def __init__(self, pollutants=pollutants, bin=3600,
+                 timeAttribute='fechahora'):
+        GroupReducer.__init__(self, pollutants)
+        self.bin = bin
+        self.timeAttribute = timeAttribute
+
+    def keys(self, emissions):
+        t = emissions[self.timeAttribute].values.astype(np.int64)
+        return(t//self.bin*self.bin)
+
+
+# Emissions of the whole fleet (colSums in CRBMEmissions.R)
+class FleetTotals:
+    def __init__(self, pollutants=pollutants):
+        self.pollutants = list(pollutants)
+        self.sums = np.zeros(len(self.pollutants))
+        self.samples = 0
+
+    def fold(self, emissions):
+        self.sums += [emissions[p].values.sum() for p in self.pollutants]
+        self.samples += len(emissions)
+
+    def merge(self, other):
+        self.sums += other.sums
+        self.samples += other.samples
+
+    def result(self):
+        return(pd.Series(self.sums, index=self.pollutants))
+
+
+# ## Gridded inventory
+#
+# Emissions summed on a regular lon/lat grid of cells of resolution degrees,
+# with their origin at (lon0, lat0). Only the cells with emissions are kept
+# (the state is sparse), so the grid can cover the whole world. Samples
+# without finite coordinates (raw AIS rows when there is no interpolation)
+# are not in any cell: their emissions are summed apart, in unlocated (a
+# FleetTotals), so the cells plus unlocated still add up to the fleet.
+
+class GridInventory(GroupReducer):
+    name = 'cell'
+
+    def __init__(self, pollutants=pollutants, resolution=0.1, lon0=-180,
+                 lat0=-90, coordNames=('longitude', 'latitude')):
+        GroupReducer.__init__(self, pollutants)
+        self.resolution = resolution
+        self.lon0 = lon0
+        self.lat0 = lat0
+        self.coordNames = coordNames
+        self.ncols = int(np.ceil(360/resolution)) + 1
+        self.unlocated = FleetTotals(pollutants)
+
+    def fold(self, emissions):
+        located = np.isfinite(emissions[self.coordNames[0]].values) & \
+                  np.isfinite(emissions[self.coordNames[1]].values)
+        if not located.all():
+            self.unlocated.fold(emissions[~located])
+            emissions = emissions[located]
+        GroupReducer.fold(self, emissions)
+
+    def merge(self, other):
+        GroupReducer.merge(self, other)
+        self.unlocated.merge(other.unlocated)
+
+    def keys(self, emissions):
+        lon = emissions[self.coordNames[0]].values
+        lat = emissions[self.coordNames[1]].values
+        col = np.floor((lon - self.lon0)/self.resolution).astype(np.int64)
+        row = np.floor((lat - self.lat0)/self.resolution).astype(np.int64)
+        return(row*self.ncols + col)
+
+    # Cells with their centre coordinates
+    def result(self):
+        row, col = np.divmod(self.groups.astype(np.int64), self.ncols)
+        res = pd.DataFrame(self.sums, columns=self.pollutants)
+        res.insert(0, 'latitude',
+                   np.round(self.lat0 + (row + 0.5)*self.resolution, 10))
+        res.insert(0, 'longitude',
+                   np.round(self.lon0 + (col + 0.5)*self.resolution, 10))
+        return(res)
+
+    # Dense (rows x cols) array of a pollutant inside a lon/lat box, with
+    # row 0 the southernmost one
+    def toArray(self, pollutant, lon_min, lon_max, lat_min, lat_max):
+        res = self.result()
+        col = np.floor((res['longitude'] - lon_min) /
+                       self.resolution).astype(np.int64)
+        row = np.floor((res['latitude'] - lat_min) /
+                       self.resolution).astype(np.int64)
+        shape = (int(np.ceil((lat_max - lat_min)/self.resolution)),
+                 int(np.ceil((lon_max - lon_min)/self.resolution)))
+        inside = (row >= 0) & (row < shape[0]) & (col >= 0) & \
+                 (col < shape[1])
+        grid = np.zeros(shape)
+        np.add.at(grid, (row[inside], col[inside]),
+                  res[pollutant].values[inside])
+        return(grid)
+
+
+# ## Streaming estimation
+#
+# Ships are estimated in batches of batch_size ships. Each batch folds its
+# emissions into empty copies of the reducers and only their states return
+# to the parent, which merges them. With a TraceStore, workers open the
+# store themselves (memory mapped) and only receive the IMOs of their batch.
+# With a sink (sinkfunctions.QueueSink), workers also send the emissions,
+# emission factors and errors of their batches to its writer.
+
+worker_ships = None
+
+def initWorker(folder):
+    global worker_ships
+    if folder is not None:
+        worker_ships = readAIS(folder)
+
+
+def reduceBatch(ships, ihs, imos, reducers, kwargs, queue=None):
+    if ships is None:
+        ships = worker_ships
+    emissions, factors, errors = estimateEmissions(ships, ihs,
+                                                   shipIMOList=imos,
+                                                   verbose=False, **kwargs)
+    for reducer in reducers.values():
+        reducer.fold(emissions)
+    # Tables of singleShipEstimation, for the writer of the sink
+    if queue is not None:
+        queue.put(('emissions', emissions))
+        queue.put(('emissionFactors', factors))
+        queue.put(('error', errors))
+    return(reducers, errors, len(emissions))
+
+
+def streamEmissions(ships, ihs, reducers, shipIMOList=None, n_jobs=1,
+                    batch_size=100, id_var='imo', ihs_id='LRIMOShipNO',
+                    sink=None, verbose=True, **kwargs):
+    start_time = time.time()
+    store = hasattr(ships, 'ship')
+    if shipIMOList is None:
+        imos = ships.ships if store else ships[id_var].unique()
+        shipIMOList = np.intersect1d(imos, ihs[ihs_id])
+    batches = [shipIMOList[b:b + batch_size]
+               for b in range(0, len(shipIMOList), batch_size)]
+    kwargs = dict(kwargs, id_var=id_var, ihs_id=ihs_id)
+    ihs = ihs[ihs[ihs_id].isin(shipIMOList)]
+    empty = copy.deepcopy(reducers)
+    queue = sink.queue if sink is not None else None
+
+    def batchShips(imos):
+        if store:
+            return(None if n_jobs != 1 else ships)
+        return(ships[ships[id_var].isin(imos)])
+
+    errors = []
+    nsamples = 0
+
+    def collect(state, e, n):
+        nonlocal nsamples
+        for name, reducer in reducers.items():
+            reducer.merge(state[name])
+        errors.append(e)
+        nsamples += n
+
+    if n_jobs == 1:
+        for imos in batches:
+            collect(*reduceBatch(batchShips(imos), ihs, imos,
+                                 copy.deepcopy(empty), kwargs, queue))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(n_jobs,
+                initializer=initWorker,
+                initargs=(ships.folder if store else None,)) as pool:
+            # At most 2*n_jobs batches in flight, so the parent does not
+            # hold the samples of every batch at once
+            pending = set()
+            for imos in batches:
+                if len(pending) >= 2*n_jobs:
+                    done, pending = concurrent.futures.wait(pending,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                    for d in done:
+                        collect(*d.result())
+                pending.add(pool.submit(reduceBatch, batchShips(imos), ihs,
+                                        imos, copy.deepcopy(empty), kwargs,
+                                        queue))
+            for d in concurrent.futures.as_completed(pending):
+                collect(*d.result())
+    errors = pd.concat(errors, ignore_index=True) if errors else \
+             pd.DataFrame(columns=['shipIMO', 'type', 'message'])
+    if verbose:
+        print("Emissions of {} samples of {} ships reduced in {:.1f}s".format(
+              nsamples, len(shipIMOList), time.time() - start_time))
+    return(reducers, errors)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-a", "--ais", metavar="FILE", required=True,
+            help = "AIS samples CSV or trace store folder.")
+    parser.add_argument("-s", "--ihs", metavar="FILE", required=True,
+            help = "IHS data (tab separated, as IHSTestData.csv).")
+    parser.add_argument("-g", "--interpolation", type=int, default=10,
+            help = "Interpolation step in seconds. 0 to use the samples as "
+                   "they are. Default 10.")
+    parser.add_argument("--max_gap", type=int, default=24*60*60,
+            help = "Longest gap to interpolate, in seconds. Default 1 day.")
+    parser.add_argument("-u", "--unit", default="g", choices=list(units),
+            help = "Unit of the emissions. Default g.")
+    parser.add_argument("-j", "--n_jobs", type=int, default=1,
+            help = "Worker processes. Default 1.")
+    parser.add_argument("-b", "--batch_size", type=int, default=100,
+            help = "Ships per batch. Default 100.")
+    parser.add_argument("--ships", metavar="FILE",
+            help = "Output CSV with the emissions of each ship.")
+    parser.add_argument("--series", metavar="FILE",
+            help = "Output CSV with the emissions per time bin.")
+    parser.add_argument("--bin", type=int, default=3600,
+            help = "Seconds per time bin of --series. Default 3600.")
+    parser.add_argument("--grid", metavar="FILE",
+            help = "Output CSV with the emissions per lon/lat cell (cell "
+                   "centres).")
+    parser.add_argument("--resolution", type=float, default=0.1,
+            help = "Cell size of --grid in degrees. Default 0.1.")
+    parser.add_argument("--sink", metavar="FILE",
+            help = "Also store the emissions, emission factors and errors of "
+                   "every sample: SQLite database, .parquet folder or .csv.")
+    args = parser.parse_args()
+
+    reducers = {'fleet': FleetTotals()}
+    if args.ships is not None:
+        reducers['ships'] = ShipTotals()
+    if args.series is not None:
+        reducers['series'] = TimeSeries(bin=args.bin)
+    if args.grid is not None:
+        reducers['grid'] = GridInventory(resolution=args.resolution)
+
+    sink = None
+    if args.sink is not None:
+        sink = QueueSink(args.sink, indexes={'emissions': ['shipIMO'],
+                                             'emissionFactors': ['shipIMO'],
+                                             'error': ['shipIMO']})
+    interpolation = args.interpolation if args.interpolation > 0 else None
+    reducers, errors = streamEmissions(readAIS(args.ais), readIHS(args.ihs),
+                                       reducers, n_jobs=args.n_jobs,
+                                       batch_size=args.batch_size,
+                                       interpolation=interpolation,
+                                       maxTimeGap=args.max_gap,
+                                       unit=args.unit, sink=sink)
+    if sink is not None:
+        print("Stored rows:", sink.close())
+    if len(errors):
+        print("Errors:")
+        print(errors.to_string(index=False))
+    # As CRBMEmissions.R: totals in tonnes when the unit is grams
+    print(reducers['fleet'].result()/10**6 if args.unit == 'g'
+          else reducers['fleet'].result())
+    if 'grid' in reducers and reducers['grid'].unlocated.samples:
+        print("Samples without coordinates (not in --grid):",
+              reducers['grid'].unlocated.samples)
+    for name in ['ships', 'series', 'grid']:
+        if name in reducers:
+            reducers[name].result().to_csv(getattr(args, name), index=False)
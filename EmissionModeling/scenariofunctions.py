@@ -0,0 +1,202 @@
+# # Scenario functions
+#
+# CRBMEmissions.R estimates the emissions of the same ships four times, with
+# the real installed main engine power, the average of the type and the two
+# predictions (activations and history), and each run splits, interpolates
+# and joins the AIS data again. Only installedPowerME changes between them.
+#
+# Here every batch of ships is prepared once (interpolation, IHS join, speed
+# and auxiliary engine terms) and the main engine equations are evaluated
+# for all the scenarios at once, as a (samples x scenarios) array. power is
+# a DataFrame indexed by IMO with one installedPowerME column per scenario:
+#
+#     power = powerScenarios(ihs, pd.read_csv('powerME-Predictions.csv'))
+#     results, totals, errors = estimateScenarios(ships, ihs, power,
+#                                                 interpolation=10)
+#
+# results has a row per scenario and a column per pollutant, as the results
+# table of CRBMEmissions.R (before /10^6 and rounding).
+
+import time
+
+from argparse import ArgumentParser
+
+import numpy as np
+import pandas as pd
+
+from emissionfunctions import (calcCO2EmissionFactor, calcNOxEmissionFactor,
+                               calcSOxEmissionFactor, mainEngine, readAIS,
+                               readIHS, shipParameters, transientPowerAE,
+                               units)
+from interpolationfunctions import interpolateFleet
+
+
+pollutants = ['SOxME', 'SOxAE', 'CO2ME', 'CO2AE', 'NOxME', 'NOxAE', 'PMME']
+
+# Scenarios of CRBMEmissions.R (row of results: column of the predictions)
+prediction_scenarios = {'act': 'predicted_act', 'his': 'predicted_hist',
+                        'avg': 'avgtype'}
+
+
+# installedPowerME of the ships of the predictions (imo column): the real
+# one of the IHS data (rea) and one per prediction column
+def powerScenarios(ihs, predictions, scenarios=prediction_scenarios,
+                   id_var='imo', ihs_id='LRIMOShipNO'):
+    real = ihs.drop_duplicates(ihs_id, keep='first') \
+              .set_index(ihs_id)['installedPowerME']
+    power = predictions.drop_duplicates(id_var).set_index(id_var)
+    res = pd.DataFrame({'rea': real.reindex(power.index)})
+    for name, col in scenarios.items():
+        res[name] = power[col]
+    res.index.name = ihs_id
+    return(res.astype(np.float64))
+
+
+# Samples of the ships of imos grouped by ship, in the order of imos, and
+# the position of the first sample of each ship
+def batchSamples(ships, imos, interpolation, maxTimeGap, id_var):
+    if interpolation is not None:
+        ships = interpolateFleet(ships, imos, id_var,
+                                 sampleTime=interpolation,
+                                 maxTimeGap=maxTimeGap)
+    elif hasattr(ships, 'ship'):
+        ships = ships.frame(ships=imos)
+    ships = ships[ships[id_var].isin(imos)]
+    position = pd.Index(imos).get_indexer(ships[id_var])
+    order = np.argsort(position, kind='stable')
+    ships = ships.iloc[order].reset_index(drop=True)
+    position = position[order]
+    starts = np.flatnonzero(np.r_[True, position[1:] != position[:-1]])
+    if not len(position):
+        starts = starts[:0]
+    return(ships, starts)
+
+
+# Per-ship emissions (ships x scenarios x pollutants) of one batch of
+# samples grouped by ship, NaN where a scenario cannot be computed
+def scenarioEmissions(sog, params, power, starts, sampleGranularity=1,
+                      unit='g'):
+    unit = units[unit]
+
+    def emission(factor, power):
+        return((factor*power/3600)/unit*sampleGranularity)
+
+    def shipSums(values):
+        values = np.broadcast_to(values, (len(sog), power.shape[1]))
+        return(np.add.reduceat(values, starts, axis=0))
+
+    column = {col: values[:, None] for col, values in params.items()}
+    transPME, PMFactME = mainEngine(sog[:, None], column, power)
+    transPAE = transientPowerAE(sog, params['passenger'],
+                                params['installedPowerAE'])[:, None]
+    SOxFact = calcSOxEmissionFactor(SC=0.001)
+    CO2Fact = calcCO2EmissionFactor()
+    NOxFactME = calcNOxEmissionFactor(params['MainEngineRPM'])[:, None]
+    NOxFactAE = calcNOxEmissionFactor(params['AuxiliaryEngineRPM'])[:, None]
+
+    res = np.stack([shipSums(emission(SOxFact, transPME)),
+                    shipSums(emission(SOxFact, transPAE)),
+                    shipSums(emission(CO2Fact, transPME)),
+                    shipSums(emission(CO2Fact, transPAE)),
+                    shipSums(emission(NOxFactME, transPME)),
+                    shipSums(emission(NOxFactAE, transPAE)),
+                    shipSums(emission(PMFactME, transPME))], axis=2)
+
+    # Ships whose emissions cannot be computed (dropped in R)
+    valid = np.ones(len(sog), dtype=bool)
+    for col in ['designSpeed', 'n_installed_me', 'MainEngineRPM',
+                'AuxiliaryEngineRPM']:
+        valid &= np.isfinite(params[col])
+    valid = valid[:, None] & np.isfinite(power)
+    valid = np.logical_and.reduceat(valid, starts, axis=0)
+    res[~valid] = np.nan
+    return(res)
+
+
+def estimateScenarios(ships, ihs, power, shipIMOList=None, interpolation=None,
+                      maxTimeGap=24*60*60, sampleGranularity=1, unit='g',
+                      id_var='imo', ihs_id='LRIMOShipNO', batch_size=100,
+                      verbose=True):
+    start_time = time.time()
+    if shipIMOList is None:
+        imos = ships.ships if hasattr(ships, 'ship') else \
+               ships[id_var].unique()
+        shipIMOList = np.intersect1d(np.intersect1d(imos, ihs[ihs_id]),
+                                     power.index)
+    if interpolation is not None:
+        sampleGranularity = interpolation
+    scenarios = list(power.columns)
+
+    totals = []
+    shipIMOs = []
+    for b in range(0, len(shipIMOList), batch_size):
+        imos = shipIMOList[b:b + batch_size]
+        samples, starts = batchSamples(ships, imos, interpolation,
+                                       maxTimeGap, id_var)
+        if not len(samples):
+            continue
+        imo = samples[id_var].values
+        params, _ = shipParameters(ihs, imo, ihs_id)
+        totals.append(scenarioEmissions(
+            samples['sog'].values.astype(np.float64), params,
+            power.reindex(imo).values, starts, sampleGranularity, unit))
+        shipIMOs.append(imo[starts])
+
+    totals = np.concatenate(totals) if totals else \
+             np.zeros((0, len(scenarios), len(pollutants)))
+    shipIMOs = np.concatenate(shipIMOs) if shipIMOs else np.array([])
+    # Per ship and scenario totals (long format)
+    ship_totals = pd.DataFrame(totals.reshape(-1, len(pollutants)),
+                               columns=pollutants)
+    ship_totals.insert(0, 'scenario', np.tile(scenarios, len(shipIMOs)))
+    ship_totals.insert(0, 'shipIMO', np.repeat(shipIMOs, len(scenarios)))
+    invalid = ship_totals[pollutants].isna().any(axis=1)
+    errors = ship_totals.loc[invalid, ['shipIMO', 'scenario']] \
+                        .assign(type='error',
+                                message='missing or invalid IHS parameters') \
+                        .reset_index(drop=True)
+    ship_totals = ship_totals[~invalid].reset_index(drop=True)
+    results = ship_totals.groupby('scenario', sort=False)[pollutants].sum() \
+                         .reindex(scenarios).fillna(0)
+    if verbose:
+        print("Emissions of {} ships in {} scenarios in {:.2f}s ({} ship "
+              "scenarios with errors)".format(len(shipIMOs), len(scenarios),
+                                             time.time() - start_time,
+                                             len(errors)))
+    return(results, ship_totals, errors)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-a", "--ais", metavar="FILE", required=True,
+            help = "AIS samples CSV or trace store folder.")
+    parser.add_argument("-s", "--ihs", metavar="FILE", required=True,
+            help = "IHS data (tab separated, as IHSTestData.csv).")
+    parser.add_argument("-p", "--predictions", metavar="FILE",
+            default="powerME-Predictions.csv",
+            help = "Power predictions per IMO (MainEngine_batch_scoring.py). "
+                   "Default: powerME-Predictions.csv.")
+    parser.add_argument("-g", "--interpolation", type=int, default=10,
+            help = "Interpolation step in seconds. 0 to use the samples as "
+                   "they are. Default 10.")
+    parser.add_argument("--max_gap", type=int, default=24*60*60,
+            help = "Longest gap to interpolate, in seconds. Default 1 day.")
+    parser.add_argument("-b", "--batch_size", type=int, default=100,
+            help = "Ships per batch. Default 100.")
+    parser.add_argument("-o", "--output", metavar="FILE",
+            help = "Output CSV with the totals of each ship and scenario.")
+    args = parser.parse_args()
+
+    ihs = readIHS(args.ihs)
+    power = powerScenarios(ihs, pd.read_csv(args.predictions))
+    interpolation = args.interpolation if args.interpolation > 0 else None
+    results, ship_totals, errors = estimateScenarios(
+        readAIS(args.ais), ihs, power, interpolation=interpolation,
+        maxTimeGap=args.max_gap, batch_size=args.batch_size)
+    if len(errors):
+        print("Errors:")
+        print(errors.to_string(index=False))
+    if args.output is not None:
+        ship_totals.to_csv(args.output, index=False)
+    # As CRBMEmissions.R: tonnes, rounded
+    print((results[["SOxME", "NOxME", "CO2ME", "PMME"]]/10**6).round(2))
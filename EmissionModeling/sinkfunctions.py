@@ -0,0 +1,358 @@
+# # Sink functions
+#
+# Python version of the storage of tools/db.R. writeDFToSQLite opens a
+# connection per ship result and retries with random sleeps while other
+# workers hold the lock. Here a single writer owns the output: tables are
+# buffered per name and written in one transaction every batch_rows rows,
+# with WAL journaling and prepared (executemany) inserts, and the indexes
+# are built once, after the bulk load.
+#
+#     with ResultSink('emissions.sqlite', indexes={'emissions': ['shipIMO']}) as sink:
+#         sink.put('emissions', df)
+#
+# The backend follows the path: a .csv file (appended, as result.csv), a
+# .parquet folder (one part file per table and sink, one row group per batch;
+# needs pyarrow) or anything else as a SQLite database. Every backend appends
+# to the tables of earlier sinks.
+#
+# Parallel workers do not write: QueueSink runs the writer in a thread of the
+# parent, fed by a queue that workers receive as an argument
+# (queue.put((table, df))).
+
+import multiprocessing
+import glob
+import os
+import shutil
+import sqlite3
+import threading
+
+import pandas as pd
+
+
+# SQLite type of a column
+def sqliteType(dtype):
+    if pd.api.types.is_bool_dtype(dtype) or \
+       pd.api.types.is_integer_dtype(dtype):
+        return('INTEGER')
+    if pd.api.types.is_float_dtype(dtype):
+        return('REAL')
+    return('TEXT')
+
+
+# ## Backends
+#
+# begin(), write(table, df), commit(), index(table, column) and close().
+
+class SQLiteBackend:
+    def __init__(self, path, timeout=600):
+        self.con = sqlite3.connect(path, timeout=timeout,
+                                   isolation_level=None)
+        self.con.execute('PRAGMA journal_mode=WAL')
+        self.con.execute('PRAGMA synchronous=NORMAL')
+        self.columns = {}
+
+    def begin(self):
+        self.con.execute('BEGIN IMMEDIATE')
+
+    def create(self, table, df):
+        existing = [row[1] for row in self.con.execute(
+                    'PRAGMA table_info("{}")'.format(table))]
+        if not existing:
+            self.con.execute('CREATE TABLE "{}" ({})'.format(table, ', '.join(
+                '"{}" {}'.format(col, sqliteType(dtype))
+                for col, dtype in df.dtypes.items())))
+            existing = list(df.columns)
+        # Columns missing in the table are added (NULL in the old rows)
+        for col in df.columns:
+            if col not in existing:
+                self.con.execute('ALTER TABLE "{}" ADD COLUMN "{}" {}'.format(
+                                 table, col, sqliteType(df[col].dtype)))
+                existing.append(col)
+        self.columns[table] = existing
+
+    def write(self, table, df):
+        if table not in self.columns or \
+           not set(df.columns) <= set(self.columns[table]):
+            self.create(table, df)
+        query = 'INSERT INTO "{}" ({}) VALUES ({})'.format(
+                table, ', '.join('"{}"'.format(col) for col in df.columns),
+                ', '.join('?'*len(df.columns)))
+        # Python values per column (NaN and NA as NULL)
+        columns = []
+        for col in df.columns:
+            values = df[col]
+            if values.isna().any():
+                values = values.astype(object).where(values.notna(), None)
+            columns.append(values.tolist())
+        self.con.executemany(query, zip(*columns))
+
+    def commit(self):
+        self.con.execute('COMMIT')
+
+    def index(self, table, column):
+        self.con.execute('CREATE INDEX IF NOT EXISTS "idx_{0}_{1}" ON "{0}" '
+                         '("{1}")'.format(table, column))
+
+    def close(self):
+        self.con.close()
+
+
+# Each sink writes one part file per table, <folder>/<table>/part-<n>.parquet,
+# after the parts of earlier sinks. The part is written under a hidden
+# temporary name and renamed at close, so readers only see complete parts
+# (the rows of a sink that did not close are lost).
+def parquetParts(folder, table):
+    return(sorted(glob.glob(os.path.join(folder, table, 'part-*.parquet'))))
+
+
+class ParquetBackend:
+    def __init__(self, folder):
+        import pyarrow
+        import pyarrow.parquet
+        self.pa = pyarrow
+        self.folder = folder
+        self.writers = {}
+        self.parts = {}
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+    def begin(self):
+        pass
+
+    def write(self, table, df):
+        if table not in self.writers:
+            folder = os.path.join(self.folder, table)
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+            parts = parquetParts(self.folder, table)
+            n = int(os.path.basename(parts[-1])[5:-8]) + 1 if parts else 0
+            name = 'part-{:05d}.parquet'.format(n)
+            self.parts[table] = (os.path.join(folder, '.' + name + '.tmp'),
+                                 os.path.join(folder, name))
+            schema = self.pa.Schema.from_pandas(df, preserve_index=False)
+            self.writers[table] = self.pa.parquet.ParquetWriter(
+                self.parts[table][0], schema)
+        writer = self.writers[table]
+        self.writers[table].write_table(self.pa.Table.from_pandas(
+            df[writer.schema.names], schema=writer.schema,
+            preserve_index=False))
+
+    def commit(self):
+        pass
+
+    def index(self, table, column):
+        pass
+
+    def close(self):
+        for table, writer in self.writers.items():
+            writer.close()
+            os.replace(*self.parts[table])
+
+
+# Appends df to the CSV at path (header only if it is new). The old rows and
+# the new ones are written to a temporary file that replaces path in one
+# rename, so a crash leaves the old file or the new one, never a half
+# written row. Every append copies the file: meant for small tables such as
+# result.csv.
+def appendCsv(df, path):
+    tmp = '{}.tmp{}'.format(path, os.getpid())
+    try:
+        with open(tmp, 'w') as f:
+            if os.path.isfile(path):
+                with open(path) as old:
+                    shutil.copyfileobj(old, f)
+                df.to_csv(f, index=False, header=False)
+            else:
+                df.to_csv(f, index=False)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+# One CSV per table: path itself for a single table named as the file (the
+# result.csv of the experiments), <path without .csv>-<table>.csv otherwise.
+# The rows of a transaction are appended at commit (appendCsv).
+class CsvBackend:
+    def __init__(self, path):
+        self.path = path
+        self.pending = {}
+
+    def tablePath(self, table):
+        base, _ = os.path.splitext(self.path)
+        if table == os.path.basename(base):
+            return(self.path)
+        return('{}-{}.csv'.format(base, table))
+
+    def begin(self):
+        self.pending = {}
+
+    def write(self, table, df):
+        self.pending.setdefault(table, []).append(df)
+
+    def commit(self):
+        for table, dfs in self.pending.items():
+            appendCsv(pd.concat(dfs, ignore_index=True),
+                      self.tablePath(table))
+        self.pending = {}
+
+    def index(self, table, column):
+        pass
+
+    def close(self):
+        pass
+
+
+def backendName(path, backend=None):
+    if backend is not None:
+        return(backend)
+    if path.endswith('.csv'):
+        return('csv')
+    if path.endswith('.parquet'):
+        return('parquet')
+    return('sqlite')
+
+
+def openBackend(path, backend=None):
+    return({'sqlite': SQLiteBackend, 'parquet': ParquetBackend,
+            'csv': CsvBackend}[backendName(path, backend)](path))
+
+
+# ## Sink
+
+class ResultSink:
+    def __init__(self, path, backend=None, batch_rows=100000, indexes=None):
+        self.backend = openBackend(path, backend)
+        self.batch_rows = batch_rows
+        self.indexes = indexes or {}
+        self.buffer = {}
+        self.buffered = 0
+        self.rows = {}
+
+    # Tables can also be lists of DataFrames or dicts of them (the lists of
+    # singleShipEstimation), as writeToSQLite
+    def put(self, table, df=None):
+        if df is None:
+            for name, value in table.items():
+                if isinstance(value, pd.DataFrame):
+                    self.put(name, value)
+            return
+        if not len(df):
+            return
+        self.buffer.setdefault(table, []).append(df)
+        self.buffered += len(df)
+        if self.buffered >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        self.backend.begin()
+        for table, dfs in self.buffer.items():
+            df = pd.concat(dfs, ignore_index=True)
+            self.backend.write(table, df)
+            self.rows[table] = self.rows.get(table, 0) + len(df)
+        self.backend.commit()
+        self.buffer = {}
+        self.buffered = 0
+
+    def close(self):
+        self.flush()
+        for table, columns in self.indexes.items():
+            if table in self.rows:
+                for column in columns:
+                    self.backend.index(table, column)
+        self.backend.close()
+        return(self.rows)
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Writer thread of a ResultSink fed by a queue that can be handed to pool
+# workers. The sink is opened, filled and closed by the thread (SQLite
+# connections belong to their thread). Errors of the writer are raised by
+# close().
+class QueueSink:
+    def __init__(self, path, backend=None, batch_rows=100000, indexes=None,
+                 maxsize=64):
+        self.manager = multiprocessing.Manager()
+        self.queue = self.manager.Queue(maxsize)
+        self.error = None
+        self.rows = None
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       args=(path, backend, batch_rows,
+                                             indexes))
+        self.thread.start()
+
+    def run(self, path, backend, batch_rows, indexes):
+        sink = None
+        try:
+            sink = ResultSink(path, backend, batch_rows, indexes)
+        except Exception as e:
+            self.error = e
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is None:
+                try:
+                    sink.put(*item)
+                except Exception as e:
+                    self.error = e
+        if sink is not None:
+            try:
+                self.rows = sink.close()
+            except Exception as e:
+                self.error = self.error or e
+
+    def put(self, table, df=None):
+        self.queue.put((table, df))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.manager.shutdown()
+        if self.error is not None:
+            raise self.error
+        return(self.rows)
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Whether a sink (SQLite database, parquet folder or CSV) has the table
+def hasTable(path, table, backend=None):
+    backend = backendName(path, backend)
+    if backend == 'sqlite':
+        if not os.path.isfile(path):
+            return(False)
+        with sqlite3.connect(path) as con:
+            return(con.execute('SELECT 1 FROM sqlite_master WHERE '
+                               'type = "table" AND name = ?',
+                               (table,)).fetchone() is not None)
+    if backend == 'parquet':
+        return(len(parquetParts(path, table)) > 0)
+    return(os.path.isfile(CsvBackend(path).tablePath(table)))
+
+
+# Table of a sink (SQLite database, parquet folder or CSV)
+def readSink(path, table, backend=None):
+    backend = backendName(path, backend)
+    if backend == 'sqlite':
+        with sqlite3.connect(path) as con:
+            return(pd.read_sql_query('SELECT * FROM "{}"'.format(table), con))
+    if backend == 'parquet':
+        parts = parquetParts(path, table)
+        if not parts:
+            raise FileNotFoundError("No parts of table {} in {}".format(
+                                    table, path))
+        return(pd.concat([pd.read_parquet(part) for part in parts],
+                         ignore_index=True))
+    return(pd.read_csv(CsvBackend(path).tablePath(table)))
@@ -0,0 +1,228 @@
+# # AR functions
+#
+# Multivariate autoregressive baseline for the CRBM, in place of the
+# per-ship gridMARIMA of marima-tools.R. MARIMAExperiments.r refits marima
+# for every point of an AR x MA x penalty x meansAdjusted grid, one ship at
+# a time. Here the models are vector autoregressions (VAR, no MA terms)
+# fitted by least squares for many ships at once:
+#
+# - The lagged design matrix of a shard of ships is built once, for the
+#   largest order. The columns of order p are its first p lags, so every
+#   order is solved from blocks of the same per-ship Gram matrix of [Z Y],
+#   and all the ships of the shard are solved in one batched call. The
+#   residual sums of squares also come from the Gram blocks.
+# - meansAdjusted = 1 fits the series minus their means (means=1 in
+#   marima), 0 the raw series. Neither has an intercept.
+# - As stepwiseForecast, the errors are those of the one-step forecasts of
+#   the ship's own trace: mse = sum of squared residuals/(n - 1), rmse and
+#   nrmse = rmse/sd. The best point of each ship is the one with the lowest
+#   sum of nrmse (as rmseMARIMA).
+#
+# All orders of a ship use the rows from the largest order on, so they are
+# compared on the same residuals. An order with no more rows than
+# parameters (order*variables) fits them exactly, with zero residuals, so
+# it has no model (NaN errors) instead of being the best one of the ship.
+# Ships are split in shards solved by a process pool.
+#
+#     python arfunctions.py -i ships.csv -p 3 -j 4 -o AR1StepFore.csv
+#
+# writes the best model of each ship. readARResults in marima-tools.R reads
+# it as the `fore` list of ARIMAvsCRBM.
+
+import concurrent.futures
+import itertools
+import os
+import time
+
+from argparse import ArgumentParser
+
+import numpy as np
+import pandas as pd
+
+
+variables = ['rotationGPS', 'sog', 'bathymetry3']
+
+
+# Series of every ship as one (samples x variables) array grouped by ship,
+# in order of first appearance, and the offsets of each ship
+def shipSeries(data, variables=variables, id_var='imo'):
+    codes, ids = pd.factorize(data[id_var])
+    order = np.argsort(codes, kind='stable')
+    X = data[variables].values[order].astype(np.float64)
+    offsets = np.r_[0, np.cumsum(np.bincount(codes, minlength=len(ids)))]
+    return(ids, X, offsets)
+
+
+# Lagged design (lags 1..order, lag 1 first) and targets of every row that
+# has order previous samples of its ship, and the ship of each row
+def lagDesign(X, offsets, order):
+    lengths = np.diff(offsets)
+    ship = np.repeat(np.arange(len(lengths)), lengths)
+    rows = np.flatnonzero(np.arange(len(X)) - offsets[ship] >= order)
+    Z = np.hstack([X[rows - lag] for lag in range(1, order + 1)])
+    return(Z, X[rows], ship[rows])
+
+
+# Pseudoinverses of a stack of matrices. If the batched SVD does not
+# converge, they are computed one by one and the ones that fail are NaN.
+def batchPinv(A):
+    try:
+        return(np.linalg.pinv(A))
+    except np.linalg.LinAlgError:
+        res = np.full(A.shape, np.nan)
+        for i, a in enumerate(A):
+            try:
+                res[i] = np.linalg.pinv(a)
+            except np.linalg.LinAlgError:
+                pass
+        return(res)
+
+
+# One-step errors of the VAR of every order in orders for the ships of X
+# (a shard). Returns an (ships x orders x 3 x variables) array with mse,
+# rmse and nrmse.
+def fitShard(X, offsets, orders, meansAdjusted=1):
+    nships, k = len(offsets) - 1, X.shape[1]
+    lengths = np.diff(offsets)
+    ship = np.repeat(np.arange(nships), lengths)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.add.reduceat(X, offsets[:-1], axis=0) / lengths[:, None] \
+                if nships else np.zeros((0, k))
+        sd = np.sqrt(np.add.reduceat((X - means[ship])**2, offsets[:-1],
+                                     axis=0)/(lengths - 1)[:, None]) \
+             if nships else np.zeros((0, k))
+    if meansAdjusted:
+        X = X - means[ship]
+
+    res = np.full((nships, len(orders), 3, k), np.nan)
+    Z, Y, rowship = lagDesign(X, offsets, max(orders))
+    fitted = np.flatnonzero(np.bincount(rowship, minlength=nships) > 0)
+    if not len(fitted):
+        return(res)
+    # Per-ship Gram matrix of [Z Y] for the largest order: Z'Z, Z'Y and the
+    # diagonal of Y'Y of every order are blocks of it
+    starts = np.searchsorted(rowship, fitted)
+    ends = np.r_[starts[1:], len(rowship)]
+    ZY = np.hstack([Z, Y])
+    G = np.stack([ZY[a:b].T @ ZY[a:b] for a, b in zip(starts, ends)])
+    # Ships with missing or infinite samples get no model (NaN errors), as
+    # the models that fail in rmseMARIMA, instead of failing the shard
+    finite = np.isfinite(G).all(axis=(1, 2))
+    fitted, G = fitted[finite], G[finite]
+    if not len(fitted):
+        return(res)
+    D = Z.shape[1]
+    yy = np.diagonal(G[:, D:, D:], axis1=1, axis2=2)
+    nrows = ends[finite] - starts[finite]
+
+    for o, order in enumerate(orders):
+        d = order*k
+        # Ships with more rows than parameters (degrees of freedom left)
+        free = nrows > d
+        if not free.any():
+            continue
+        ships, Go = fitted[free], G[free]
+        # Minimum norm solutions (constant series give singular matrices)
+        coef = batchPinv(Go[:, :d, :d]) @ Go[:, :d, D:]
+        # Residual sum of squares of the normal equations: Y'Y - coef'Z'Y
+        sse = np.maximum(yy[free] - (coef*Go[:, :d, D:]).sum(axis=1), 0)
+        mse = sse/(lengths[ships] - 1)[:, None]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            res[ships, o] = np.stack([mse, np.sqrt(mse),
+                                      np.sqrt(mse)/sd[ships]], axis=1)
+    return(res)
+
+
+# Errors of every grid point (order, meansAdjusted) of every ship (long
+# format), with n_jobs processes over shards of shard_size ships
+def fitShips(data, variables=variables, orders=(1, 2), means=(0, 1),
+             id_var='imo', n_jobs=1, shard_size=500, verbose=True):
+    start_time = time.time()
+    ids, X, offsets = shipSeries(data, variables, id_var)
+    shards = [(X[offsets[b]:offsets[min(b + shard_size, len(ids))]],
+               offsets[b:min(b + shard_size, len(ids)) + 1] - offsets[b])
+              for b in range(0, len(ids), shard_size)]
+    tasks = [(x, o, list(orders), m) for (x, o), m in
+             itertools.product(shards, means)]
+    if n_jobs == 1:
+        results = [fitShard(*task) for task in tasks]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(n_jobs) as pool:
+            results = list(pool.map(fitShard, *zip(*tasks)))
+
+    # (ships x means x orders x 3 x variables)
+    res = np.concatenate([np.stack(results[s*len(means):(s + 1)*len(means)],
+                                   axis=1)
+                          for s in range(len(shards))]) \
+          if shards else np.zeros((0, len(means), len(orders), 3,
+                                   len(variables)))
+    grid = pd.DataFrame(res.reshape(-1, 3*len(variables)),
+                        columns=['{}.{}'.format(metric, v)
+                                 for metric in ['mse', 'rmse', 'nrmse']
+                                 for v in variables])
+    grid.insert(0, 'meansAdjusted', np.tile(np.repeat(means, len(orders)),
+                                            len(ids)))
+    grid.insert(0, 'ar', np.tile(orders, len(ids)*len(means)))
+    grid.insert(0, 'id', np.repeat(ids, len(means)*len(orders)))
+    grid['score'] = grid[['nrmse.' + v for v in variables]].sum(axis=1,
+                                                               skipna=False)
+    if verbose:
+        print("{} models of {} ships in {:.2f}s".format(len(grid), len(ids),
+                                                        time.time() -
+                                                        start_time))
+    return(grid)
+
+
+# Best grid point of each ship (lowest sum of nrmse, as gridMARIMA). Ships
+# whose every point failed keep their first point, with NaN errors.
+def bestModels(grid):
+    score = grid['score'].fillna(np.inf)
+    best = score.groupby(grid['id'], sort=False).idxmin()
+    return(grid.loc[best.values].reset_index(drop=True))
+
+
+# Ship samples of a CSV, or of a trace store folder
+# (DatasetGeneration/tracefunctions.py)
+def readShips(path, columns=None):
+    if os.path.isdir(path):
+        import sys
+        sys.path.append(os.path.join(os.path.dirname(
+            os.path.abspath(__file__)), '..', '..', 'DatasetGeneration'))
+        from tracefunctions import TraceStore
+        return(TraceStore(path).frame(columns))
+    return(pd.read_csv(path, usecols=columns))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-i", "--input", metavar="FILE", required=True,
+            help = "Ship samples CSV or trace store folder.")
+    parser.add_argument("-v", "--variables", default=",".join(variables),
+            help = "Comma separated variables. Default: "
+                   "rotationGPS,sog,bathymetry3.")
+    parser.add_argument("--id_var", default="imo",
+            help = "Ship column. Default imo.")
+    parser.add_argument("-p", "--max_order", type=int, default=2,
+            help = "Orders 1 to max_order are fitted. Default 2 (AR levels "
+                   "of MARIMAExperiments.r).")
+    parser.add_argument("-j", "--n_jobs", type=int, default=1,
+            help = "Processes. Default 1.")
+    parser.add_argument("--shard_size", type=int, default=500,
+            help = "Ships per shard. Default 500.")
+    parser.add_argument("-o", "--output", metavar="FILE",
+            default="AR1StepFore.csv",
+            help = "Best model of each ship. Default: AR1StepFore.csv.")
+    parser.add_argument("-g", "--grid_output", metavar="FILE",
+            help = "Errors of every grid point of every ship.")
+    args = parser.parse_args()
+
+    v = args.variables.split(",")
+    grid = fitShips(readShips(args.input, [args.id_var] + v), v,
+                    orders=range(1, args.max_order + 1), id_var=args.id_var,
+                    n_jobs=args.n_jobs, shard_size=args.shard_size)
+    best = bestModels(grid)
+    best.to_csv(args.output, index=False)
+    if args.grid_output is not None:
+        grid.to_csv(args.grid_output, index=False)
+    print(best.groupby('ar').size())
+    print(best[['nrmse.' + col for col in v]].median())
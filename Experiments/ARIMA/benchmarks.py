@@ -0,0 +1,45 @@
+# # Benchmarks
+#
+# Throughput of the batched AR baseline (arfunctions.py) against one least
+# squares fit per ship and grid point, as the per-ship grid search of
+# MARIMAExperiments.r. Run it from this folder with `python benchmarks.py`.
+# The values are checked against those fits by the tests (python -m pytest
+# tests, from the root).
+
+import os
+import sys
+import time
+
+import pandas as pd
+
+from arfunctions import fitShips, shipSeries
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                             '..', 'tests'))
+from testtools import referenceShip, shipTraces, timeit
+
+
+def benchAR(sizes=(100, 1000), orders=(1, 2), means=(0, 1), nref=100):
+    rows = []
+    for nships in sizes:
+        data = shipTraces(nships)
+        grid, batch_time = timeit(lambda: fitShips(data, orders=orders,
+                                                   means=means,
+                                                   verbose=False))
+        ids, X, offsets = shipSeries(data)
+        start_time = time.time()
+        for i in range(min(nref, nships)):
+            x = X[offsets[i]:offsets[i + 1]]
+            for m in means:
+                for order in orders:
+                    referenceShip(x, order, max(orders), m)
+        ref_time = (time.time() - start_time)*nships/min(nref, nships)
+        rows.append({'ships': nships, 'samples': len(data),
+                     'models': len(grid), 'time': batch_time,
+                     'per_ship_time': ref_time,
+                     'speedup': ref_time/batch_time})
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    print(benchAR())
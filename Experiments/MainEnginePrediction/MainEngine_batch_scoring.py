@@ -0,0 +1,54 @@
+# # Main engine power batch scoring
+#
+# Predicts the installed main engine power of every ship in a feature CSV with
+# the models saved by MainEngine_regression_loop.py and writes the per-IMO
+# predictions used by EmissionModeling/CRBMEmissions.R:
+#
+#     python MainEngine_batch_scoring.py -d features.csv -m models \
+#         -o powerME-Predictions.csv -j 8
+#
+# The per-IMO prediction is the median of the row predictions in log space,
+# converted back to kW.
+
+from argparse import ArgumentParser
+
+try:
+    from sklearn.externals import joblib
+except ImportError:
+    import joblib
+
+from scorefunctions import scoreFile
+
+# Output column: model artifact (folder name in the models folder)
+models = {'avgtype': 'Type_average',
+          'predicted_act': 'RF_Activations',
+          'predicted_hist': 'RF_History'}
+
+# # Parse parameters
+
+parser = ArgumentParser()
+parser.add_argument("-d", "--input_data", metavar="FILE", required=True,
+        help = "Feature CSV to score (same columns as the training data).")
+parser.add_argument("-m", "--models_folder", metavar="FOLDER",
+        default="models",
+        help = "Output folder of the regression loop. Default: models.")
+parser.add_argument("-o", "--output", metavar="FILE",
+        default="powerME-Predictions.csv",
+        help = "Output CSV. Default: powerME-Predictions.csv.")
+parser.add_argument("-j", "--n_jobs", type=int, default=1,
+        help = "Scoring processes. Default: 1.")
+parser.add_argument("-c", "--chunksize", type=int, default=100000,
+        help = "Rows read per chunk. Default: 100000.")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    spec = joblib.load(args.models_folder + "/preprocess.joblib")
+    artifacts = {col: args.models_folder + "/" + folder
+                 for col, folder in models.items()}
+    res = scoreFile(args.input_data, spec['pipeline'], artifacts,
+                    usecols=spec['usecols'], output=args.output,
+                    group=spec['group'], chunksize=args.chunksize,
+                    n_jobs=args.n_jobs)
+    print("Predictions of {} ships written to {}".format(len(res),
+                                                         args.output))
@@ -23,6 +23,7 @@ import numpy as np
 import pandas as pd
 import datetime
 import os
+import sys
 import time
 
 from math import sqrt
@@ -41,6 +42,17 @@ from argparse import ArgumentParser
 
 from pipefunctions import *
 from auxiliar_functions import *
+from datafunctions import *
+from searchfunctions import *
+from runfunctions import *
+from storefunctions import *
+
+# Result sink shared with the emission estimation (Jupyter runs the notebook
+# from this folder, without __file__)
+here = os.path.dirname(os.path.abspath(__file__)) \
+       if '__file__' in globals() else os.getcwd()
+sys.path.append(os.path.join(here, '..', '..', 'EmissionModeling'))
+from sinkfunctions import ResultSink, hasTable, readSink
 
 # # Parse parameters
 
@@ -51,6 +63,23 @@ parser.add_argument("-o", "--output_folder", metavar="FILE",
         help = "Output folder path for experiment results.")
 parser.add_argument("-f", "--jupyter_config", metavar="FILE",
         help = "STUB. This is here to ignore jupyter's config.")
+parser.add_argument("-p", "--profile", action="store_true",
+        help = "Print the time and memory used by each preprocess step "
+               "(reads the CSV, the cache is not used).")
+parser.add_argument("-j", "--n_jobs", type=int, default=-1,
+        help = "Number of cores shared by all the fits. Default: all (-1).")
+parser.add_argument("-s", "--search", choices=["grid", "halving"],
+        default="grid",
+        help = "Hyperparameter search: exhaustive grid or successive halving.")
+parser.add_argument("--resource", choices=["n_samples", "n_estimators"],
+        default="n_samples",
+        help = "Resource increased by successive halving. Default n_samples.")
+parser.add_argument("--budget", type=float, default=None,
+        help = "Successive halving budget per model, in full fits.")
+parser.add_argument("-r", "--results", metavar="FILE", default=None,
+        help = "Metrics output (table result): a .csv file (<name>-result.csv "
+               "unless it is result.csv), a .parquet folder or a SQLite "
+               "database. Default: result.csv in the output folder.")
 
 args = parser.parse_args()
 
@@ -58,22 +87,29 @@ if args.jupyter_config is not None:
     print("Executing on Jupyter. Setting default params...")
     input_data="crbmdata.csv"
     output_folder="/tmp/MainEngine_regression_loop-Jupyter"
+    profile=False
+    n_jobs=-1
+    search="grid"
+    resource="n_samples"
+    budget=None
+    results=None
 else: 
     input_data = args.input_data
     output_folder = args.output_folder
+    profile = args.profile
+    n_jobs = args.n_jobs
+    search = args.search
+    resource = args.resource
+    budget = args.budget
+    results = args.results
 
 # Create output folder
 
 if not os.path.exists(output_folder):
     os.makedirs(output_folder)
 
-results_file=output_folder+"/result.csv"
-
-# # Read data
-
-# Read dataset
-df = pd.read_csv(input_data)
-# -
+results_file=results if results is not None else output_folder+"/result.csv"
+memmap_folder=output_folder+"/memmap"
 
 # # Preprocess
 
@@ -81,18 +117,42 @@ df = pd.read_csv(input_data)
 
 preprocess = Pipeline([
         ("dropNA", Droper()), 
-        ('logaritmizer', Logaritmizer(inputColumn='installedPowerME', outputColumn='logInstalledPowerME')),
+        ('logaritmizer', Logaritmizer(inputColumn='installedPowerME', outputColumn='logInstalledPowerME', copy=False)),
         ('stringCast', StringCaster(column='type')),
         ('dummizer', Dummizer(inputColumns=['type'], outputPrefix='binType'))
-        # ('binner', Binner(inputColumn='logInstalledPowerME', outputColumn='binLogInstalledPowerME', bins=10)),
-        # ('binnerMid', BinnerMid(inputColumn='binLogInstalledPowerME', outputColumn='binmidLogInstalledPowerME')),
+        # ('binner', Binner(inputColumn='logInstalledPowerME', outputColumn='binLogInstalledPowerME', bins=10, copy=False)),
+        # ('binnerMid', BinnerMid(inputColumn='binLogInstalledPowerME', outputColumn='binmidLogInstalledPowerME', copy=False)),
         # ('stringCastBin', StringCaster(column='binmidLogInstalledPowerME'))
         ])
 
+# # Read data
 
-# And then we execute it with transform
-
-df = preprocess.transform(df)
+# Only the columns used by the feature sets below are read. The file is parsed
+# in chunks, downcasted to float32 and preprocessed chunk by chunk. The result
+# is cached next to the input file, keyed by its content and the pipeline, so
+# later runs skip parsing and preprocessing.
+
+def requiredColumn(col):
+    return (col in ['imo', 'type', 'installedPowerME'] or
+            'activations' in col or
+            ('rotationGPS' in col and 'rotationGPSA' not in col and
+             'rotationGPSW' not in col) or
+            'sog' in col or
+            'bathymetry' in col)
+
+# Read dataset. With profile the cache is bypassed: a cached frame would
+# skip the preprocess steps to profile.
+usecols = [col for col in pd.read_csv(input_data, nrows=0).columns
+           if requiredColumn(col)]
+data_params = {'usecols': usecols, 'pipeline': pipelineKey(preprocess)}
+if profile:
+    print("Profiling the preprocess: the cache is not used")
+    df = readDataset(input_data, usecols, preprocess, profile=True)
+else:
+    df = cachedDataset(input_data,
+            loader=lambda path: readDataset(path, usecols, preprocess),
+            params=data_params)
+# -
 
 
 # ## Split train/test
@@ -105,20 +165,21 @@ print(nships)
 np.random.seed(2)
 trainimo = np.random.choice(imolist, int(nships*0.8), replace=False)
 
-# Get data by IMO
-df_train =  df.loc[df['imo'].isin(trainimo)]
-df_test =  df.loc[~df['imo'].isin(trainimo)]
+# Rows by IMO. The frame is not split: ptn.extract selects the rows of each
+# column, so a cached (memory mapped) frame is never copied as a whole.
+train_rows = np.asarray(df['imo'].isin(trainimo))
+test_rows = ~train_rows
 
 # Train/Test groups
-group_train = df_train['imo']
-group_test = df_test['imo']
+group_train = np.asarray(df['imo'], dtype=np.int64)[train_rows]
+group_test = np.asarray(df['imo'], dtype=np.int64)[test_rows]
 # -
 
-df_train.shape
+train_rows.sum()
 
-df_test.shape
+test_rows.sum()
 
-list(df_train.columns)
+list(df.columns)
 
 # # Training
 
@@ -127,7 +188,9 @@ list(df_train.columns)
 
 # +
 target = 'logInstalledPowerME'
-ptn = PandasToNumpyXY(response=target)
+# float32 Fortran-ordered matrices, shared by all the models of a feature set
+ptn = PandasToNumpyXY(response=target, dtype=np.float32, order='F',
+                      memmap_folder=memmap_folder)
 
 k = 3
 cv = GroupKFold(k)
@@ -146,7 +209,7 @@ f_sog = [col for col in df.columns if 'sog' in col]
 f_bat = [col for col in df.columns if 'bathymetry' in col]
 
 # Datasets
-# feat_type = binType 
+feat_type = binType
 # feat_all =  f_act + f_rot + f_sog + f_bat + binType
 feat_activation =  f_act + binType
 feat_history = f_rot + f_sog + f_bat + binType
@@ -275,42 +338,107 @@ params['RF History'] = dict({
 #
 # # Model fitting loop
 
-res = pd.DataFrame()
+# All the (model, grid point, fold) fits of every entry are scheduled together
+# on a single budget of n_jobs cores, most expensive first (searchfunctions.py).
+# Models are fitted single-threaded inside each task. GB and RF grid points
+# that only differ in n_estimators share one fit at the largest value, and the
+# smaller ones are scored from its stages / first trees.
+#
+# With search="halving" the grids are explored with successive halving over
+# the IMO groups (or n_estimators) instead. Every evaluated configuration and
+# its fit time is saved in search_log.csv.
+#
+# The run is resumable: manifest.json in the output folder records every
+# completed model, keyed by its name, features, grid and the data, and both
+# searches save each fold score and each refitted model in checkpoints/. A
+# restarted run skips the completed models, folds and refits. Model artifacts
+# (storefunctions.py) and result rows are written atomically.
+#
+# The manifest record of a model holds its result row and its search log
+# rows, and search_log.csv and the results table are rebuilt from it: the log
+# is rewritten with every completed model, and the results table gets the
+# rows of the completed models it does not hold yet. The manifest keys of the
+# stored rows are kept in the result_keys table of the sink, written in the
+# same flush as the rows, so the result table keeps its format. The manifest
+# is written first, so a crash before the row is stored leaves it for the
+# next run instead of duplicating it.
+
+manifest = RunManifest(output_folder)
+
+# Preprocess pipeline and columns read, for batch scoring of new data
+# (MainEngine_batch_scoring.py)
+atomicWrite(output_folder+"/preprocess.joblib",
+            lambda f: joblib.dump({'pipeline': preprocess, 'usecols': usecols,
+                                   'group': 'imo'}, f), mode='wb')
+data_key = cacheKey(input_data, dict(data_params, target=target, k=k,
+                                     search=search, resource=resource,
+                                     budget=budget))
+
+entries = dict()
+keys = dict()
+for ke in params:
+    p = params[ke]
+    features = p['features'] if p['features'] is not None else []
+    keys[ke] = manifest.entryKey(ke, features, p['grid'], p['model'], data_key)
+    if manifest.done(keys[ke]):
+        print("{}: already completed, skipped".format(ke))
+        continue
+    X_tr, y_tr = ptn.extract(df, features, key='train', rows=train_rows)
+    entries[ke] = {'model': p['model'], 'grid': p['grid'], 'X': X_tr, 'y': y_tr}
+
+start_time = time.time()
+checkpoints = {ke: manifest.checkpointFolder(keys[ke]) for ke in entries}
+if search == "halving":
+    fitted = halvingSearch(entries, cv, group_train, n_jobs=n_jobs,
+                           resource=resource, budget=budget,
+                           checkpoints=checkpoints, verbose=1)
+else:
+    fitted = flatSearch(entries, cv, group_train, n_jobs=n_jobs,
+                        checkpoints=checkpoints, verbose=1)
+print("Search ({}) time: {:.1f}s".format(search, time.time() - start_time))
+
+# Result rows already stored (by an earlier run of the same models)
+stored = set()
+if hasTable(results_file, 'result_keys'):
+    stored = set(readSink(results_file, 'result_keys')['entry_key'])
+
+# The row of a completed model and its key go in one flush
+results_sink = ResultSink(results_file)
+
+# Stores the result rows of the completed models missing in the table, and
+# rewrites search_log.csv with the log rows of every completed model
+def syncResults():
+    for ke in params:
+        if manifest.done(keys[ke]) and keys[ke] not in stored:
+            results_sink.put('result',
+                             pd.DataFrame(manifest.record(keys[ke])['result']))
+            results_sink.put('result_keys',
+                             pd.DataFrame({'entry_key': [keys[ke]]}))
+            results_sink.flush()
+            stored.add(keys[ke])
+    logs = [pd.DataFrame(manifest.record(keys[ke]).get('log', []))
+            for ke in params if manifest.done(keys[ke])]
+    log = pd.concat(logs, ignore_index=True) if logs else pd.DataFrame()
+    atomicWrite(output_folder+"/search_log.csv",
+                lambda f: log.to_csv(f, index=False))
+
+syncResults()
 
 for ke in params:
     p = params[ke]
     modelname = ke
-    target = p['target']
-    grid = p['grid']
-    if p['features'] is not None:
-        featuresResponse = p['features'] + [target]
-    else:
-        featuresResponse = [target]
-    model = sklearn.base.clone(p['model']) # Create a new model from base
-    
-
-    X_tr, y_tr = ptn.transform(df_train[featuresResponse])
-    X_te, y_te = ptn.transform(df_test[featuresResponse])
-
-    n_jobs = -1
-
-    if (grid is not None):
-        gr =  GridSearchCV( model, param_grid=grid, n_jobs = n_jobs, cv=cv)
-        gr.fit(X_tr, y_tr, groups=group_train)
-        mean_time = np.mean(gr.cv_results_['mean_fit_time'])
-        start_time = time.time()
-        e = predict_results(gr, X_tr, y_tr, X_te, y_te, group_train, group_test, modelname)
-        predict_time = time.time() - start_time
-        model = gr
-    else:
-        start_time = time.time()
-        model.fit(X_tr, y_tr)
-        mean_time = time.time() - start_time
-        start_time = time.time()
-        e = predict_results(model, X_tr, y_tr, X_te, y_te, group_train, group_test, modelname)
-        predict_time = time.time() - start_time
-        
-    
+    features = p['features'] if p['features'] is not None else []
+    if manifest.done(keys[ke]):
+        continue
+    model = fitted[ke]['model']
+    mean_time = fitted[ke]['mean_time']
+
+    X_tr, y_tr = ptn.extract(df, features, key='train', rows=train_rows)
+    X_te, y_te = ptn.extract(df, features, key='test', rows=test_rows)
+
+    start_time = time.time()
+    e = predict_results(model, X_tr, y_tr, X_te, y_te, group_train, group_test, modelname)
+    predict_time = time.time() - start_time
     
     print(
         """{}: 
@@ -325,30 +453,40 @@ for ke in params:
                    e['TrainMeanMAE'],e['TestMeanMAE']))
     
     pres = pd.DataFrame({**e, 'mean_time':mean_time, 'predict_time':predict_time})
-    res = res.append(pres)
     
-    # Save Model
-    joblib.dump(model, output_folder+'/'+modelname.replace(" ", "_")+".sav")
+    # Save Model: best estimator compressed, search metadata apart and the
+    # trees of RF/GB packed for memory mapped loading
+    artifact = output_folder+'/'+modelname.replace(" ", "_")
+    saveArtifact(model, artifact, features=features,
+                 search={'mean_time': mean_time})
     
-    # Save metrics - If file doesn't exist, put header.
-    pres.to_csv(results_file, index=False, mode="a", 
-           header=(not os.path.isfile(results_file)))
+    # Save metrics - If the table doesn't exist, it is created.
+    manifest.complete(keys[ke], {'model': ke, 'artifact': artifact,
+        'result': pres.to_dict(orient='list'),
+        'log': searchLog({ke: entries[ke]}).to_dict(orient='records')})
+    syncResults()
 
+results_sink.close()
 
+# Results of every model, this run's and the skipped ones
+res = pd.concat([pd.DataFrame(manifest.record(keys[ke])['result'])
+                 for ke in params], ignore_index=True)
 res
 
 # # Compare best models results
 
-m = joblib.load('models/RF_History.sav')
-X_tr, y_tr = ptn.transform(df_train[feat_history+[target]])
-X_te, y_te = ptn.transform(df_test[feat_history+[target]])
+# Only meta.json is read here; the packed trees are memory mapped at the
+# first predict
+m = loadArtifact('models/RF_History')
+X_tr, y_tr = ptn.extract(df, feat_history, key='train', rows=train_rows)
+X_te, y_te = ptn.extract(df, feat_history, key='test', rows=test_rows)
 pred_tr = m.predict(X_tr)
 pred_te = m.predict(X_te)
-getErrorMeasures(np.exp(y_te), np.exp(pred_te), group=df_test['imo'], agg_funct='median')
+getErrorMeasures(np.exp(y_te), np.exp(pred_te), group=group_test, agg_funct='median')
 
-m = joblib.load('models/RF_Activations.sav')
-X_tr, y_tr = ptn.transform(df_train[feat_activation+[target]])
-X_te, y_te = ptn.transform(df_test[feat_activation+[target]])
+m = loadArtifact('models/RF_Activations')
+X_tr, y_tr = ptn.extract(df, feat_activation, key='train', rows=train_rows)
+X_te, y_te = ptn.extract(df, feat_activation, key='test', rows=test_rows)
 pred_tr = m.predict(X_tr)
 pred_te = m.predict(X_te)
-getErrorMeasures(np.exp(y_te), np.exp(pred_te), group=df_test['imo'], agg_funct='median')
+getErrorMeasures(np.exp(y_te), np.exp(pred_te), group=group_test, agg_funct='median')
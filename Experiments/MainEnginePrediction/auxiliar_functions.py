@@ -38,27 +38,80 @@ def comparePredBase(real, pred, base):
     return(betterThanBase)
 
 
-# Return the different error measures
-def getErrorMeasures(real, pred, prefix='', group=None, agg_funct='mean',
-        individual_measures = False):
-    if group is not None:
-        df = pd.DataFrame({'real': real, 'pred': pred, 'group':group})
-        group = df.groupby(group).agg(agg_funct)
-        pred = group.pred.values
-        real = group.real.values
+# Group labels factorized once per split. The index is reused by every
+# aggregation over that split: codes per sample, sample count per group and
+# where each group starts once the samples are sorted by code. groups holds
+# the label of each code.
+#
+# As pandas groupby, samples with a missing (NaN) label are left out and the
+# aggregations skip missing values; a group with no values gets NaN.
+class GroupIndex:
+    def __init__(self, group):
+        codes, self.groups = pd.factorize(np.asarray(group), sort=True)
+        self.labeled = codes >= 0 # Code -1 is a missing label
+        self.codes = codes[self.labeled]
+        self.counts = np.bincount(self.codes, minlength=len(self.groups))
+        self.starts = np.cumsum(self.counts) - self.counts
+
+    def aggregate(self, values, agg_funct='mean'):
+        values = np.asarray(values, dtype=np.float64)[self.labeled]
+        valid = ~np.isnan(values)
+        counts = np.bincount(self.codes[valid], minlength=len(self.groups))
+        if agg_funct == 'mean':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return(np.bincount(self.codes[valid], weights=values[valid],
+                                   minlength=len(self.groups))/counts)
+        elif agg_funct == 'median':
+            # Sort by group and value (NaN last in each group), then pick the
+            # middle of the values of each segment
+            v = values[np.lexsort((values, self.codes))]
+            lo = self.starts + np.maximum(counts - 1, 0)//2
+            hi = self.starts + counts//2
+            res = np.full(len(self.groups), np.nan)
+            found = counts > 0
+            res[found] = (v[lo[found]] + v[hi[found]])/2
+            return(res)
+        else:
+            return(pd.Series(values).groupby(self.codes).agg(agg_funct)
+                     .reindex(np.arange(len(self.groups))).values)
+
+
+def errorMeasures(real, pred, prefix='', individual_measures=False):
+    diff = np.asarray(real, dtype=np.float64) - np.asarray(pred, dtype=np.float64)
     errors = dict()
-    errors[prefix+'MAE'] = [metrics.mean_absolute_error(real, pred)]
-    MSE = metrics.mean_squared_error(real, pred)
-    errors[prefix+'RMSE'] = [sqrt(MSE)]
+    errors[prefix+'MAE'] = [np.mean(np.abs(diff))]
+    errors[prefix+'RMSE'] = [sqrt(np.mean(diff**2))]
 
     if (individual_measures):
         # Individual measures
-        pairs = [ metrics.mean_absolute_error([r],[p]) for r,p in zip(real,pred)]
+        pairs = np.abs(diff)
         errors[prefix+'max_ind'] = np.max(pairs)
         errors[prefix+'mean_ind'] = np.mean(pairs)
         errors[prefix+'std_ind'] = np.std(pairs)
     return(errors)
 
+
+# Error measures of one split for several aggregations at once. aggs maps
+# each prefix to its aggregation function, e.g. {'TrainMedian': 'median'}.
+def groupedErrorMeasures(real, pred, group, aggs, individual_measures=False):
+    if not isinstance(group, GroupIndex):
+        group = GroupIndex(group)
+    errors = dict()
+    for prefix, agg_funct in aggs.items():
+        errors[prefix] = errorMeasures(group.aggregate(real, agg_funct),
+                                       group.aggregate(pred, agg_funct),
+                                       prefix, individual_measures)
+    return(errors)
+
+
+# Return the different error measures
+def getErrorMeasures(real, pred, prefix='', group=None, agg_funct='mean',
+        individual_measures = False):
+    if group is not None:
+        return(groupedErrorMeasures(real, pred, group, {prefix: agg_funct},
+                                    individual_measures)[prefix])
+    return(errorMeasures(real, pred, prefix, individual_measures))
+
 def fitModel(model, X_tr, y_tr, groupTrain, useGroupFit=True): 
     if useGroupFit:
         model.fit(X_tr,y_tr, groups = groupTrain)
@@ -87,14 +140,12 @@ def predict_results(model, X_tr, y_tr, X_te, y_te, groupTrain, groupTest,
         y_tr = np.exp(y_tr)
         y_te = np.exp(y_te)
 
-    etrmed = getErrorMeasures(y_tr, y_tr_pred, group=groupTrain,
-            prefix='TrainMedian', agg_funct='median')
-    etemed = getErrorMeasures(y_te, y_te_pred, group=groupTest, prefix='TestMedian',
-            agg_funct='median')
-
-    etr = getErrorMeasures(y_tr, y_tr_pred, group=groupTrain, prefix='TrainMean')
-    ete = getErrorMeasures(y_te, y_te_pred, group=groupTest, prefix='TestMean')
-    errors = {'model':modelName, **etrmed, **etemed, **etr, **ete}
+    etr = groupedErrorMeasures(y_tr, y_tr_pred, groupTrain,
+            {'TrainMedian': 'median', 'TrainMean': 'mean'})
+    ete = groupedErrorMeasures(y_te, y_te_pred, groupTest,
+            {'TestMedian': 'median', 'TestMean': 'mean'})
+    errors = {'model':modelName, **etr['TrainMedian'], **ete['TestMedian'],
+              **etr['TrainMean'], **ete['TestMean']}
 
     return errors
 
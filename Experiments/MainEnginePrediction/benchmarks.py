@@ -0,0 +1,375 @@
+# # Benchmarks
+#
+# Throughput checks for the hot paths of the regression loop. Run it from this
+# folder with `python benchmarks.py`.
+#
+# The scaling suite times and memory-profiles (tracemalloc) each hot path on
+# synthetic fleets (syntheticfunctions.py) of several sizes, fits the scaling
+# exponent of each one (time ~ rows^exponent) and can save the results as a
+# JSON baseline and compare a later run against it:
+#
+#     python benchmarks.py --save baseline.json
+#     python benchmarks.py --compare baseline.json --tolerance 1.5
+#
+# The comparison exits with status 1 when a benchmark is slower than the
+# baseline by more than the tolerance, or has no baseline (other scales or
+# mean_length), so a scheduled job can catch regressions before the weekly
+# runs do.
+
+import json
+import os
+import platform
+import shutil
+import sys
+import time
+import tracemalloc
+import warnings
+
+from argparse import ArgumentParser
+
+import numpy as np
+import pandas as pd
+import sklearn
+
+from auxiliar_functions import getErrorMeasures, predict_results
+from datafunctions import loadFrame, saveFrame
+from pipefunctions import *
+from searchfunctions import flatSearch
+from sklearn.ensemble import GradientBoostingRegressor, RandomForestRegressor
+from sklearn.exceptions import ConvergenceWarning
+from sklearn.linear_model import Lasso
+from sklearn.model_selection import GroupKFold
+from sklearn.pipeline import Pipeline
+from syntheticfunctions import syntheticFleet
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                             '..', 'tests'))
+from testtools import timeit
+
+
+# ## Meanizer
+
+# String-key Meanizer as it was before the integer group-id engine. Kept only
+# as a reference for the benchmark.
+
+class StringKeyMeanizer(Meanizer):
+    def fit(self, X, y):
+        keys = np.apply_along_axis(str, 1, X) # Transform data to keys
+        df = pd.DataFrame({'key': keys, 'value': y})
+        df = df.groupby('key').agg('mean')
+        self.mean = dict(zip(df.index.values, df['value']))
+        return self
+
+    def predict(self, X, y=None):
+        keys = np.apply_along_axis(str, 1, X) # Transform data to keys
+        return(np.array([self.mean[k] for k in keys]))
+
+
+# One-hot ship type matrix as the one produced by the Dummizer
+def typeDataset(nrows, ntypes, seed=0):
+    rng = np.random.RandomState(seed)
+    types = rng.randint(ntypes, size=nrows)
+    X = np.zeros((nrows, ntypes), dtype=np.uint8)
+    X[np.arange(nrows), types] = 1
+    y = rng.normal(9, 1, size=nrows) + types/ntypes
+    return X, y
+
+
+def benchMeanizer(sizes=(10**3, 10**4, 10**5), ntypes=30):
+    rows = []
+    for n in sizes:
+        X, y = typeDataset(n, ntypes)
+        preds = []
+        for name, model in [('string', StringKeyMeanizer()),
+                            ('groupid', Meanizer())]:
+            _, fit_time = timeit(model.fit, X, y)
+            pred, predict_time = timeit(model.predict, X)
+            preds.append(pred)
+            rows.append({'engine': name, 'rows': n, 'fit_time': fit_time,
+                         'predict_time': predict_time,
+                         'rows_per_sec': 2*n/(fit_time + predict_time)})
+        # Both engines must agree
+        if not np.allclose(preds[0], preds[1]):
+            raise ValueError("Meanizer engines disagree")
+    return pd.DataFrame(rows)
+
+
+# ## Estimator path reuse
+#
+# Grid search of GB and RF with and without sharing one fit per n_estimators
+# path. Scores must be the same (fixed random_state).
+
+def regressionDataset(nrows, ncols, ngroups=50, seed=0):
+    rng = np.random.RandomState(seed)
+    X = rng.normal(size=(nrows, ncols)).astype(np.float32)
+    y = X[:, 0] + np.sin(X[:, 1]) + rng.normal(0, 0.1, size=nrows)
+    groups = rng.randint(ngroups, size=nrows)
+    return X, y, groups
+
+
+def benchPathReuse(nrows=1000, ncols=10):
+    X, y, groups = regressionDataset(nrows, ncols)
+    grids = {'GB': (GradientBoostingRegressor(random_state=0),
+                    {'max_depth': [3, 5], 'n_estimators': [50, 100, 150, 200],
+                     'learning_rate': [0.01, 0.1]}),
+             'RF': (RandomForestRegressor(random_state=0),
+                    {'max_depth': [5, None], 'n_estimators': [20, 100]})}
+    rows = []
+    for name, (model, grid) in grids.items():
+        scores = []
+        for reuse in [False, True]:
+            entries = {name: {'model': model, 'grid': grid, 'X': X, 'y': y}}
+            _, search_time = timeit(flatSearch, entries, GroupKFold(3), groups,
+                                    1, reuse)
+            scores.append(entries[name]['cv_results']['mean_test_score'])
+            rows.append({'model': name, 'reuse_path': reuse,
+                         'search_time': search_time})
+        if not np.allclose(scores[0], scores[1], rtol=1e-10, atol=1e-12):
+            raise ValueError("Path reuse changes the {} scores".format(name))
+    return pd.DataFrame(rows)
+
+
+# ## Feature cache
+#
+# A cached frame must come back memory mapped: loadFrame allocates (traced
+# memory) a small fraction of the frame, and extracting a split reads only
+# the rows of the split.
+
+def benchCache(nrows=10**6, ncols=20, folder='benchcache'):
+    rng = np.random.RandomState(0)
+    df = pd.DataFrame(rng.normal(size=(nrows, ncols)).astype(np.float32),
+                      columns=['x{}'.format(j) for j in range(ncols)])
+    df['imo'] = pd.Categorical(rng.randint(1000, size=nrows))
+    size = df.memory_usage(index=True).sum()/2**20
+    saveFrame(df, folder)
+    del df
+    tracemalloc.start()
+    start_time = time.time()
+    cached = loadFrame(folder)
+    load_time = time.time() - start_time
+    load_peak = tracemalloc.get_traced_memory()[1]/2**20
+    tracemalloc.stop()
+    mapped = sum(isinstance(cached[col].values, np.memmap)
+                 for col in cached.columns)
+    rows = np.asarray(cached['imo'].isin(range(500)))
+    ptn = PandasToNumpyXY(response='x0', dtype=np.float32, order='F')
+    tracemalloc.start()
+    X, y = ptn.extract(cached, list(cached.columns[1:ncols]), rows=rows)
+    extract_peak = tracemalloc.get_traced_memory()[1]/2**20
+    tracemalloc.stop()
+    shutil.rmtree(folder)
+    return pd.DataFrame([{'frame_mb': size, 'mapped_columns': mapped,
+                          'load_time': load_time, 'load_peak_mb': load_peak,
+                          'split_mb': (X.nbytes + y.nbytes)/2**20,
+                          'extract_peak_mb': extract_peak}])
+
+
+# ## Scaling suite
+#
+# Every benchmark gets the regression dataset of a synthetic fleet (type as a
+# categorical, as readDataset loads it) and returns the function to measure.
+
+# Preprocess pipeline of MainEngine_regression_loop.py
+def preprocessPipeline():
+    return Pipeline([
+        ("dropNA", Droper()),
+        ('logaritmizer', Logaritmizer(inputColumn='installedPowerME',
+                                      outputColumn='logInstalledPowerME',
+                                      copy=False)),
+        ('stringCast', StringCaster(column='type')),
+        ('dummizer', Dummizer(inputColumns=['type'], outputPrefix='binType'))])
+
+
+# Preprocessed frame, history and type features, target and groups
+def preparedData(df):
+    df = preprocessPipeline().transform(df.copy())
+    binType = [col for col in df.columns if 'binType_' in col]
+    history = [col for col in df.columns
+               if col.startswith(('rotationGPS', 'sog', 'bathymetry'))]
+    activations = [col for col in df.columns if 'activations' in col]
+    return df, {'type': binType, 'history': history + binType,
+                'activations': activations + binType}
+
+
+def setupPreprocess(df):
+    pipeline = preprocessPipeline()
+    return lambda: pipeline.transform(df.copy())
+
+
+def setupMeanizer(df):
+    df, features = preparedData(df)
+    X = df[features['type']].values
+    y = df['logInstalledPowerME'].values
+    return lambda: Meanizer().fit(X, y).predict(X)
+
+
+def setupExtract(df):
+    df, features = preparedData(df)
+    ptn = PandasToNumpyXY(response='logInstalledPowerME', dtype=np.float32,
+                          order='F')
+    return lambda: ptn.extract(df, features['history'])
+
+
+def setupErrorMeasures(df):
+    df, features = preparedData(df)
+    X, y = PandasToNumpyXY(response='logInstalledPowerME').extract(
+        df, features['type'])
+    groups = df['imo'].values.astype(np.int64)
+    model = Meanizer().fit(X, y)
+
+    def run():
+        predict_results(model, X, y, X, y, groups, groups, 'Type average')
+        getErrorMeasures(np.exp(y), np.exp(model.predict(X)), group=groups,
+                         agg_funct='median')
+    return run
+
+
+# The per-model fit loop with a reduced version of the grids of the loop
+def setupFitLoop(df):
+    df, features = preparedData(df)
+    groups = df['imo'].values.astype(np.int64)
+    models = {'Type average': (Meanizer(), None, 'type'),
+              'Lasso History': (Lasso(), {'alpha': [0.001, 0.01]},
+                                'history'),
+              'GB Activations': (GradientBoostingRegressor(random_state=0),
+                                 {'max_depth': [3], 'n_estimators': [10, 20]},
+                                 'activations')}
+
+    def run():
+        # A new ptn per run, so every run extracts the matrices again
+        ptn = PandasToNumpyXY(response='logInstalledPowerME',
+                              dtype=np.float32, order='F')
+        entries = {}
+        for name, (model, grid, feats) in models.items():
+            X, y = ptn.extract(df, features[feats], key='train')
+            entries[name] = {'model': model, 'grid': grid, 'X': X, 'y': y}
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', ConvergenceWarning)
+            return flatSearch(entries, GroupKFold(3), groups, n_jobs=1)
+    return run
+
+
+suite = {'preprocess': setupPreprocess, 'meanizer': setupMeanizer,
+         'extract': setupExtract, 'error_measures': setupErrorMeasures,
+         'fit_loop': setupFitLoop}
+
+
+# Best time of up to repeat runs (fewer once budget seconds are spent, so
+# only the fast benchmarks are repeated), and peak traced memory of one more
+# run
+def measure(funct, repeat=5, budget=1):
+    times = []
+    while len(times) < repeat and sum(times) < budget:
+        start_time = time.time()
+        funct()
+        times.append(time.time() - start_time)
+    tracemalloc.start()
+    funct()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times), peak/2**20
+
+
+def benchSuite(scales=(50, 200, 800), mean_length=200, names=None, repeat=5,
+               seed=0):
+    rows = []
+    for nships in scales:
+        dataset = syntheticFleet(nships, mean_length, seed=seed)[2]
+        dataset['type'] = dataset['type'].astype('category')
+        for name in names or suite:
+            elapsed, peak = measure(suite[name](dataset), repeat)
+            rows.append({'benchmark': name, 'ships': nships,
+                         'rows': len(dataset), 'time': elapsed,
+                         'peak_mb': peak,
+                         'rows_per_sec': len(dataset)/elapsed})
+    return pd.DataFrame(rows)
+
+
+# Exponent of time ~ rows^exponent of every benchmark (least squares in log
+# space over the scales)
+def scalingCurves(res):
+    rows = []
+    for name, runs in res.groupby('benchmark', sort=False):
+        exponent = np.polyfit(np.log(runs['rows']), np.log(runs['time']), 1)[0] \
+                   if len(runs) > 1 else np.nan
+        rows.append({'benchmark': name, 'exponent': exponent,
+                     'max_rows': runs['rows'].max(),
+                     'max_time': runs['time'].max(),
+                     'max_peak_mb': runs['peak_mb'].max()})
+    return pd.DataFrame(rows)
+
+
+def environment():
+    return {'python': platform.python_version(), 'numpy': np.__version__,
+            'pandas': pd.__version__, 'sklearn': sklearn.__version__,
+            'machine': platform.machine(), 'processor': platform.processor()}
+
+
+def saveBaseline(res, path):
+    with open(path, 'w') as f:
+        json.dump({'environment': environment(),
+                   'results': res.to_dict(orient='records'),
+                   'scaling': scalingCurves(res).to_dict(orient='records')},
+                  f, indent=1)
+
+
+# Time and memory ratios of res over the baseline, by benchmark and scale
+# (ships and rows, so runs with another mean_length do not match). status is
+# 'ok', 'slower' (time ratio above tolerance), 'no baseline' (run but not in
+# the baseline) or 'not run' (in the baseline but not run).
+def compareBaseline(res, path, tolerance=1.5):
+    with open(path) as f:
+        baseline = pd.DataFrame(json.load(f)['results'])
+    res = res.merge(baseline, on=['benchmark', 'ships', 'rows'], how='outer',
+                    suffixes=('', '_baseline'), indicator=True, sort=False)
+    res['time_ratio'] = res['time']/res['time_baseline']
+    res['memory_ratio'] = res['peak_mb']/res['peak_mb_baseline']
+    res['status'] = np.select(
+        [res['_merge'] == 'left_only', res['_merge'] == 'right_only',
+         res['time_ratio'] > tolerance],
+        ['no baseline', 'not run', 'slower'], 'ok')
+    return res[['benchmark', 'ships', 'rows', 'time', 'time_baseline',
+                'time_ratio', 'peak_mb', 'peak_mb_baseline', 'memory_ratio',
+                'status']]
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-n", "--scales", default="50,200,800",
+            help = "Comma separated fleet sizes (ships). Default 50,200,800.")
+    parser.add_argument("-l", "--mean_length", type=int, default=200,
+            help = "Mean samples per ship. Default 200.")
+    parser.add_argument("-b", "--only",
+            help = "Comma separated benchmarks of the suite ({}). Skips the "
+                   "engine checks.".format(",".join(suite)))
+    parser.add_argument("-r", "--repeat", type=int, default=5,
+            help = "Most timed runs per benchmark, while they take less than "
+                   "a second in total (best is kept). Default 5.")
+    parser.add_argument("--save", metavar="FILE",
+            help = "Save the results as a JSON baseline.")
+    parser.add_argument("--compare", metavar="FILE",
+            help = "Compare with a JSON baseline.")
+    parser.add_argument("--tolerance", type=float, default=1.5,
+            help = "Time ratio over the baseline reported as a regression. "
+                   "Default 1.5.")
+    args = parser.parse_args()
+
+    if args.only is None:
+        print(benchMeanizer())
+        print(benchPathReuse())
+        print(benchCache())
+    names = args.only.split(",") if args.only else None
+    res = benchSuite([int(n) for n in args.scales.split(",")],
+                     args.mean_length, names, args.repeat)
+    print(res.to_string(index=False))
+    print(scalingCurves(res).to_string(index=False))
+    if args.save is not None:
+        saveBaseline(res, args.save)
+    if args.compare is not None:
+        comparison = compareBaseline(res, args.compare, args.tolerance)
+        print(comparison.to_string(index=False))
+        if (comparison['status'] == 'not run').any():
+            print("Warning: baseline benchmarks not run in this comparison")
+        # A run that cannot be compared fails as a slower one
+        if comparison['status'].isin(['slower', 'no baseline']).any():
+            sys.exit(1)
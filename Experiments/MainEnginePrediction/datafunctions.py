@@ -0,0 +1,217 @@
+# # Data loading functions
+
+import hashlib
+import json
+import os
+import resource
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+
+from pandas.api.types import union_categoricals
+
+from pipefunctions import profilePipeline
+
+
+# Peak resident memory of this process in MB (ru_maxrss is in kB on Linux)
+def peakMemory():
+    return(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024)
+
+
+# Downcast numeric columns in place: floats to float32 and integers to the
+# smallest integer type that holds them.
+def downcast(X):
+    for col in X.select_dtypes(include=['float64']).columns:
+        X[col] = X[col].astype(np.float32)
+    for col in X.select_dtypes(include=['int64']).columns:
+        X[col] = pd.to_numeric(X[col], downcast='integer')
+    return(X)
+
+
+# ## Chunked CSV reader
+#
+# Reads only the columns accepted by `usecols` (list or callable, as in
+# pd.read_csv), `chunksize` rows at a time. Each chunk is downcasted, the
+# `categorical` columns are read as pandas categoricals and the chunk goes
+# through `pipeline.transform` before the next one is parsed, so the float64
+# version of the whole file never sits in memory.
+#
+# Chunks may see different categories: they are unified before concatenating
+# and dummy columns missing in a chunk are filled with 0.
+
+def readDataset(path, usecols=None, pipeline=None, chunksize=500000,
+                categorical=('type', 'imo'), profile=False, verbose=True):
+    start_time = time.time()
+
+    header = pd.read_csv(path, nrows=0).columns
+    if callable(usecols):
+        usecols = [col for col in header if usecols(col)]
+    elif usecols is None:
+        usecols = list(header)
+    dtype = {col: 'category' for col in categorical if col in usecols}
+
+    chunks = []
+    profiles = []
+    reader = pd.read_csv(path, usecols=usecols, dtype=dtype,
+                         chunksize=chunksize)
+    for chunk in reader:
+        chunk = downcast(chunk)
+        if pipeline is not None and profile:
+            chunk, prof = profilePipeline(pipeline, chunk)
+            profiles.append(prof)
+        elif pipeline is not None:
+            chunk = pipeline.transform(chunk)
+        chunks.append(chunk)
+
+    if profiles:
+        prof = pd.concat(profiles).groupby('step', sort=False).agg(
+            {'time': 'sum', 'peak_mb': 'max', 'retained_mb': 'max',
+             'frame_mb': 'max'})
+        print("Preprocess profile (time summed, memory max per chunk):")
+        print(prof)
+
+    dtypes = dict()
+    for chunk in chunks:
+        for col, dt in chunk.dtypes.items():
+            dtypes.setdefault(col, dt)
+    columns = list(dtypes)
+
+    for col in columns:
+        if not all(col in c and hasattr(c[col], 'cat') for c in chunks):
+            continue
+        cats = union_categoricals([c[col] for c in chunks]).categories
+        for c in chunks:
+            c[col] = c[col].cat.set_categories(cats)
+
+    for i, chunk in enumerate(chunks):
+        if len(chunk.columns) != len(columns):
+            missing = [col for col in columns if col not in chunk.columns]
+            for col in missing:
+                chunk[col] = np.zeros(len(chunk), dtype=dtypes[col])
+        chunks[i] = chunk[columns]
+
+    df = pd.concat(chunks)
+    del chunks
+
+    load_time = time.time() - start_time
+    if verbose:
+        print("Loaded {} rows x {} columns in {:.1f}s. Peak memory: {:.0f} MB"
+              .format(df.shape[0], df.shape[1], load_time, peakMemory()))
+    return df
+
+
+# ## Feature cache
+#
+# The preprocessed frame is stored as one .npy file per column plus a
+# meta.json with the column names and dtypes. Categorical and string columns
+# are stored as integer codes and their categories. The cache entry is keyed
+# by the content hash of the input file and the parameters of the pipeline
+# that produced it, so a change in either creates a new entry.
+
+# Hashes already computed in this process, by path, size and modification time
+fileHashes = dict()
+
+def fileHash(path, blocksize=2**24):
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    if key not in fileHashes:
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(blocksize), b''):
+                h.update(block)
+        fileHashes[key] = h.hexdigest()
+    return(fileHashes[key])
+
+
+# Steps of this repo's pipelines do not all implement get_params, so the
+# key is built from their attributes.
+def pipelineKey(pipeline):
+    if pipeline is None:
+        return(None)
+    return([(name, type(step).__name__, sorted(vars(step).items()))
+            for name, step in pipeline.steps])
+
+
+def cacheKey(path, params=None):
+    h = hashlib.sha1(fileHash(path).encode())
+    h.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return(h.hexdigest())
+
+
+def saveFrame(df, folder):
+    tmp = folder + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    meta = {'columns': [], 'index': None}
+    for i, col in enumerate(df.columns):
+        values = df[col]
+        kind = str(values.dtype)
+        categories = None
+        if kind == 'category' or pd.api.types.is_string_dtype(values):
+            cat = pd.Categorical(values)
+            categories = cat.categories.tolist()
+            values = cat.codes
+        np.save(os.path.join(tmp, 'col_{}.npy'.format(i)), np.asarray(values))
+        meta['columns'].append({'name': col, 'kind': kind,
+                                'categories': categories})
+    if not isinstance(df.index, pd.RangeIndex):
+        np.save(os.path.join(tmp, 'index.npy'), df.index.values)
+        meta['index'] = 'index.npy'
+
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f, default=str)
+    shutil.rmtree(folder, ignore_errors=True)
+    os.rename(tmp, folder)
+
+
+# Numeric columns stay memory mapped: the frame is built without copying or
+# consolidating them (one block per column). mmap_mode='c' is copy on write,
+# so code that modifies a column in place gets private copies of the pages it
+# writes and the cache is never changed. Categorical and string columns are
+# rebuilt from their codes.
+def loadFrame(folder, mmap_mode='c'):
+    with open(os.path.join(folder, 'meta.json')) as f:
+        meta = json.load(f)
+
+    data = dict()
+    for i, col in enumerate(meta['columns']):
+        values = np.load(os.path.join(folder, 'col_{}.npy'.format(i)),
+                         mmap_mode=mmap_mode)
+        if col['categories'] is not None:
+            values = pd.Categorical.from_codes(values, col['categories'])
+            if col['kind'] != 'category':
+                values = np.asarray(values, dtype=object)
+        data[col['name']] = values
+
+    index = None
+    if meta['index'] is not None:
+        index = np.load(os.path.join(folder, meta['index']))
+    return(pd.DataFrame(data, index=index, copy=False))
+
+
+# Returns loader(path) from the cache in cache_folder (default: .cache next to
+# the input file), computing and storing it on a miss.
+def cachedDataset(path, loader=pd.read_csv, params=None, cache_folder=None,
+                  verbose=True):
+    if cache_folder is None:
+        cache_folder = os.path.join(os.path.dirname(path), '.cache')
+    start_time = time.time()
+    key = cacheKey(path, params)
+    folder = os.path.join(cache_folder,
+                          os.path.basename(path) + '-' + key[:16])
+
+    if os.path.isfile(os.path.join(folder, 'meta.json')):
+        df = loadFrame(folder)
+        if verbose:
+            print("Loaded {} from cache {} in {:.1f}s".format(
+                  path, folder, time.time() - start_time))
+    else:
+        df = loader(path)
+        saveFrame(df, folder)
+        if verbose:
+            print("Cached {} in {} ({:.1f}s)".format(
+                  path, folder, time.time() - start_time))
+    return(df)
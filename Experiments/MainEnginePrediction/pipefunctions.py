@@ -22,6 +22,10 @@
 #     version: 3.6.7
 # ---
 
+import os
+import time
+import tracemalloc
+
 import sklearn
 import numpy as np
 import pandas as pd
@@ -37,41 +41,51 @@ class Droper(sklearn.base.BaseEstimator, sklearn.base.TransformerMixin):
     def transform(self, X, y=None):
         return(X.dropna())
 
+# ## Copy mode
+#
+# Transformers that derive a new column return a copy of X with it by default.
+# With copy=False the column is written into X itself, so a long pipeline does
+# not keep one copy of the frame per step. Without outputColumn the input
+# column is always replaced in place.
+
+def setColumn(X, inputColumn, outputColumn, values, copy=True):
+    if outputColumn is None:
+        X[inputColumn] = values
+    elif copy:
+        X = X.assign(**{outputColumn: values})
+    else:
+        X[outputColumn] = values
+    return(X)
+
 # ## Logaritmizer & Exponentizator
 
 class Logaritmizer(sklearn.base.BaseEstimator, sklearn.base.TransformerMixin):
-    def __init__(self, inputColumn, outputColumn=None):
+    def __init__(self, inputColumn, outputColumn=None, copy=True):
         self.inputColumn = inputColumn
         self.outputColumn = outputColumn
+        self.copy = copy
 
     def fit(self, X, y):
         return(self)
 
     def transform(self, X, y=None):
         lg = np.log(X[self.inputColumn])
-        if self.outputColumn is None:
-            X[self.inputColumn] = lg
-        else:
-            X = X.assign(___Log___ = lg)
-            X = X.rename(columns={'___Log___': self.outputColumn})
-        return(X)
+        return(setColumn(X, self.inputColumn, self.outputColumn, lg,
+                         self.copy))
 
 class Exponentizator(sklearn.base.BaseEstimator, sklearn.base.TransformerMixin):
-    def __init__(self, inputColumn, outputColumn=None):
+    def __init__(self, inputColumn, outputColumn=None, copy=True):
         self.inputColumn = inputColumn
         self.outputColumn = outputColumn
+        self.copy = copy
 
     def fit(self, X, y):
         return(self)
 
     def transform(self, X, y=None):
         ex = np.exp(X[self.inputColumn])
-        if self.outputColumn is None:
-            X[self.inputColumn] = ex
-        else:
-            X = X.assign(___Exp___ = ex)
-            X = X.rename(columns={'___Exp___': self.outputColumn})
-        return(X)
+        return(setColumn(X, self.inputColumn, self.outputColumn, ex,
+                         self.copy))
 
 
 # ## Shuffler
@@ -105,7 +119,8 @@ class Dummizer(sklearn.base.TransformerMixin):
 
     def transform(self, X, y=None):
         # Transform to string
-        X=pd.get_dummies(X, columns=self.columns, prefix=self.prefix)
+        X=pd.get_dummies(X, columns=self.columns, prefix=self.prefix,
+                         dtype=np.uint8)
         return X
 
 
@@ -119,93 +134,186 @@ class StringCaster(sklearn.base.TransformerMixin):
         return self
 
     def transform(self, X, y=None):
-        X[self.column] = X[self.column].astype(str)
+        if hasattr(X[self.column], 'cat'): # Keep categoricals compact
+            X[self.column] = X[self.column].cat.rename_categories(str)
+        else:
+            X[self.column] = X[self.column].astype(str)
         return X
 
 # ## Binner
 
 class Binner(sklearn.base.TransformerMixin):
-    def __init__(self, bins, inputColumn, outputColumn=None):
+    def __init__(self, bins, inputColumn, outputColumn=None, copy=True):
         self.inputColumn = inputColumn
         self.outputColumn = outputColumn
         self.bins = bins
+        self.copy = copy
 
     def fit(self, X, y):
         return(self)
 
     def transform(self, X, y=None):
         bin = pd.cut(X[self.inputColumn], bins=self.bins)
-        if self.outputColumn is None:
-            X[self.inputColumn] = bin
-        else:
-            X = X.assign(___Bin___ = bin)
-            X = X.rename(columns={'___Bin___': self.outputColumn})
-        return(X)
+        return(setColumn(X, self.inputColumn, self.outputColumn, bin,
+                         self.copy))
 
+# Midpoints are computed once per bin from the interval edges and gathered
+# with the category codes. Missing values stay NaN.
 class BinnerMid(sklearn.base.TransformerMixin):
-    def __init__(self, inputColumn, outputColumn=None):
+    def __init__(self, inputColumn, outputColumn=None, copy=True):
         self.inputColumn = inputColumn
         self.outputColumn = outputColumn
+        self.copy = copy
 
     def fit(self, X, y):
         return(self)
 
     def transform(self, X, y=None):
-        bin = [i.mid for i in X[self.inputColumn]] 
-        if self.outputColumn is None:
-            X[self.inputColumn] = bin
-        else:
-            X = X.assign(___Bin___ = bin)
-            X = X.rename(columns={'___Bin___': self.outputColumn})
-        return(X)
+        mids = np.append(X[self.inputColumn].cat.categories.mid, np.nan)
+        bin = mids[X[self.inputColumn].cat.codes.values] # Code -1 is NaN
+        return(setColumn(X, self.inputColumn, self.outputColumn, bin,
+                         self.copy))
 
 
 
 # ## Response splitter: PandasToNumpyXY
 
+# The feature matrix is allocated once with the requested dtype and memory
+# order and filled column by column, so neither X nor a fancy-indexed copy of
+# it is materialized on the way. Linear models (coordinate descent) and tree
+# ensembles both read X by columns, so order='F' avoids the conversion copy
+# they would otherwise do in fit.
+#
+# rows (boolean mask or positions) selects the rows of X column by column, so
+# a split of a memory mapped frame (loadFrame) is never copied as a whole.
+#
+# extract() caches the result by (key, features): models that use the same
+# feature set on the same split share one array. The cache (cached_) is
+# created at the first extract, so it is not constructor state: get_params and
+# clone only see the parameters. With memmap_folder set, the
+# cached arrays are stored as .npy and reopened memory mapped (see
+# sharedArray).
+
 class PandasToNumpyXY(sklearn.base.BaseEstimator, sklearn.base.TransformerMixin):
-    def __init__(self, response):
+    def __init__(self, response, dtype=None, order='C', memmap_folder=None):
         self.response = response
+        self.dtype = dtype
+        self.order = order
+        self.memmap_folder = memmap_folder
    
     def fit(self, X, y):
         return(self)
 
     def transform(self, X, y=None):
-        y = X[self.response]
-        Xc = X.copy()
-        del Xc[self.response] # This has effect over the global X! We need a copy
-        X = Xc.values
-        y = y.values
-        
-        return(X,y)        
+        features = [col for col in X.columns if col != self.response]
+        return(self.extract(X, features))
+
+    def extract(self, X, features, key=None, rows=None):
+        if not hasattr(self, 'cached_'):
+            self.cached_ = dict()
+        cacheKey = (key, tuple(features))
+        if key is not None and cacheKey in self.cached_:
+            return(self.cached_[cacheKey])
+
+        dtype = self.dtype
+        if dtype is None and len(features) > 0:
+            dtype = np.result_type(*[X[col].dtype for col in features])
+        elif dtype is None:
+            dtype = np.float64
+        if rows is None:
+            rows = slice(None)
+            nrows = X.shape[0]
+        else:
+            rows = np.asarray(rows)
+            nrows = rows.sum() if rows.dtype == bool else len(rows)
+        Xa = np.empty((nrows, len(features)), dtype=dtype, order=self.order)
+        for j, col in enumerate(features):
+            Xa[:, j] = np.asarray(X[col].values)[rows]
+        y = np.asarray(X[self.response].values)[rows]
+
+        if key is not None:
+            if self.memmap_folder is not None:
+                name = '{}-{}'.format(key, len(self.cached_))
+                Xa = sharedArray(Xa, self.memmap_folder, name)
+            self.cached_[cacheKey] = (Xa, y)
+        return(Xa, y)
+
+
+# Stores a feature matrix as .npy and reopens it memory mapped. joblib passes
+# memmaps to the GridSearchCV workers by file name, so all of them share the
+# same pages instead of receiving a pickled copy.
+def sharedArray(X, folder, name):
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    path = os.path.join(folder, name + '.npy')
+    np.save(path, X)
+    return(np.load(path, mmap_mode='r'))
+
+
+# ## Pipeline profiling
+
+# Runs the pipeline step by step and reports, for each step, the time spent,
+# the peak memory allocated while running it (tracemalloc) and the size of
+# the frame it returns.
+
+def profilePipeline(pipeline, X):
+    rows = []
+    for name, step in pipeline.steps:
+        tracemalloc.start()
+        start_time = time.time()
+        X = step.transform(X)
+        elapsed = time.time() - start_time
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        size = X.memory_usage(index=True).sum() if hasattr(X, 'memory_usage') else np.nan
+        rows.append({'step': name, 'time': elapsed, 'peak_mb': peak/2**20,
+                     'retained_mb': current/2**20, 'frame_mb': size/2**20})
+    return X, pd.DataFrame(rows)
 
 
 # # Regressors
 
 # ## Meanizer - Model that always predict the average
 
+# Rows are encoded as integer group ids (np.unique over a byte view of each
+# row), so fit and predict never leave NumPy. Keys not seen during fit get
+# the `unseen` value: 'mean' (global train mean), 'nan' or a number.
+
+def rowKeys(X):
+    X = np.ascontiguousarray(X, dtype=np.float64) + 0.0 # -0.0 -> 0.0
+    return X.view(np.dtype((np.void, X.dtype.itemsize*X.shape[1]))).ravel()
+
 class Meanizer(sklearn.base.BaseEstimator, sklearn.base.RegressorMixin):
+    def __init__(self, unseen='mean'):
+        self.unseen = unseen
 
     def fit(self, X, y):
+        y = np.asarray(y, dtype=np.float64)
+        self.mean = y.mean()
         if X.shape[1] == 0: # Normal mean
-            # Remove duplicates to do the mean?
-            self.mean = y.mean()
+            self.keys = None
         else:
-            keys = np.apply_along_axis(str, 1, X) # Transform data to keys
-
-            df = pd.DataFrame({'key': keys, 'value': y})
-            df = df.groupby('key').agg('mean')
-
-            self.mean =  dict(zip(df.index.values, df['value']))
+            self.keys, groups = np.unique(rowKeys(X), return_inverse=True)
+            groups = groups.ravel()
+            self.means = (np.bincount(groups, weights=y) /
+                          np.bincount(groups))
 
         return self
 
     def predict(self, X, y=None):
-        if isinstance(self.mean, dict): # Grouped average
-            keys = np.apply_along_axis(str, 1, X) # Transform data to keys
-            y = [self.mean[k] for k in keys]
+        if self.keys is None:
+            return(np.repeat(self.mean, X.shape[0])) # Repeat mean nrow times
+
+        keys = rowKeys(X)
+        pos = np.searchsorted(self.keys, keys)
+        pos[pos == len(self.keys)] = 0
+        found = self.keys[pos] == keys
+
+        if self.unseen == 'mean':
+            fallback = self.mean
+        elif self.unseen == 'nan':
+            fallback = np.nan
         else:
-            y = np.repeat(self.mean, X.shape[0]) # Repeat mean ncol times
+            fallback = float(self.unseen)
+        y = np.where(found, self.means[pos], fallback)
         return(y)
-
-
@@ -0,0 +1,120 @@
+# # Run functions
+#
+# Checkpointing of the experiment runs: a manifest of the completed entries,
+# per-fold cross-validation scores, refitted models and atomic writes of the
+# result files, so that a restarted run skips the work already done.
+
+import hashlib
+import json
+import os
+import time
+
+try:
+    from sklearn.externals import joblib
+except ImportError:
+    import joblib
+
+
+# ## Atomic writes
+#
+# write(f) fills a temporary file next to path, which then replaces path in
+# one rename: readers (and restarts after a crash) see either the old or the
+# new file, never a partial one.
+
+def atomicWrite(path, write, mode='w'):
+    tmp = '{}.tmp{}'.format(path, os.getpid())
+    try:
+        with open(tmp, mode) as f:
+            write(f)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+# ## Fold checkpoints
+#
+# One small JSON file per finished fold task with its fit time and score(s).
+
+def loadCheckpoint(path):
+    if path is None or not os.path.isfile(path):
+        return(None)
+    with open(path) as f:
+        res = json.load(f)
+    return(res['fit_time'], res['score'])
+
+
+def saveCheckpoint(path, fit_time, score):
+    atomicWrite(path, lambda f: json.dump({'fit_time': fit_time,
+                                           'score': score}, f))
+
+
+# ## Refit checkpoints
+#
+# The refitted model of an entry with its fit time and parameters, in one
+# joblib file. It is only loaded back for the same parameters.
+
+def loadRefit(path, params):
+    if path is None or not os.path.isfile(path):
+        return(None)
+    res = joblib.load(path)
+    if json.dumps(res['params'], sort_keys=True, default=str) != \
+       json.dumps(params, sort_keys=True, default=str):
+        return(None)
+    return(res['model'], res['fit_time'])
+
+
+def saveRefit(path, model, fit_time, params):
+    atomicWrite(path, lambda f: joblib.dump({'model': model,
+                                             'fit_time': fit_time,
+                                             'params': params}, f),
+                mode='wb')
+
+
+# ## Run manifest
+#
+# manifest.json in the output folder maps the key of every completed entry to
+# its record (model name, saved model file, result row...). The key hashes the
+# model name, the feature list, the grid, the model parameters and the data
+# key (input file and everything else that changes the data or the search),
+# so changing any of them runs the entry again. Fold checkpoints of an entry
+# live in checkpoints/<key>.
+
+def modelKey(model):
+    if hasattr(model, 'get_params'):
+        params = model.get_params()
+    else:
+        params = vars(model)
+    return([type(model).__name__, sorted(params.items())])
+
+
+class RunManifest:
+    def __init__(self, folder):
+        self.folder = folder
+        self.path = os.path.join(folder, 'manifest.json')
+        self.entries = dict()
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                self.entries = json.load(f)
+
+    def entryKey(self, name, features, grid, model, data_key):
+        key = [name, features, grid, modelKey(model), data_key]
+        return(hashlib.sha1(json.dumps(key, sort_keys=True, default=str)
+                            .encode()).hexdigest())
+
+    def done(self, key):
+        return(key in self.entries)
+
+    def record(self, key):
+        return(self.entries[key])
+
+    def complete(self, key, record):
+        self.entries[key] = dict(record, completed=time.time())
+        atomicWrite(self.path, lambda f: json.dump(self.entries, f,
+                                                   indent=1, default=float))
+
+    def checkpointFolder(self, key):
+        folder = os.path.join(self.folder, 'checkpoints', key)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        return(folder)
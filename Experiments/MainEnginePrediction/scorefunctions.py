@@ -0,0 +1,179 @@
+# # Scoring functions
+#
+# Batch scoring of a feature CSV with the preprocess pipeline and the model
+# artifacts saved by the regression loop. The file is read in chunks that a
+# pool of processes preprocesses and predicts. The per-row predictions are
+# spilled to disk partitioned by IMO and reduced one partition at a time, so
+# memory does not grow with the size of the file.
+
+import concurrent.futures
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from sklearn.pipeline import Pipeline
+
+from auxiliar_functions import GroupIndex
+from datafunctions import downcast, peakMemory
+from runfunctions import atomicWrite
+from storefunctions import loadArtifact
+
+
+# Steps whose input column is missing in the data are skipped, e.g. the log
+# of installedPowerME when scoring ships without it.
+def scoringPipeline(pipeline, columns):
+    columns = set(columns)
+    steps = []
+    for name, step in pipeline.steps:
+        inputColumn = getattr(step, 'inputColumn', None)
+        if inputColumn is not None and inputColumn not in columns:
+            continue
+        steps.append((name, step))
+        if getattr(step, 'outputColumn', None) is not None:
+            columns.add(step.outputColumn)
+    return(Pipeline(steps))
+
+
+# ## Chunk scorer
+#
+# models maps each output column to an artifact folder. The artifacts store
+# the feature list of their model; dummy columns missing in a chunk (ship
+# types not present in it) are zeros, as for the unseen types in training.
+
+class ChunkScorer:
+    def __init__(self, pipeline, models, group='imo'):
+        self.pipeline = pipeline
+        self.group = group
+        self.models = {col: loadArtifact(folder)
+                       for col, folder in models.items()}
+        for col, m in self.models.items():
+            if m.meta.get('features') is None:
+                raise ValueError("Artifact of {} has no feature list"
+                                 .format(col))
+
+    def score(self, chunk):
+        chunk = self.pipeline.transform(downcast(chunk))
+        out = {self.group: np.asarray(chunk[self.group], dtype=np.int64)}
+        for col, m in self.models.items():
+            features = m.meta['features']
+            X = np.zeros((len(chunk), len(features)), dtype=np.float32,
+                         order='F')
+            for j, feature in enumerate(features):
+                if feature in chunk.columns:
+                    X[:, j] = chunk[feature].values
+            out[col] = np.asarray(m.predict(X), dtype=np.float32)
+        return(out)
+
+
+# Every worker process builds its scorer once. The packed trees of the
+# artifacts are memory mapped, so the workers share them.
+scorer = None
+
+def initScorer(pipeline, models, group):
+    global scorer
+    scorer = ChunkScorer(pipeline, models, group)
+
+
+def scoreChunk(chunk):
+    return(scorer.score(chunk))
+
+
+# ## Partitioned spill
+#
+# Rows (group, one float32 per model, enough for log predictions) are
+# appended to npartitions binary files by group modulo npartitions: all the
+# rows of a ship end in the same partition.
+
+class PartitionSpill:
+    def __init__(self, folder, group, columns, npartitions=64):
+        self.folder = folder
+        self.group = group
+        self.npartitions = npartitions
+        self.dtype = np.dtype([(group, np.int64)] +
+                              [(col, np.float32) for col in columns])
+
+    def path(self, p):
+        return(os.path.join(self.folder, 'part{}.bin'.format(p)))
+
+    def append(self, out):
+        rows = np.empty(len(out[self.group]), dtype=self.dtype)
+        for col in self.dtype.names:
+            rows[col] = out[col]
+        part = rows[self.group] % self.npartitions
+        for p in np.unique(part):
+            with open(self.path(p), 'ab') as f:
+                f.write(rows[part == p].tobytes())
+
+    def partitions(self):
+        for p in range(self.npartitions):
+            if os.path.isfile(self.path(p)):
+                yield(np.fromfile(self.path(p), dtype=self.dtype))
+
+
+# Per-group median of the (log) predictions, back to the original scale
+def medianByGroup(rows, group, columns):
+    index = GroupIndex(rows[group])
+    res = {group: index.groups}
+    for col in columns:
+        res[col] = np.exp(index.aggregate(rows[col], 'median'))
+    return(pd.DataFrame(res))
+
+
+# ## Batch scoring
+#
+# Only usecols (the columns read in training) are parsed, so the Droper
+# drops the same rows. At most 2*n_jobs chunks are in flight, so a slow pool
+# does not make the reader load the whole file. Returns the per-group
+# predictions, also written to output (atomically) if given.
+
+def scoreFile(path, pipeline, models, usecols=None, output=None, group='imo',
+              chunksize=100000, n_jobs=1, npartitions=64, spill_folder=None,
+              verbose=True):
+    start_time = time.time()
+    header = pd.read_csv(path, nrows=0).columns
+    if usecols is not None:
+        header = [col for col in header if col in usecols]
+    pipeline = scoringPipeline(pipeline, header)
+
+    spill_folder = tempfile.mkdtemp(prefix='scoring-', dir=spill_folder)
+    spill = PartitionSpill(spill_folder, group, list(models), npartitions)
+    dtype = {'type': 'category'} if 'type' in header else None
+    reader = pd.read_csv(path, usecols=header, dtype=dtype,
+                         chunksize=chunksize)
+    nrows = 0
+    try:
+        with concurrent.futures.ProcessPoolExecutor(n_jobs,
+                initializer=initScorer,
+                initargs=(pipeline, models, group)) as pool:
+            pending = set()
+            for chunk in reader:
+                pending.add(pool.submit(scoreChunk, chunk))
+                if len(pending) >= 2*n_jobs:
+                    done, pending = concurrent.futures.wait(pending,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                    for d in done:
+                        out = d.result()
+                        nrows += len(out[group])
+                        spill.append(out)
+            for d in concurrent.futures.as_completed(pending):
+                out = d.result()
+                nrows += len(out[group])
+                spill.append(out)
+
+        res = pd.concat([medianByGroup(rows, group, list(models))
+                         for rows in spill.partitions()])
+    finally:
+        shutil.rmtree(spill_folder, ignore_errors=True)
+    res = res.sort_values(group).reset_index(drop=True)
+
+    if output is not None:
+        atomicWrite(output, lambda f: res.to_csv(f, index=False))
+    if verbose:
+        print("Scored {} rows of {} ships in {:.1f}s. Peak memory: {:.0f} MB"
+              .format(nrows, len(res), time.time() - start_time,
+                      peakMemory()))
+    return(res)
@@ -0,0 +1,543 @@
+# # Search functions
+#
+# Hyperparameter search over all the models of an experiment at once.
+
+import hashlib
+import json
+import os
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+import sklearn
+import sklearn.ensemble
+import sklearn.exceptions
+import sklearn.metrics
+
+from scipy.stats import rankdata
+from sklearn.model_selection import ParameterGrid
+
+from runfunctions import loadCheckpoint, loadRefit, saveCheckpoint, saveRefit
+
+try:
+    from sklearn.externals import joblib
+except ImportError:
+    import joblib
+
+
+# ## Search result
+#
+# Fitted search with the attributes of a refitted GridSearchCV that the
+# experiment scripts use (best_estimator_, best_params_, cv_results_). Any
+# other attribute (predict_proba, classes_...) comes from the best estimator.
+
+class SearchResult:
+    def __init__(self, best_estimator_, best_params_=None, cv_results_=None):
+        self.best_estimator_ = best_estimator_
+        self.best_params_ = best_params_
+        self.cv_results_ = cv_results_
+
+    def __getattr__(self, name):
+        if name.startswith('__') or name == 'best_estimator_':
+            raise AttributeError(name)
+        return(getattr(self.best_estimator_, name))
+
+    def predict(self, X):
+        return(self.best_estimator_.predict(X))
+
+    def score(self, X, y):
+        return(self.best_estimator_.score(X, y))
+
+
+# ## Cost model
+#
+# Rough relative cost of one fit, only used to order the tasks: the most
+# expensive ones are dispatched first so the cheap ones fill the gaps at the
+# end (longest processing time first).
+
+def fitCost(model, params, nrows, ncols):
+    p = model.get_params()
+    p.update(params)
+    ncols = max(ncols, 1)
+    if 'n_estimators' not in p: # Linear models and averages
+        return(float(nrows*ncols))
+
+    features = p.get('max_features')
+    if features == 'sqrt':
+        features = np.sqrt(ncols)
+    elif features == 'log2':
+        features = np.log2(ncols)
+    elif isinstance(features, float):
+        features = features*ncols
+    elif not isinstance(features, int): # None or 'auto' in regressors
+        features = ncols
+    depth = p.get('max_depth') or np.log2(max(nrows, 2))
+    return(float(nrows*max(features, 1)*depth*p['n_estimators']))
+
+
+# ## Estimator path
+#
+# A boosting model with n stages contains the models with fewer stages
+# (staged_predict) and a forest of n trees contains the forests made of its
+# first trees (with a fixed random_state the tree seeds are drawn in the same
+# order). Grid points that only differ in n_estimators are therefore fitted
+# once, with the largest value, and scored for every value.
+
+def reusesPath(model):
+    p = model.get_params()
+    if 'n_estimators' not in p or p.get('warm_start'):
+        return(False)
+    if hasattr(model, 'staged_predict'):
+        return(p.get('n_iter_no_change') is None)
+    return(isinstance(model, (sklearn.ensemble.RandomForestRegressor,
+                              sklearn.ensemble.RandomForestClassifier,
+                              sklearn.ensemble.ExtraTreesRegressor,
+                              sklearn.ensemble.ExtraTreesClassifier)))
+
+
+# Groups of grid point indices that share everything but n_estimators, with
+# their n_estimators values (None for points fitted on their own).
+def pathGroups(model, points):
+    if not reusesPath(model):
+        return([([i], None) for i in range(len(points))])
+    default = model.get_params()['n_estimators']
+    groups = dict()
+    for i, point in enumerate(points):
+        key = tuple(sorted((k, repr(v)) for k, v in point.items()
+                           if k != 'n_estimators'))
+        groups.setdefault(key, []).append(i)
+    return([(idx, [points[i].get('n_estimators', default) for i in idx]
+             if len(idx) > 1 else None) for idx in groups.values()])
+
+
+# Predictions of the forest made of the first 1, 2, ... trees
+def forestStages(model, X):
+    classifier = sklearn.base.is_classifier(model)
+    total = 0
+    for i, tree in enumerate(model.estimators_, 1):
+        if classifier:
+            total = total + tree.predict_proba(X)
+            yield model.classes_[np.argmax(total, axis=1)]
+        else:
+            total = total + tree.predict(X)
+            yield total/i
+
+
+# Scores (as model.score) of the model truncated to each value of path. A
+# boosting model that stopped early scores its last stage for the rest.
+def pathScores(model, X, y, path):
+    if sklearn.base.is_classifier(model):
+        metric = sklearn.metrics.accuracy_score
+    else:
+        metric = sklearn.metrics.r2_score
+    if hasattr(model, 'staged_predict'):
+        stages = model.staged_predict(X)
+    else:
+        stages = forestStages(model, X)
+
+    wanted = set(path)
+    scores = dict()
+    last = None
+    for n, pred in enumerate(stages, 1):
+        if n in wanted:
+            scores[n] = metric(y, pred)
+        last = pred
+    for n in wanted.difference(scores):
+        scores[n] = metric(y, last)
+    return([scores[n] for n in path])
+
+
+# ## Tasks
+
+# One task is one fit: a grid point on a fold (test is not None, returns the
+# fold score), a path of n_estimators values on a fold (path is not None,
+# returns one score per value) or a refit on all the training data (returns
+# the model). Fold results, and refitted models, are also saved to the
+# checkpoint file if given.
+#
+# As GridSearchCV with error_score=nan, a fold fit that fails scores NaN
+# (with a FitFailedWarning) instead of stopping the search; it is not
+# checkpointed, so a resumed run tries it again. Refits raise.
+def runTask(model, params, X, y, train=None, test=None, n_jobs=1, path=None,
+            checkpoint=None):
+    start_time = time.time()
+    try:
+        model = sklearn.base.clone(model).set_params(**params)
+        if path is not None:
+            model.set_params(n_estimators=max(path))
+        if 'n_jobs' in model.get_params():
+            model.set_params(n_jobs=n_jobs)
+
+        start_time = time.time()
+        if train is None:
+            model.fit(X, y)
+        else:
+            model.fit(X[train], y[train])
+        fit_time = time.time() - start_time
+
+        if test is None:
+            if checkpoint is not None:
+                saveRefit(checkpoint, model, fit_time, params)
+            return(model, fit_time, None)
+        if path is not None:
+            score = pathScores(model, X[test], y[test], path)
+        else:
+            score = model.score(X[test], y[test])
+    except Exception as e:
+        if test is None:
+            raise
+        warnings.warn("Fit failed with {}: {}: {}".format(
+                      params, type(e).__name__, e),
+                      sklearn.exceptions.FitFailedWarning)
+        score = [np.nan]*len(path) if path is not None else np.nan
+        return(None, time.time() - start_time, score)
+    if checkpoint is not None:
+        saveCheckpoint(checkpoint, fit_time, score)
+    return(None, fit_time, score)
+
+
+def runParallel(tasks, n_jobs, verbose=0):
+    order = sorted(range(len(tasks)), key=lambda i: -tasks[i]['cost'])
+    out = joblib.Parallel(n_jobs=n_jobs, batch_size=1, verbose=verbose)(
+        joblib.delayed(runTask)(**tasks[i]['args']) for i in order)
+    res = [None]*len(tasks)
+    for i, r in zip(order, out):
+        res[i] = r
+    return(res)
+
+
+# Results of the tasks, loaded from their checkpoints (fold scores or refitted
+# models) when they have one and run (runParallel) otherwise, and the number
+# of tasks loaded
+def runResumable(tasks, n_jobs, verbose=0):
+    res = [None]*len(tasks)
+    for i, t in enumerate(tasks):
+        args = t['args']
+        if args.get('test') is None:
+            saved = loadRefit(args.get('checkpoint'), args['params'])
+            if saved is not None:
+                res[i] = saved + (None,)
+        else:
+            saved = loadCheckpoint(args.get('checkpoint'))
+            if saved is not None:
+                res[i] = (None,) + saved
+    pending = [i for i in range(len(tasks)) if res[i] is None]
+    for i, r in zip(pending, runParallel([tasks[i] for i in pending],
+                                         n_jobs, verbose)):
+        res[i] = r
+    return(res, len(tasks) - len(pending))
+
+
+# Checkpoint file of a task of entry name (None without checkpoints)
+def checkpointPath(checkpoints, name, filename):
+    if checkpoints is None or name not in checkpoints:
+        return(None)
+    return(os.path.join(checkpoints[name], filename))
+
+
+# ## Flattened search
+#
+# entries maps a model name to a dict with 'model', 'grid' (or None), 'X' and
+# 'y'. Every (entry, grid point, fold) is one task and all of them share the
+# `n_jobs` cores, instead of one GridSearchCV(n_jobs=-1) per entry with nested
+# model parallelism. The best grid point of each entry (highest mean fold
+# score, first one on ties, as in GridSearchCV) is then refitted on the whole
+# training set. Points with a failed fold have a NaN mean score and are never
+# the best; an entry whose every point failed raises.
+#
+# With reuse_path, grid points that only differ in n_estimators share one fit
+# per fold (see pathGroups). Their scores are the ones of separate fits and
+# their fit times the shared one in proportion to n_estimators.
+#
+# checkpoints maps entry names to a folder where every finished fold and the
+# refitted model are saved. Folds and refits found there (from an
+# interrupted run) are not fitted again.
+#
+# Returns, per entry, the fitted model (a SearchResult for grid entries) and
+# its mean fit time, computed as in the sequential loop.
+
+def flatSearch(entries, cv, groups, n_jobs=-1, reuse_path=True,
+               checkpoints=None, verbose=0):
+    if n_jobs < 0:
+        n_jobs = joblib.cpu_count() + 1 + n_jobs
+
+    tasks = []
+    for name, e in entries.items():
+        if e['grid'] is None:
+            continue
+        X, y = e['X'], e['y']
+        folds = list(cv.split(X, y, groups))
+        e['points'] = list(ParameterGrid(e['grid']))
+        e['nfolds'] = len(folds)
+        if reuse_path:
+            paths = pathGroups(e['model'], e['points'])
+        else:
+            paths = [([i], None) for i in range(len(e['points']))]
+        for idx, path in paths:
+            point = e['points'][idx[0]]
+            if path is not None:
+                point = dict(point, n_estimators=max(path))
+            for f, (train, test) in enumerate(folds):
+                checkpoint = checkpointPath(checkpoints, name,
+                    'points{}-fold{}.json'.format(
+                    '_'.join(str(i) for i in idx), f))
+                tasks.append({'entry': name, 'points': idx, 'path': path,
+                    'fold': f,
+                    'cost': fitCost(e['model'], point, len(train), X.shape[1]),
+                    'args': dict(model=e['model'], params=point, X=X, y=y,
+                                 train=train, test=test, path=path,
+                                 checkpoint=checkpoint)})
+
+    start_time = time.time()
+    res, loaded = runResumable(tasks, n_jobs, verbose)
+    if verbose:
+        print("Cross-validation: {} fits in {:.1f}s ({} from checkpoints)"
+              .format(len(tasks) - loaded, time.time() - start_time, loaded))
+
+    for name, e in entries.items():
+        if e['grid'] is None:
+            continue
+        npoints, nfolds = len(e['points']), e['nfolds']
+        scores = np.full((npoints, nfolds), np.nan)
+        times = np.full((npoints, nfolds), np.nan)
+        for t, (_, fit_time, score) in zip(tasks, res):
+            if t['entry'] != name:
+                continue
+            if t['path'] is None:
+                scores[t['points'][0], t['fold']] = score
+                times[t['points'][0], t['fold']] = fit_time
+                continue
+            for i, n, sc in zip(t['points'], t['path'], score):
+                scores[i, t['fold']] = sc
+                times[i, t['fold']] = fit_time*n/max(t['path'])
+        e['cv_results'] = cvResults(e['points'], scores, times)
+        e['cv_results']['iter'] = np.zeros(npoints, dtype=int)
+        e['cv_results']['n_resources'] = np.repeat(e['X'].shape[0], npoints)
+        mean = e['cv_results']['mean_test_score']
+        if np.all(np.isnan(mean)):
+            raise ValueError("All the {} fits of {} failed".format(
+                             mean.size*nfolds, name))
+        e['best_params'] = e['points'][int(np.nanargmax(mean))]
+
+    return(refitEntries(entries, n_jobs, verbose, checkpoints))
+
+
+# Refit of the best grid point (or single fit) of every entry. The refits
+# split the core budget between them, and each one is saved (refit.joblib)
+# in the checkpoint folder of its entry as soon as it is fitted.
+def refitEntries(entries, n_jobs, verbose=0, checkpoints=None):
+    refits = []
+    cores = max(1, n_jobs//max(len(entries), 1))
+    for name, e in entries.items():
+        point = e['best_params'] if e['grid'] is not None else {}
+        refits.append({'entry': name,
+            'cost': fitCost(e['model'], point, *e['X'].shape),
+            'args': dict(model=e['model'], params=point, X=e['X'], y=e['y'],
+                         n_jobs=cores, checkpoint=checkpointPath(
+                             checkpoints, name, 'refit.joblib'))})
+
+    start_time = time.time()
+    res, loaded = runResumable(refits, n_jobs, verbose)
+    if verbose:
+        print("Refit: {} fits in {:.1f}s ({} from checkpoints)".format(
+              len(refits) - loaded, time.time() - start_time, loaded))
+
+    results = dict()
+    for t, (model, fit_time, _) in zip(refits, res):
+        e = entries[t['entry']]
+        if e['grid'] is None:
+            results[t['entry']] = {'model': model, 'mean_time': fit_time}
+        else:
+            cvr = e['cv_results']
+            # Fit time of the refit if no point was cross-validated
+            mean_time = np.mean(cvr['mean_fit_time']) \
+                        if len(cvr['params']) else fit_time
+            results[t['entry']] = {
+                'model': SearchResult(model, e['best_params'], cvr),
+                'mean_time': mean_time}
+    return(results)
+
+
+def cvResults(points, scores, times):
+    cvr = {'params': points,
+           'mean_fit_time': times.mean(axis=1),
+           'std_fit_time': times.std(axis=1),
+           'mean_test_score': scores.mean(axis=1),
+           'std_test_score': scores.std(axis=1)}
+    for f in range(scores.shape[1]):
+        cvr['split{}_test_score'.format(f)] = scores[:, f]
+    # Failed points (NaN) rank last
+    mean = cvr['mean_test_score']
+    cvr['rank_test_score'] = rankdata(-np.where(np.isnan(mean), -np.inf, mean),
+                                      method='min').astype(np.int32)
+    return(cvr)
+
+
+# ## Successive halving
+#
+# Budgeted alternative to the exhaustive grid. In every round the surviving
+# grid points of all the entries are evaluated together (same scheduler as
+# flatSearch) with a fraction of the resource, and only the best 1/factor of
+# each entry go on to the next round, which gets `factor` times more. The
+# search of an entry stops as soon as one point is left, which is refitted
+# without being cross-validated again (a grid with a single point is not
+# cross-validated at all).
+#
+# resource is either 'n_samples' (the training rows of a subset of the
+# groups, so folds stay group-aware) or 'n_estimators' (for ensembles, the
+# grid values of n_estimators are replaced by the round's share of the
+# largest one; entries without n_estimators use n_samples). budget is the
+# compute allowed per entry, in full fits (one fold fit with all the resource
+# counts as 1), spread evenly over the rounds as in budgeted successive
+# halving. Without budget the last round (the one that leaves one point) uses
+# the full resource and every previous one `factor` times less.
+#
+# The cv_results of each entry hold every evaluated point with its round
+# ('iter') and resource ('n_resources').
+#
+# checkpoints works as in flatSearch: fold scores are saved by round,
+# resource and grid point, and an interrupted search replays the rounds it
+# had finished from them (the choice of the survivors only depends on the
+# scores) and resumes at the first fit that is missing.
+
+def halvingSearch(entries, cv, groups, n_jobs=-1, factor=3,
+                  resource='n_samples', budget=None, random_state=0,
+                  checkpoints=None, verbose=0):
+    if n_jobs < 0:
+        n_jobs = joblib.cpu_count() + 1 + n_jobs
+    groups = np.asarray(groups)
+    ugroups = np.unique(groups)
+    ugroups = ugroups[np.random.RandomState(random_state).permutation(len(ugroups))]
+    nfolds = cv.get_n_splits()
+
+    for name, e in entries.items():
+        if e['grid'] is None:
+            continue
+        grid = dict(e['grid'])
+        e['resource'] = resource
+        if 'n_estimators' not in e['model'].get_params():
+            e['resource'] = 'n_samples' # e.g. Lasso
+        if e['resource'] == 'n_estimators':
+            e['max_resource'] = max(grid.pop('n_estimators',
+                                    [e['model'].get_params()['n_estimators']]))
+        else:
+            e['max_resource'] = len(ugroups)
+        e['candidates'] = list(ParameterGrid(grid))
+        e['rounds'] = 0
+        n = len(e['candidates'])
+        while n > 1:
+            n = int(np.ceil(n/factor))
+            e['rounds'] += 1
+        e['log'] = []
+        if len(e['candidates']) == 1:
+            e['best_params'] = dict(e['candidates'][0])
+            e['candidates'] = []
+
+    start_time = time.time()
+    step = 0
+    while any(e['grid'] is not None and len(e['candidates']) > 0
+              for e in entries.values()):
+        tasks = []
+        for name, e in entries.items():
+            if e['grid'] is None or len(e['candidates']) == 0:
+                continue
+            n = len(e['candidates'])
+            if budget is not None:
+                share = budget/(e['rounds']*n*nfolds)
+            else:
+                share = float(factor)**(step - e['rounds'] + 1)
+            amount = int(np.clip(np.ceil(share*e['max_resource']),
+                                 nfolds if e['resource'] == 'n_samples' else 1,
+                                 e['max_resource']))
+            e['amount'] = amount
+
+            X, y = e['X'], e['y']
+            if e['resource'] == 'n_samples':
+                rows = np.flatnonzero(np.isin(groups, ugroups[:amount]))
+                extra = {}
+            else:
+                rows = np.arange(len(y))
+                extra = {'n_estimators': amount}
+            folds = list(cv.split(X[rows], y[rows], groups[rows]))
+            for i, point in enumerate(e['candidates']):
+                point = dict(point, **extra)
+                digest = hashlib.sha1(json.dumps(point, sort_keys=True,
+                    default=str).encode()).hexdigest()[:16]
+                for f, (train, test) in enumerate(folds):
+                    checkpoint = checkpointPath(checkpoints, name,
+                        'halving{}-{}-{}-fold{}.json'.format(step, amount,
+                                                             digest, f))
+                    tasks.append({'entry': name, 'point': i, 'fold': f,
+                        'cost': fitCost(e['model'], point, len(train), X.shape[1]),
+                        'args': dict(model=e['model'], params=point, X=X, y=y,
+                                     train=rows[train], test=rows[test],
+                                     checkpoint=checkpoint)})
+
+        res, loaded = runResumable(tasks, n_jobs, verbose)
+
+        for name, e in entries.items():
+            if e['grid'] is None or len(e['candidates']) == 0:
+                continue
+            n = len(e['candidates'])
+            scores = np.full((n, nfolds), np.nan)
+            times = np.full((n, nfolds), np.nan)
+            for t, (_, fit_time, score) in zip(tasks, res):
+                if t['entry'] == name:
+                    scores[t['point'], t['fold']] = score
+                    times[t['point'], t['fold']] = fit_time
+            for i, point in enumerate(e['candidates']):
+                e['log'].append({'iter': step, 'n_resources': e['amount'],
+                                 'params': point, 'scores': scores[i],
+                                 'times': times[i]})
+            mean = scores.mean(axis=1)
+            order = np.argsort(-np.where(np.isnan(mean), -np.inf, mean),
+                               kind='mergesort')
+            keep = int(np.ceil(n/factor))
+            e['candidates'] = [e['candidates'][i] for i in order[:keep]]
+            if keep == 1:
+                e['best_params'] = dict(e['candidates'][0])
+                e['candidates'] = []
+        if verbose:
+            print("Halving round {}: {} fits in {:.1f}s ({} from checkpoints)"
+                  .format(step, len(tasks) - loaded, time.time() - start_time,
+                          loaded))
+        step += 1
+
+    for name, e in entries.items():
+        if e['grid'] is None:
+            continue
+        log = e['log']
+        points = [dict(l['params']) for l in log]
+        if e['resource'] == 'n_estimators':
+            for point, l in zip(points, log):
+                point['n_estimators'] = l['n_resources']
+            e['best_params']['n_estimators'] = e['max_resource']
+        e['cv_results'] = cvResults(points,
+                                    np.array([l['scores'] for l in log])
+                                      .reshape(len(log), nfolds),
+                                    np.array([l['times'] for l in log])
+                                      .reshape(len(log), nfolds))
+        for key in ['iter', 'n_resources']:
+            e['cv_results'][key] = np.array([l[key] for l in log])
+
+    return(refitEntries(entries, n_jobs, verbose, checkpoints))
+
+
+# Every configuration evaluated by a search, one row per grid point and round
+def searchLog(entries):
+    rows = []
+    for name, e in entries.items():
+        cvr = e.get('cv_results')
+        if cvr is None:
+            continue
+        nfolds = sum(key.endswith('_test_score') and key.startswith('split')
+                     for key in cvr)
+        for i, point in enumerate(cvr['params']):
+            rows.append({'model': name, 'iter': cvr['iter'][i],
+                         'n_resources': cvr['n_resources'][i],
+                         'params': point,
+                         'mean_test_score': cvr['mean_test_score'][i],
+                         'mean_fit_time': cvr['mean_fit_time'][i],
+                         'fit_time': cvr['mean_fit_time'][i]*nfolds})
+    return(pd.DataFrame(rows))
@@ -0,0 +1,229 @@
+# # Model store
+#
+# Compact artifacts for the fitted models. An artifact is a folder with:
+#
+# - model.joblib: the refitted best estimator alone (not the whole search),
+#   compressed.
+# - search.json: best parameters, fit time and cv_results of the search.
+# - trees/: for tree ensembles (RF, GB regressors), the nodes of all the trees
+#   packed in flat .npy arrays. sklearn copies the tree nodes when unpickling,
+#   so these arrays are what several scoring processes can share: they are
+#   opened memory mapped and predicted with `PackedEnsemble`.
+# - meta.json: model class, feature list, file sizes and save time.
+#
+# `Artifact` reads meta.json only and loads the rest on first use.
+
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import sklearn
+import sklearn.dummy
+import sklearn.ensemble
+
+try:
+    from sklearn.externals import joblib
+except ImportError:
+    import joblib
+
+
+# Plain JSON version of numpy values (cv_results hold arrays and numpy scalars)
+def jsonValue(o):
+    if hasattr(o, 'tolist'):
+        return(o.tolist())
+    return(str(o))
+
+
+def folderSizes(folder):
+    sizes = dict()
+    for root, _, files in os.walk(folder):
+        for name in files:
+            path = os.path.join(root, name)
+            sizes[os.path.relpath(path, folder)] = os.path.getsize(path)
+    return(sizes)
+
+
+# ## Tree packing
+#
+# The trees are concatenated: node i of tree t is packed node roots[t] + i and
+# the children point to packed nodes (-1 in leaves). Only what prediction
+# needs is kept: feature, threshold, children and the leaf value.
+#
+# predict = offset + scale * combine(leaf values of all trees), with combine
+# the mean (forests) or the sum (boosting).
+
+def ensembleTrees(model):
+    if isinstance(model, (sklearn.ensemble.RandomForestRegressor,
+                          sklearn.ensemble.ExtraTreesRegressor)):
+        return(list(model.estimators_), {'combine': 'mean', 'scale': 1.0,
+                                         'offset': 0.0})
+    if isinstance(model, sklearn.ensemble.GradientBoostingRegressor):
+        init = model.init_
+        if isinstance(init, sklearn.dummy.DummyRegressor):
+            offset = float(np.ravel(init.constant_)[0])
+        elif init == 'zero':
+            offset = 0.0
+        else: # Arbitrary init estimators are not constant
+            return(None, None)
+        return(list(model.estimators_[:, 0]),
+               {'combine': 'sum', 'scale': float(model.learning_rate),
+                'offset': offset})
+    return(None, None)
+
+
+def packTrees(trees, folder):
+    nodes = [t.tree_.node_count for t in trees]
+    roots = np.concatenate([[0], np.cumsum(nodes)[:-1]]).astype(np.int32)
+    arrays = {'feature': [], 'threshold': [], 'left': [], 'right': [],
+              'value': []}
+    for root, t in zip(roots, trees):
+        tree = t.tree_
+        leaf = tree.children_left < 0
+        arrays['feature'].append(np.where(leaf, 0, tree.feature))
+        arrays['threshold'].append(tree.threshold)
+        arrays['left'].append(np.where(leaf, -1, tree.children_left + root))
+        arrays['right'].append(np.where(leaf, -1, tree.children_right + root))
+        arrays['value'].append(tree.value[:, 0, 0])
+    feature = np.int16 if trees[0].tree_.n_features < 2**15 else np.int32
+    dtypes = {'feature': feature, 'threshold': np.float64, 'left': np.int32,
+              'right': np.int32, 'value': np.float64}
+
+    os.makedirs(folder)
+    np.save(os.path.join(folder, 'roots.npy'), roots)
+    for name, values in arrays.items():
+        np.save(os.path.join(folder, name + '.npy'),
+                np.concatenate(values).astype(dtypes[name]))
+
+
+class PackedEnsemble:
+    def __init__(self, folder, combine, scale, offset, mmap_mode='r'):
+        self.combine = combine
+        self.scale = scale
+        self.offset = offset
+        for name in ['roots', 'feature', 'threshold', 'left', 'right',
+                     'value']:
+            setattr(self, name, np.load(os.path.join(folder, name + '.npy'),
+                                        mmap_mode=mmap_mode))
+
+    # All the trees are walked together, one level per step, for batches of
+    # rows (batch_size row-tree pairs at a time). X is compared as float32,
+    # as sklearn trees do.
+    def predict(self, X, batch_size=2**22):
+        X = np.asarray(X, dtype=np.float32)
+        ntrees = len(self.roots)
+        rows = max(1, batch_size//ntrees)
+        pred = np.empty(X.shape[0])
+        for start in range(0, X.shape[0], rows):
+            Xb = X[start:start + rows]
+            nodes = np.tile(self.roots, len(Xb))
+            row = np.repeat(np.arange(len(Xb)), ntrees)
+            active = np.flatnonzero(self.left[nodes] >= 0)
+            while len(active) > 0:
+                node = nodes[active]
+                go_left = (Xb[row[active], self.feature[node]] <=
+                           self.threshold[node])
+                nodes[active] = np.where(go_left, self.left[node],
+                                         self.right[node])
+                active = active[self.left[nodes[active]] >= 0]
+            values = self.value[nodes].reshape(len(Xb), ntrees)
+            if self.combine == 'mean':
+                values = values.sum(axis=1)/ntrees
+            else:
+                values = values.sum(axis=1)
+            pred[start:start + rows] = self.offset + self.scale*values
+        return(pred)
+
+
+# ## Save and load
+
+# model is a fitted search (GridSearchCV or SearchResult) or a plain model.
+# features are the columns of its input matrix, in order (used to build it
+# when scoring). search holds extra metadata to store with it (e.g. the mean
+# fit time). The
+# artifact is written to a temporary folder and renamed, so it is complete or
+# missing, never partial.
+def saveArtifact(model, folder, features=None, search=None, compress=3,
+                 verbose=True):
+    start_time = time.time()
+    estimator = getattr(model, 'best_estimator_', model)
+    search = dict(search or {})
+    if hasattr(model, 'best_estimator_'):
+        search['best_params'] = model.best_params_
+        search['cv_results'] = model.cv_results_
+
+    tmp = folder + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    joblib.dump(estimator, os.path.join(tmp, 'model.joblib'),
+                compress=compress)
+    with open(os.path.join(tmp, 'search.json'), 'w') as f:
+        json.dump(search, f, default=jsonValue)
+
+    trees, packing = ensembleTrees(estimator)
+    if trees is not None:
+        packTrees(trees, os.path.join(tmp, 'trees'))
+
+    meta = {'model': type(estimator).__name__, 'features': features,
+            'packing': packing, 'save_time': time.time() - start_time}
+    meta['sizes'] = folderSizes(tmp)
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    shutil.rmtree(folder, ignore_errors=True)
+    os.rename(tmp, folder)
+
+    if verbose:
+        print("Saved {} ({}) in {:.1f}s: {:.1f} MB".format(
+              folder, meta['model'], meta['save_time'],
+              sum(meta['sizes'].values())/2**20))
+    return(meta)
+
+
+class Artifact:
+    def __init__(self, folder, mmap_mode='r'):
+        self.folder = folder
+        self.mmap_mode = mmap_mode
+        with open(os.path.join(folder, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self._estimator = None
+        self._predictor = None
+        self._search = None
+        self.load_times = dict()
+
+    @property
+    def estimator(self):
+        if self._estimator is None:
+            start_time = time.time()
+            self._estimator = joblib.load(os.path.join(self.folder,
+                                                       'model.joblib'))
+            self.load_times['estimator'] = time.time() - start_time
+        return(self._estimator)
+
+    # Packed trees when available, the estimator otherwise
+    @property
+    def predictor(self):
+        if self._predictor is None:
+            if self.meta['packing'] is None:
+                self._predictor = self.estimator
+            else:
+                start_time = time.time()
+                self._predictor = PackedEnsemble(
+                    os.path.join(self.folder, 'trees'),
+                    mmap_mode=self.mmap_mode, **self.meta['packing'])
+                self.load_times['predictor'] = time.time() - start_time
+        return(self._predictor)
+
+    @property
+    def search(self):
+        if self._search is None:
+            with open(os.path.join(self.folder, 'search.json')) as f:
+                self._search = json.load(f)
+        return(self._search)
+
+    def predict(self, X):
+        return(self.predictor.predict(X))
+
+
+def loadArtifact(folder, mmap_mode='r'):
+    return(Artifact(folder, mmap_mode))
@@ -0,0 +1,173 @@
+# # Synthetic data
+#
+# Deterministic AIS traces and IHS parameters of a made-up fleet, and the
+# regression dataset built from them (crbmdata.csv layout: imo, type,
+# installedPowerME, activations.N and the <col>delay..<col>1 history of
+# rotationGPS, sog and bathymetry3). The same seed gives the same data, so
+# benchmarks and end-to-end runs can be repeated at any scale:
+#
+#     python syntheticfunctions.py -n 1000 -l 500 -o synthetic
+#
+# writes synthetic/AIS.csv, synthetic/IHS.csv (tab separated, as
+# IHSTestData.csv) and synthetic/crbmdata.csv.
+#
+# Each ship has a type, which sets its installed main engine power (log
+# normal around the median of the type) and its speeds, so the models of the
+# regression loop have something to learn. Traces have a sample every 1 to
+# 10 minutes and, with probability gap_rate per sample, a gap of gap_length
+# seconds (uniform between the two values).
+
+import os
+
+from argparse import ArgumentParser
+
+import numpy as np
+import pandas as pd
+
+
+# Type: (median installedPowerME in kW, design speed in knots)
+ship_types = {'Bulk Carrier': (8000, 14), 'Container Ship': (25000, 22),
+              'Crude Oil Tanker': (14000, 15),
+              'General Cargo Ship': (3000, 12), 'Fishing Vessel': (800, 10),
+              'Passenger/Ro-Ro Cargo Ship': (15000, 20),
+              'Passenger (Cruise) Ship': (40000, 21)}
+
+
+# IHS parameters of nships ships (IHSTestData.csv columns used by the
+# emission estimation)
+def syntheticIHS(nships, types=ship_types, seed=0):
+    rng = np.random.RandomState(seed)
+    names = np.array(list(types))
+    type_ = rng.randint(len(names), size=nships)
+    power, speed = np.array([types[name] for name in names]).T
+    ihs = pd.DataFrame({
+        'LRIMOShipNO': 9000001 + np.arange(nships),
+        'type': names[type_],
+        'installedPowerME': (power[type_] *
+                             rng.lognormal(0, 0.3, nships)).round(),
+        'designSpeed': (speed[type_] + rng.normal(0, 1, nships)).round(1),
+        'n_installed_me': rng.choice([1, 1, 1, 2, 4], nships)})
+    ihs['installedPowerAE'] = (ihs['installedPowerME'] *
+                               rng.uniform(0.05, 0.2, nships)).round()
+    ihs['MainEngineRPM'] = np.where(ihs['installedPowerME'] > 10000,
+                                    rng.choice([80, 100, 120], nships),
+                                    rng.choice([500, 750, 1000], nships))
+    ihs['AuxiliaryEngineRPM'] = rng.choice([720, 900, 1800], nships)
+    return(ihs)
+
+
+# Random walks of steps N(0, scale) starting at 0 at every ship
+def shipWalk(rng, scale, starts, lengths):
+    walk = np.cumsum(rng.normal(0, scale, lengths.sum()))
+    return(walk - np.repeat(walk[starts], lengths))
+
+
+# AIS samples (imo, fechahora, latitude, longitude, sog, rotationGPS,
+# bathymetry3) of the ships of ihs, mean_length samples per ship on average,
+# sorted by ship and time
+def syntheticAIS(ihs, mean_length=200, gap_rate=0.01,
+                 gap_length=(3600, 86400), seed=0):
+    rng = np.random.RandomState(seed + 1)
+    nships = len(ihs)
+    lengths = np.maximum(rng.poisson(mean_length, nships), 1)
+    ship = np.repeat(np.arange(nships), lengths)
+    n = len(ship)
+    starts = np.r_[0, np.cumsum(lengths)[:-1]]
+
+    # Time: a random start in the first day, then steps and some gaps
+    steps = rng.randint(60, 601, n)
+    gaps = rng.uniform(size=n) < gap_rate
+    steps[gaps] = rng.randint(gap_length[0], gap_length[1] + 1, gaps.sum())
+    steps[starts] = 0
+    time = np.cumsum(steps)
+    time += np.repeat(rng.randint(0, 86400, nships) - time[starts], lengths)
+
+    # Speed: a fraction of the design speed that changes slowly, with stops
+    design = ihs['designSpeed'].values[ship]
+    load = np.clip(0.75 + shipWalk(rng, 0.05, starts, lengths), 0, 1.1)
+    sog = np.where(rng.uniform(size=n) < 0.1, 0, design*load).round(1)
+    rotation = rng.normal(0, 2, n).round(3)
+    lat = rng.uniform(30, 45, nships)[ship] + \
+          shipWalk(rng, 0.01, starts, lengths)
+    lon = rng.uniform(-10, 20, nships)[ship] + \
+          shipWalk(rng, 0.01, starts, lengths)
+    bathymetry = np.clip(rng.normal(-2000, 1500, nships)[ship] +
+                         rng.normal(0, 50, n), None, -5).round()
+    return(pd.DataFrame({'imo': ihs['LRIMOShipNO'].values[ship],
+                         'fechahora': time, 'latitude': lat,
+                         'longitude': lon, 'sog': sog,
+                         'rotationGPS': rotation,
+                         'bathymetry3': bathymetry}))
+
+
+# Regression dataset of the samples with at least delay previous samples of
+# their ship: history columns <col>delay..<col>1 (<col>1 the oldest, as
+# historyfunctions.py) and n_hidden activations that depend on the recent
+# speed and the power, plus noise
+def syntheticDataset(ais, ihs, delay=10, n_hidden=10,
+                     datacols=('rotationGPS', 'sog', 'bathymetry3'), seed=0):
+    rng = np.random.RandomState(seed + 2)
+    codes = pd.factorize(ais['imo'])[0]
+    position = np.arange(len(ais)) - np.searchsorted(codes, codes)
+    rows = np.flatnonzero(position >= delay - 1)
+    res = {'imo': ais['imo'].values[rows]}
+    params = ihs.set_index('LRIMOShipNO').loc[res['imo']]
+    res['type'] = params['type'].values
+    res['installedPowerME'] = params['installedPowerME'].values
+    for col in datacols:
+        values = ais[col].values
+        for lag in range(delay):
+            res['{}{}'.format(col, delay - lag)] = values[rows - lag]
+    speed = ais['sog'].values[rows]
+    logpower = np.log(res['installedPowerME'])
+    weights = rng.normal(size=(2, n_hidden))
+    activations = 1/(1 + np.exp(-(np.outer(speed/10 - 1, weights[0]) +
+                                  np.outer(logpower - 9, weights[1]) +
+                                  rng.normal(0, 0.5, (len(rows), n_hidden)))))
+    for i in range(n_hidden):
+        res['activations.{}'.format(i + 1)] = activations[:, i]
+    return(pd.DataFrame(res))
+
+
+# AIS, IHS and regression dataset of nships ships
+def syntheticFleet(nships, mean_length=200, types=ship_types, gap_rate=0.01,
+                   gap_length=(3600, 86400), delay=10, n_hidden=10, seed=0):
+    ihs = syntheticIHS(nships, types, seed)
+    ais = syntheticAIS(ihs, mean_length, gap_rate, gap_length, seed)
+    return(ais, ihs, syntheticDataset(ais, ihs, delay, n_hidden, seed=seed))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-n", "--nships", type=int, default=1000,
+            help = "Number of ships. Default 1000.")
+    parser.add_argument("-l", "--mean_length", type=int, default=200,
+            help = "Mean samples per ship. Default 200.")
+    parser.add_argument("-g", "--gap_rate", type=float, default=0.01,
+            help = "Probability of a gap after each sample. Default 0.01.")
+    parser.add_argument("--gap_length", default="3600,86400",
+            help = "Shortest and longest gap in seconds. Default 3600,86400.")
+    parser.add_argument("-d", "--delay", type=int, default=10,
+            help = "History length of the regression dataset. Default 10.")
+    parser.add_argument("--n_hidden", type=int, default=10,
+            help = "Activation columns. Default 10.")
+    parser.add_argument("-s", "--seed", type=int, default=0,
+            help = "Seed. Default 0.")
+    parser.add_argument("-o", "--output_folder", metavar="FOLDER",
+            default="synthetic",
+            help = "Output folder. Default: synthetic.")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.output_folder):
+        os.makedirs(args.output_folder)
+    ais, ihs, dataset = syntheticFleet(
+        args.nships, args.mean_length, gap_rate=args.gap_rate,
+        gap_length=[int(x) for x in args.gap_length.split(",")],
+        delay=args.delay, n_hidden=args.n_hidden, seed=args.seed)
+    ais.to_csv(os.path.join(args.output_folder, "AIS.csv"), index=False)
+    ihs.to_csv(os.path.join(args.output_folder, "IHS.csv"), sep="\t",
+               index=False)
+    dataset.to_csv(os.path.join(args.output_folder, "crbmdata.csv"),
+                   index=False)
+    print("{} ships, {} AIS samples, {} dataset rows written to {}".format(
+          len(ihs), len(ais), len(dataset), args.output_folder))
@@ -23,14 +23,28 @@ import pdb
 from sklearn.model_selection import GridSearchCV
 from sklearn.metrics import confusion_matrix
 import os
+import sys
+import time
+
+sys.path.append("../MainEnginePrediction")
+from datafunctions import cachedDataset, sharedArray
+from searchfunctions import halvingSearch, searchLog
+from sklearn.model_selection import GroupKFold
+
+###### Search mode: "grid" (exhaustive GridSearchCV) or "halving" #########
+# Successive halving evaluates the grids on growing subsets of ships (groups
+# by IMO when the data has it) within `budget` full fits per model, or with
+# the default schedule if it is None.
+search = "grid"
+budget = None
 
 os.makedirs("resultsfinal")
 os.makedirs("resultsfinal/predictions")
-###### Load the data #########
-train = pd.read_csv("data/train_AIS.csv");
-test = pd.read_csv("data/test_AIS.csv");
-train_crbm = pd.read_csv("data/train_crbm_AIS.csv");
-test_crbm = pd.read_csv("data/test_crbm_AIS.csv");
+###### Load the data (parsed once, then read from data/.cache) #########
+train = cachedDataset("data/train_AIS.csv");
+test = cachedDataset("data/test_AIS.csv");
+train_crbm = cachedDataset("data/train_crbm_AIS.csv");
+test_crbm = cachedDataset("data/test_crbm_AIS.csv");
 
 ######### encoding class names as integers  from 0 to C-1 for C classes  #########
 encoder = LabelEncoder()
@@ -79,6 +93,8 @@ results_acc = {"original_features":{"train":{}, "test":{}},
                "hist_features":{"train":{}, "test":{}},
                "crbm_features":{"train":{}, "test":{}}}
 
+results_time = {"original_features":{}, "hist_features":{}, "crbm_features":{}}
+
 results_auc = {"original_features":{"train":{}, "test":{}},
                "hist_features":{"train":{}, "test":{}},
                "crbm_features":{"train":{}, "test":{}}}
@@ -97,11 +113,36 @@ data_splits = (("original_features", X_tr, y_tr, X_te, y_te),
                ("hist_features", X_tr_hist, y_tr, X_te_hist, y_te),
                ("crbm_features", X_tr_crbm,y_tr_crbm, X_te_crbm, y_te_crbm))
 
+###### Groups (ships) of each training set, used by the halving search #########
+# The split must stay group-aware: without imo the folds would mix the
+# samples of a ship between train and validation.
+def ship_groups(df):
+    if "imo" not in df.columns:
+        raise ValueError("The training set has no imo column to group the "
+                         "cross-validation folds by ship")
+    return np.array(df["imo"])
+
+groups_tr = {"original_features": ship_groups(train),
+             "hist_features": ship_groups(train),
+             "crbm_features": ship_groups(train_crbm)}
+
 ###### We can add a grid and make model=grid to do grid search #########
 grid_params = {"LogisticRegression":{ "C":[0.8, 0.9, 1, 1.1, 1.2] },
                 "MLPClassifier":{"hidden_layer_sizes":[(100,), (200,), (300,), (400,), (500,)]},
                 "KNeighborsClassifier":{"n_neighbors":[5, 10, 15]} }
 
+###### Predictions are computed once per split and memoized #########
+# When the model has predict_proba the labels are its argmax, so e.g. the
+# KNN neighbour search runs once for both.
+def predict_split(model, X):
+    if hasattr(model, "predict_proba"):
+        proba = model.predict_proba(X)
+        pred = model.classes_[np.argmax(proba, axis=1)]
+    else:
+        proba = None
+        pred = model.predict(X)
+    return {"pred": pred, "proba": proba}
+
 ###### Train the different models #########
 for modelname,current_model in models:
     g_params = grid_params[modelname]
@@ -109,33 +150,57 @@ for modelname,current_model in models:
     
     for dataname, Xtr, ytr, Xte, yte in data_splits:
         print("\n\t\tWorking with data: ", dataname, " shape of Xtr", Xtr.shape)
-        model = sklearn.model_selection.GridSearchCV(current_model, g_params, n_jobs=-1)
-        model.fit(Xtr, ytr)
-        
-        results_acc[dataname]["train"][modelname] = accuracy(model.predict(Xtr), ytr)
-        results_acc[dataname]["test"][modelname] = accuracy(model.predict(Xte), yte)
+        timing = {}
+        # GridSearchCV workers share the memory mapped copy
+        Xtr = sharedArray(Xtr, "resultsfinal/memmap", modelname + "_" + dataname)
+        start = time.time()
+        if search == "halving":
+            entries = {modelname: {"model": current_model, "grid": g_params,
+                                   "X": Xtr, "y": ytr}}
+            model = halvingSearch(entries, GroupKFold(5), groups_tr[dataname],
+                                  n_jobs=-1, budget=budget)[modelname]["model"]
+            searchLog(entries).to_csv('./resultsfinal/search_log_' + modelname + "_" + dataname + '.csv', index=False)
+        else:
+            model = sklearn.model_selection.GridSearchCV(current_model, g_params, n_jobs=-1)
+            model.fit(Xtr, ytr)
+        timing["fit"] = time.time() - start
+
+        start = time.time()
+        tr = predict_split(model, Xtr)
+        timing["predict_train"] = time.time() - start
+        start = time.time()
+        te = predict_split(model, Xte)
+        timing["predict_test"] = time.time() - start
+
+        start = time.time()
+        results_acc[dataname]["train"][modelname] = accuracy(tr["pred"], ytr)
+        results_acc[dataname]["test"][modelname] = accuracy(te["pred"], yte)
         cv_results = pd.DataFrame(model.cv_results_)
         cv_results.to_json('./resultsfinal/resultsfinal_cv_' + modelname + "_" + dataname +'.json')
         print("\t\tBest model of the grid selected. Results in train and test saved")
 
-        conf_mat_tr = confusion_matrix(ytr, model.predict(Xtr))
-        conf_mat_te = confusion_matrix(yte, model.predict(Xte))
+        conf_mat_tr = confusion_matrix(ytr, tr["pred"])
+        conf_mat_te = confusion_matrix(yte, te["pred"])
 
         pd.DataFrame(conf_mat_tr).to_csv('./resultsfinal/predictions/conf_mat_tr_' + modelname + "_" + dataname +'.json')
         pd.DataFrame(conf_mat_te).to_csv('./resultsfinal/predictions/conf_mat_te_' + modelname + "_" + dataname +'.json')
         print("\t\tConfusion Matrix saved")
 
-        pd.DataFrame(model.predict(Xtr)).to_csv('./resultsfinal/predictions/y_tr_hat_' + modelname + "_" + dataname +'.json')
-        pd.DataFrame(model.predict(Xte)).to_csv('./resultsfinal/predictions/y_te_hat_' + modelname + "_" + dataname +'.json')
+        pd.DataFrame(tr["pred"]).to_csv('./resultsfinal/predictions/y_tr_hat_' + modelname + "_" + dataname +'.json')
+        pd.DataFrame(te["pred"]).to_csv('./resultsfinal/predictions/y_te_hat_' + modelname + "_" + dataname +'.json')
         print("\t\tModel predictions saved")
         
-        auc_tr = sklearn.metrics.f1_score(ytr, model.predict(Xtr), average="weighted")
-        auc_te = sklearn.metrics.f1_score(yte, model.predict(Xte), average="weighted")
+        auc_tr = sklearn.metrics.f1_score(ytr, tr["pred"], average="weighted")
+        auc_te = sklearn.metrics.f1_score(yte, te["pred"], average="weighted")
         pd.DataFrame({"train": [auc_tr], "test": [auc_te]}).to_csv('./resultsfinal/predictions/f1_weighted' + modelname + "_" + dataname +'.json')
+        timing["metrics_and_writes"] = time.time() - start
+        results_time[dataname][modelname] = timing
         print("\t\tData saved for: ", dataname)
+        print("\t\tTime per phase (s):", timing)
         del(model)
 
 
 ###### Train the different models #########
 final_results = pd.DataFrame(results_acc)
 final_results.to_json("./resultsfinal/all_results.json")
+pd.DataFrame(results_time).to_json("./resultsfinal/all_timings.json")
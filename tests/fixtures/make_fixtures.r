@@ -0,0 +1,92 @@
+#' # R fixtures
+#'
+#' Writes the outputs of the R functions that the Python versions are tested
+#' against (tests/test_rparity.py), for the inputs in this folder:
+#'
+#' * ships.csv: six synthetic ships (two no longer than the delay, one with
+#'   a gap of two days) and four samples without IMO.
+#' * ihs.txt: their IHS parameters (one without MainEngineRPM).
+#'
+#' Needs rrbm (https://github.com/josepllberral/machine-learning-tools), zoo,
+#' data.table and DBI. Run it from this folder with `Rscript make_fixtures.r`
+#' and commit what it writes:
+#'
+#' * crbm/: a small CRBM trained with train.crbm, written by export_crbm.
+#' * activations-R.csv: imo, row (position of the sample in its ship) and
+#'   activations.* of predict_simulation, as R returns them for each ship.
+#' * history-R.csv: generate_window_data with a delay of 5.
+#' * interpolation-R.csv: imo and fillSerieLinearly every 10 seconds.
+#' * emissions-R.csv: estimateEmissions with an interpolation of 10 seconds.
+
+library(rrbm)
+
+fixtures <- getwd()
+delay <- 5
+datacols <- c("rotationGPS", "sog", "bathymetry3")
+id_var <- "imo"
+
+dataset <- read.table("ships.csv", header = T, sep = ",")
+targets <- sort(unique(dataset$imo[dataset$imo != 0]))
+
+source("../../DatasetGeneration/CRBM-tools.r")
+
+#' ## Activations
+#'
+#' The CRBM is trained on the ships with a full window only.
+
+series <- generate_data(targets, datacols)
+trained <- unlist(series$seqlen) > delay
+batchdata <- do.call("rbind", series$batchdata[trained])
+
+set.seed(1234)
+crbm <- train.crbm(batchdata, unlist(series$seqlen[trained]),
+                   learning_rate = 1e-3, training_epochs = 5,
+                   batch_size = 20, n_hidden = 4, delay = delay,
+                   momentum = 0.1)
+export_crbm(crbm, "crbm")
+
+activations <- lapply(seq_along(targets), function(i) {
+    act <- predict_simulation(crbm, series$batchdata[[i]])$activation
+    n <- nrow(series$batchdata[[i]])
+    data.frame(imo = targets[i], row = (n - nrow(act) + 1):n,
+               activations = act)
+})
+write.table(do.call("rbind", activations), "activations-R.csv", sep = ",",
+            row.names = F)
+
+#' ## History
+#'
+#' Ships shorter than the delay are left out (R gives rows of NA for them).
+
+ship_list <- split(dataset, dataset$imo)
+ship_list['0'] <- NULL
+ship_list <- ship_list[sapply(ship_list, nrow) >= delay]
+historyDataset <- lapply(ship_list, generate_window_data, width = delay,
+                         datacols = datacols)
+historyDataset <- do.call("rbind", historyDataset)
+write.table(historyDataset, "history-R.csv", sep = ",", row.names = F)
+
+#' ## Interpolation and emissions
+#'
+#' The emission scripts source their tools relative to EmissionModeling.
+
+setwd("../../EmissionModeling")
+source("emissions.R")
+
+traces <- lapply(targets, function(imo) {
+    serie <- dataset[dataset$imo == imo, ]
+    cbind(imo = imo,
+          fillSerieLinearly(serie, "fechahora",
+                            c("latitude", "longitude", "sog"),
+                            sampleTime = 10))
+})
+
+IHSData <- read.table(file = file.path(fixtures, "ihs.txt"), sep = "\t",
+                      header = TRUE)
+IHSData$MainEngineRPM[is.na(IHSData$MainEngineRPM)] <- 514  # Jalkanen 2009
+emissions <- estimateEmissions(dataset, IHSData, NULL, interpolation = 10)
+
+setwd(fixtures)
+write.table(do.call("rbind", traces), "interpolation-R.csv", sep = ",",
+            row.names = F)
+write.table(emissions, "emissions-R.csv", sep = ",", row.names = F)
@@ -0,0 +1,45 @@
+# # AR baseline tests
+#
+# The batched VAR fits of arfunctions.py against one np.linalg.lstsq fit per
+# ship and grid point (testtools.referenceShip).
+
+import numpy as np
+import pandas as pd
+
+from testtools import referenceShip, shipTraces
+
+from arfunctions import bestModels, fitShips, shipSeries, variables
+
+
+def test_fits():
+    orders, means = (1, 2), (0, 1)
+    data = shipTraces(100, 100)
+    grid = fitShips(data, variables, orders, means, verbose=False)
+    ids, X, offsets = shipSeries(data)
+    row = 0
+    for i in range(len(ids)):
+        x = X[offsets[i]:offsets[i + 1]]
+        for m in means:
+            for order in orders:
+                expected = referenceShip(x, order, max(orders), m).ravel()
+                res = grid.iloc[row, 3:3 + len(expected)].values \
+                          .astype(np.float64)
+                assert np.allclose(res, expected, rtol=1e-6, atol=1e-12,
+                                   equal_nan=True), (ids[i], order, m)
+                row += 1
+
+
+# Orders with no more rows than parameters fit exactly: no model, and never
+# the best one of the ship
+def test_short_ships():
+    rng = np.random.RandomState(1)
+    data = pd.concat([pd.DataFrame(rng.normal(size=(n, 3)), columns=variables)
+                      .assign(imo=n) for n in [2, 4, 6, 8, 9, 20]],
+                     ignore_index=True)
+    grid = fitShips(data, orders=(1, 2), means=(1,), verbose=False)
+    rows = grid['id'].values - 2
+    assert grid.loc[rows <= 3*grid['ar'], 'score'].isna().all()
+    assert grid.loc[rows > 3*grid['ar'], 'score'].notna().all()
+    best = bestModels(grid).set_index('id')
+    assert best.loc[8, 'ar'] == 1 and best.loc[8, 'score'] > 0
+    assert np.isnan(best.loc[4, 'score'])
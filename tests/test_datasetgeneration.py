@@ -0,0 +1,70 @@
+# # Dataset generation tests
+#
+# History, activation and phase datasets of DatasetGeneration against the
+# literal ports of CRBM-tools.r (testtools.py).
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from testtools import (crbmSeries, randomCRBM, referenceActivations,
+                       referencePhases, referenceWindowData)
+
+from crbmfunctions import crbmActivations, normalizeShips
+from historyfunctions import compareHistory, historyDataset, sortShips
+from phasefunctions import nearestCentroids, validActivations
+
+
+datacols = ['rotationGPS', 'sog', 'bathymetry3']
+
+
+# Ships of 1 to 30 samples in random order, with an extra column and
+# samples without IMO
+def historyShips(nships=8, seed=0):
+    values, codes = crbmSeries(nships, 15, len(datacols), seed)
+    dataset = pd.DataFrame(values, columns=datacols)
+    dataset.insert(0, 'imo', codes + 9000001)
+    dataset['fechahora'] = np.arange(len(dataset))
+    dataset.loc[dataset.index[::17], 'imo'] = 0
+    return dataset.sample(frac=1, random_state=seed)
+
+
+@pytest.mark.parametrize('delay', [1, 5, 20])
+def test_history(delay):
+    dataset = sortShips(historyShips())
+    expected = [referenceWindowData(serie.reset_index(drop=True), delay,
+                                    datacols)
+                for _, serie in dataset.groupby('imo', sort=True)
+                if len(serie) >= delay]
+    res = historyDataset(dataset, delay, datacols)
+    assert compareHistory(res, pd.concat(expected, ignore_index=True))
+
+
+@pytest.mark.parametrize('delay', [1, 5, 20])
+def test_activations(delay):
+    crbm = randomCRBM(delay=delay)
+    values, codes = crbmSeries(20, 30)
+    norm = normalizeShips(values, codes)[0]
+    act = crbmActivations(crbm, norm, codes, normalized=True)
+    for c in np.unique(codes):
+        rows = np.flatnonzero(codes == c)
+        if len(rows) <= delay:
+            # Ships without any full window, as predict_simulation
+            assert np.all(act[rows] == -1)
+            continue
+        assert np.allclose(act[rows], referenceActivations(crbm, norm[rows]),
+                           rtol=1e-10, equal_nan=True)
+
+
+@pytest.mark.parametrize('method', ['brute', 'kdtree'])
+def test_phases(method):
+    rng = np.random.RandomState(0)
+    X = rng.uniform(size=(2000, 10))
+    X[::13] = np.nan
+    X[::29] = -1
+    centers = rng.uniform(size=(7, 10))
+    rows = validActivations(X)
+    labels = nearestCentroids(X, centers, method)
+    assert np.array_equal(labels[rows], referencePhases(X[rows], centers))
+    # Rows without activations get no phase
+    assert np.all(labels[~rows] == -1)
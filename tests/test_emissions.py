@@ -0,0 +1,74 @@
+# # Emission modeling tests
+#
+# The fleet versions of EmissionModeling against the literal ports of the R
+# functions (testtools.py).
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from testtools import (compareTraces, fleetData, referenceEmissions,
+                       referenceFillSerie, referenceNOxFactor,
+                       referenceScenarios, weekTraces)
+
+from emissionfunctions import (calcNOxEmissionFactor, compareEmissions,
+                               estimateEmissions)
+from interpolationfunctions import interpolateShips
+from scenariofunctions import estimateScenarios
+
+
+def test_nox_factor():
+    rpm = np.array([80, 129.9, 130, 500, 1999, 2000, 2500, 0, -1])
+    expected = [referenceNOxFactor(n) for n in rpm]
+    assert np.allclose(calcNOxEmissionFactor(rpm), expected, rtol=1e-12)
+
+
+@pytest.mark.parametrize('sampleGranularity,unit', [(1, 'g'), (10, 'g'),
+                                                    (10, 'kg'), (1, 't')])
+def test_emissions(sampleGranularity, unit):
+    ais, ihs = fleetData(20, 100)
+    res = estimateEmissions(ais, ihs, sampleGranularity=sampleGranularity,
+                            unit=unit, verbose=False)[0]
+    expected = referenceEmissions(ais, ihs, res['shipIMO'].unique(),
+                                  sampleGranularity, unit)
+    assert compareEmissions(res, expected)
+
+
+# Ships with missing parameters get no emissions and an error
+def test_emissions_missing_parameters():
+    ais, ihs = fleetData(5, 50)
+    ihs.loc[1, 'MainEngineRPM'] = np.nan
+    res, _, errors = estimateEmissions(ais, ihs, verbose=False)
+    assert ihs.loc[1, 'LRIMOShipNO'] not in set(res['shipIMO'])
+    assert ihs.loc[1, 'LRIMOShipNO'] in set(errors['shipIMO'])
+
+
+@pytest.mark.parametrize('sampleTime,maxTimeGap', [(1, 24*60*60),
+                                                   (10, 24*60*60),
+                                                   (60, 3600)])
+def test_interpolation(sampleTime, maxTimeGap):
+    ais = weekTraces(3)
+    # Repeated times and missing values, as raw AIS
+    ais = pd.concat([ais, ais.iloc[::97]], ignore_index=True)
+    ais.loc[ais.index[::53], 'sog'] = np.nan
+    traces = dict(interpolateShips(ais, sampleTime=sampleTime,
+                                   maxTimeGap=maxTimeGap))
+    for imo, serie in ais.groupby('imo', sort=False):
+        expected = referenceFillSerie(serie, sampleTime=sampleTime,
+                                      maxTimeGap=maxTimeGap)[0]
+        assert compareTraces(traces[imo], expected)
+
+
+def test_scenarios():
+    nships = 20
+    ais = weekTraces(nships)
+    ihs = fleetData(nships)[1]
+    rng = np.random.RandomState(0)
+    real = ihs.set_index('LRIMOShipNO')['installedPowerME']
+    power = pd.DataFrame({name: real*rng.uniform(0.5, 1.5, nships)
+                          for name in ['act', 'his', 'avg']})
+    power.insert(0, 'rea', real)
+    results = estimateScenarios(ais, ihs, power, interpolation=60,
+                                verbose=False)[0]
+    expected = referenceScenarios(ais, ihs, power, interpolation=60)
+    assert np.allclose(results.values, expected.values, rtol=1e-10, atol=0)
@@ -0,0 +1,83 @@
+# # R parity tests
+#
+# The Python versions against the outputs of the R code itself, written by
+# fixtures/make_fixtures.r for the inputs in fixtures/ (the other tests use
+# the Python ports of testtools.py). The tests of the outputs that have not
+# been generated are skipped.
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from testtools import compareTraces
+
+from crbmfunctions import (activationDataset, compareActivations, loadCRBM,
+                           shipTailRows)
+from emissionfunctions import (compareEmissions, estimateEmissions, readAIS,
+                               readIHS)
+from historyfunctions import compareHistory, historyDataset
+from interpolationfunctions import interpolateShips
+from tracefunctions import readShips
+
+
+fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'fixtures')
+datacols = ['rotationGPS', 'sog', 'bathymetry3']
+delay = 5
+
+
+def fixture(name):
+    path = os.path.join(fixtures, name)
+    if not os.path.exists(path):
+        pytest.skip("{} not generated (Rscript make_fixtures.r in "
+                    "tests/fixtures)".format(name))
+    return path
+
+
+# R gives a row per sample of each ship, or leaves out the first ones (the
+# samples without a full history, NaN in Python); rows says which.
+def test_activations():
+    crbm = loadCRBM(fixture('crbm'))
+    expected = pd.read_csv(fixture('activations-R.csv'))
+    ships = readShips(fixture('ships.csv'))
+    res = activationDataset(ships[ships['imo'] != 0], crbm, datacols)
+    assert crbm.delay == delay
+
+    starts = res.reset_index().groupby('imo')['index'].min()
+    rows = starts.loc[expected['imo']].values + expected['row'].values - 1
+    assert np.array_equal(shipTailRows(res['imo'].values,
+                                       expected['imo'].values), rows)
+    columns = ['activations.{}'.format(i + 1) for i in range(crbm.n_hidden)]
+    act = res[columns].values
+    assert compareActivations(act[rows], expected[columns].values)
+    # Every sample with a full history is compared
+    full = ~np.isnan(act).any(axis=1)
+    assert np.isin(np.flatnonzero(full), rows).all()
+
+
+def test_history():
+    expected = pd.read_csv(fixture('history-R.csv'))
+    res = historyDataset(readShips(fixture('ships.csv')), delay, datacols)
+    assert compareHistory(res, expected)
+
+
+def test_interpolation():
+    expected = pd.read_csv(fixture('interpolation-R.csv'))
+    ships = readShips(fixture('ships.csv'))
+    traces = dict(interpolateShips(ships[ships['imo'] != 0], sampleTime=10))
+    assert sorted(traces) == sorted(expected['imo'].unique())
+    for imo, trace in expected.groupby('imo'):
+        assert compareTraces(traces[imo],
+                             trace.drop(columns='imo').reset_index(drop=True),
+                             rtol=1e-10)
+
+
+def test_emissions():
+    expected = pd.read_csv(fixture('emissions-R.csv'))
+    res = estimateEmissions(readAIS(fixture('ships.csv')),
+                            readIHS(fixture('ihs.txt')), interpolation=10,
+                            verbose=False)[0]
+    assert np.array_equal(res['shipIMO'].values, expected['shipIMO'].values)
+    assert compareEmissions(res, expected)
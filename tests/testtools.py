@@ -0,0 +1,326 @@
+# # Test tools
+#
+# Helpers shared by the tests (python -m pytest tests) and the benchmarks of
+# every folder: timing, the synthetic fleets they run on and the literal
+# ports of the R functions. The ports follow the R code one ship (or one
+# sample) at a time; the tests compare the fast versions with them and the
+# benchmarks time them as the per-ship baseline. Benchmarks add this folder
+# to sys.path:
+#
+#     sys.path.append(os.path.join(os.path.dirname(
+#         os.path.abspath(__file__)), '..', 'tests'))
+#     from testtools import timeit
+
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+for folder in ['DatasetGeneration', 'EmissionModeling',
+               os.path.join('Experiments', 'ARIMA')]:
+    if os.path.join(root, folder) not in sys.path:
+        sys.path.append(os.path.join(root, folder))
+
+from arfunctions import lagDesign
+from crbmfunctions import CRBM, sigmoid
+from emissionfunctions import estimateEmissions, passenger_types, units
+
+
+# ## Timing
+
+def timeit(funct, *args):
+    start_time = time.time()
+    res = funct(*args)
+    return res, time.time() - start_time
+
+
+# Result, time and peak traced memory (MB) of funct()
+def traced(funct):
+    tracemalloc.start()
+    start_time = time.time()
+    res = funct()
+    elapsed = time.time() - start_time
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return res, elapsed, peak/2**20
+
+
+# ## Synthetic data
+
+# IHS parameters of nships ships and mean_length AIS samples (sog and time)
+# per ship, in random order
+def fleetData(nships, mean_length=1000, seed=0):
+    rng = np.random.RandomState(seed)
+    imos = np.arange(9000001, 9000001 + nships)
+    types = np.array(passenger_types + ["Bulk Carrier", "Container Ship"])
+    ihs = pd.DataFrame({
+        'LRIMOShipNO': imos, 'designSpeed': rng.uniform(10, 25, nships),
+        'installedPowerME': rng.uniform(1000, 40000, nships),
+        'installedPowerAE': rng.uniform(0, 3000, nships).round(),
+        'type': types[rng.randint(len(types), size=nships)],
+        'n_installed_me': rng.randint(1, 4, nships),
+        'MainEngineRPM': rng.choice([80, 130, 500, 1999, 2500], nships),
+        'AuxiliaryEngineRPM': rng.choice([0, 720, 1800, 2200], nships)})
+    lengths = rng.randint(1, 2*mean_length, size=nships)
+    ais = pd.DataFrame({'imo': np.repeat(imos, lengths)})
+    ais['fechahora'] = rng.randint(0, 7*86400, size=len(ais))
+    ais['sog'] = np.clip(rng.normal(8, 6, size=len(ais)), 0, None)
+    return ais.sample(frac=1, random_state=seed), ihs
+
+
+# One-week traces of nships ships: a sample every 1 to 10 minutes, with some
+# gaps of hours or days
+def weekTraces(nships, seed=0):
+    rng = np.random.RandomState(seed)
+    traces = []
+    for imo in range(nships):
+        steps = rng.choice([60, 180, 600, 4*3600, 2*86400], size=3000,
+                           p=[0.5, 0.3, 0.18, 0.015, 0.005])
+        t = np.cumsum(steps)
+        t = t[t < 7*86400]
+        traces.append(pd.DataFrame({
+            'imo': imo + 9000001, 'fechahora': t,
+            'latitude': 40 + np.cumsum(rng.normal(0, 0.01, len(t))),
+            'longitude': np.cumsum(rng.normal(0, 0.01, len(t))),
+            'sog': rng.uniform(0, 20, len(t))}))
+    return pd.concat(traces, ignore_index=True)
+
+
+# Samples of ships of random length (sorted by ship) with n_visible columns,
+# and the ship code of each sample
+def crbmSeries(nships, mean_length=200, n_visible=3, seed=0):
+    rng = np.random.RandomState(seed)
+    lengths = rng.randint(1, 2*mean_length, size=nships)
+    codes = np.repeat(np.arange(nships), lengths)
+    values = rng.normal(size=(len(codes), n_visible))
+    return values, codes
+
+
+def randomCRBM(n_visible=3, n_hidden=10, delay=20, seed=0):
+    rng = np.random.RandomState(seed)
+    return CRBM(rng.normal(0, 0.1, (n_visible, n_hidden)),
+                rng.normal(0, 0.01, (delay*n_visible, n_hidden)),
+                rng.normal(0, 0.01, (delay*n_visible, n_visible)),
+                rng.normal(0, 0.1, n_hidden), rng.normal(0, 0.1, n_visible),
+                delay)
+
+
+# AR(2) traces of nships ships of about mean_length samples, with a few
+# constant and missing (NaN sample) ones, and short ones with about as many
+# rows as parameters (3 variables: 3 per lag)
+def shipTraces(nships, mean_length=500, seed=0):
+    rng = np.random.RandomState(seed)
+    traces = []
+    for i in range(nships):
+        n = max(rng.poisson(mean_length), 1) if i % 25 else rng.randint(1, 12)
+        x = np.zeros((n, 3))
+        e = rng.normal(size=(n, 3))*[5, 1, 20]
+        for t in range(n):
+            x[t] = e[t] + (0.6*x[t - 1] - 0.2*x[t - 2] if t >= 2 else 0)
+        x += [0, 10, -2000]
+        if i % 70 == 1:
+            x[:, 1] = 0
+        if i % 60 == 2:
+            x[n//2, i % 3] = np.nan
+        traces.append(pd.DataFrame(x, columns=['rotationGPS', 'sog',
+                                               'bathymetry3'])
+                        .assign(imo=9000001 + i))
+    return pd.concat(traces, ignore_index=True)
+
+
+# ## Emissions (jalkanen2009/)
+#
+# One ship at a time, with scalar parameters, the sapply of
+# calcNOxEmissionFactor and the type checks of transientPowerAE.
+
+def referenceNOxFactor(rpm):
+    nf = []
+    for n in np.atleast_1d(rpm):
+        if n > 0:
+            if n < 130:
+                nf.append(17)
+            elif n < 2000:
+                nf.append(45*(n**(-0.2)))
+            else:
+                nf.append(9.8)
+        elif n <= 0:
+            nf.append(0)
+        else:
+            raise ValueError("missing value where TRUE/FALSE needed")
+    return sum(nf)
+
+
+def referenceShipEmissions(sog, parameters, sampleGranularity=1, unit='g'):
+    unit = units[unit]
+    p = parameters
+    transPME = (0.8*p['installedPowerME'])/(p['designSpeed'] + 0.5)**3 * \
+               sog**3
+
+    instPow = p['installedPowerAE']
+    if instPow is not None and (np.isnan(instPow) or instPow <= 0):
+        instPow = None
+    if p['type'] in passenger_types:
+        transPAE = np.full(len(sog), min(4000, instPow or 4000))
+    else:
+        transPAE = np.full(len(sog), 1000.0)
+        transPAE[(sog > 1) & (sog <= 5)] = 1250
+        transPAE[sog > 5] = 750
+        if instPow is not None:
+            transPAE[transPAE > instPow] = instPow
+
+    SOxFact = (64.06436*(200*0.001)/32.0655)
+    CO2Fact = 44.00886*(200*0.85)/12.01
+    enginePowerME = p['installedPowerME']/p['n_installed_me']
+    nOE = np.trunc(transPME/enginePowerME + 1)
+    EL = transPME/(enginePowerME*nOE)
+    relSFOC = 0.455*(EL**2) - 0.71*EL + 1.28
+    OCEL = np.full(len(EL), 3.333)
+    OCEL[EL >= 0.15] = 1.024/(1 + -47.660*np.exp(-32.547*EL[EL >= 0.15]))
+    PMFactME = relSFOC*(0.312*0.001 + 0.244*0.001 + 0.02*OCEL + 0.08 + 0.06)
+    NOxFactME = referenceNOxFactor(p['MainEngineRPM'])
+    NOxFactAE = referenceNOxFactor(p['AuxiliaryEngineRPM'])
+
+    def emission(factor, power):
+        return (factor*power/3600)/unit*sampleGranularity
+
+    return pd.DataFrame({
+        'SOxME': emission(SOxFact, transPME),
+        'SOxAE': emission(SOxFact, transPAE),
+        'CO2ME': emission(CO2Fact, transPME),
+        'CO2AE': emission(CO2Fact, transPAE),
+        'NOxME': emission(NOxFactME, transPME),
+        'NOxAE': emission(NOxFactAE, transPAE),
+        'PMME': emission(PMFactME, transPME),
+        'transPME': transPME, 'transPAE': transPAE})
+
+
+# Emissions of the ships imos, in that order, with referenceShipEmissions
+def referenceEmissions(ships, ihs, imos, sampleGranularity=1, unit='g'):
+    ihs = ihs.drop_duplicates('LRIMOShipNO', keep='first') \
+             .set_index('LRIMOShipNO')
+    expected = []
+    for imo in imos:
+        sog = ships.loc[ships['imo'] == imo, 'sog'].values.astype(float)
+        expected.append(referenceShipEmissions(sog, ihs.loc[imo].to_dict(),
+                                               sampleGranularity, unit))
+    return pd.concat(expected, ignore_index=True)
+
+
+# ## Interpolation (tools/interpolation.R)
+
+# fillSerieLinearly: every second of the span, na.approx with maxgap,
+# na.omit and sampling. Returns the trace and the number of per-second rows
+# it built.
+def referenceFillSerie(serie, timeAttribute='fechahora',
+                       dataAttributes=('latitude', 'longitude', 'sog'),
+                       sampleTime=1, maxTimeGap=24*60*60):
+    serie = pd.DataFrame({col: np.asarray(serie[col])
+                          for col in [timeAttribute] + list(dataAttributes)})
+    serie = serie.sort_values(timeAttribute, kind='mergesort') \
+                 .drop_duplicates(timeAttribute)
+    times = serie[timeAttribute].values.astype(np.int64)
+    grid = np.arange(times.min(), times.max() + 1)
+    res = {'fechahora': grid}
+    for col in dataAttributes:
+        full = np.full(len(grid), np.nan)
+        full[times - times[0]] = serie[col].values
+        known = np.flatnonzero(~np.isnan(full))
+        # NA runs of at most maxTimeGap between known values
+        for a, b in zip(known[:-1], known[1:]):
+            if 1 < b - a and b - a - 1 <= maxTimeGap:
+                v = grid[a + 1:b]
+                full[a + 1:b] = full[a] + (full[b] - full[a]) * \
+                                ((v - grid[a])/(grid[b] - grid[a]))
+        res[col] = full
+    res = pd.DataFrame(res).dropna()
+    if sampleTime > 1:
+        res = res[res['fechahora'] % sampleTime == 0]
+    return res.reset_index(drop=True), len(grid)
+
+
+def compareTraces(res, expected, rtol=0):
+    if len(res) != len(expected):
+        raise ValueError("Rows differ: {} vs {}".format(len(res),
+                                                        len(expected)))
+    for col in expected.columns:
+        if not np.allclose(res[col].values, expected[col].values, rtol=rtol,
+                           atol=0, equal_nan=True):
+            raise ValueError("Column {} differs".format(col))
+    return True
+
+
+# ## Power scenarios (CRBMEmissions.R)
+
+# One estimateEmissions per scenario, with installedPowerME replaced in the
+# IHS data
+def referenceScenarios(ships, ihs, power, ihs_id='LRIMOShipNO', **kwargs):
+    ihs = ihs.drop_duplicates(ihs_id, keep='first')
+    ihs = ihs[ihs[ihs_id].isin(power.index)]
+    results = {}
+    for scenario in power.columns:
+        scenario_ihs = ihs.copy()
+        scenario_ihs['installedPowerME'] = power[scenario] \
+            .reindex(scenario_ihs[ihs_id]).values
+        res = estimateEmissions(ships, scenario_ihs, ihs_id=ihs_id,
+                                verbose=False, **kwargs)[0]
+        results[scenario] = res[['SOxME', 'SOxAE', 'CO2ME', 'CO2AE',
+                                 'NOxME', 'NOxAE', 'PMME']].sum()
+    return pd.DataFrame(results).T
+
+
+# ## Dataset generation (CRBM-tools.r)
+
+# generate_window_data, one cell at a time, for one ship with at least delay
+# samples
+def referenceWindowData(serie, delay, datacols):
+    res = serie.iloc[delay - 1:].reset_index(drop=True).copy()
+    for r in range(len(res)):
+        for dc in datacols:
+            for i in range(delay - 1, -1, -1):
+                res.loc[r, dc + str(i + 1)] = serie[dc].iloc[r + i]
+    return res.drop(columns=datacols)
+
+
+# rrbm forward pass for one ship: one sample at a time, history built by
+# indexing (hist_idx)
+def referenceActivations(crbm, batchdata):
+    batchdata = np.asarray(batchdata, dtype=np.float64)
+    act = np.full((len(batchdata), crbm.n_hidden), np.nan)
+    for t in range(crbm.delay, len(batchdata)):
+        history = np.concatenate([batchdata[t - i]
+                                  for i in range(1, crbm.delay + 1)])
+        act[t] = sigmoid(batchdata[t] @ crbm.W + history @ crbm.B +
+                         crbm.hbias)
+    return act
+
+
+# closest.cluster, one row and one centre at a time
+def referencePhases(X, centers):
+    labels = []
+    for x in X:
+        dist = [np.sqrt(np.sum((x - y)**2)) for y in centers]
+        labels.append(int(np.argmin(dist)))
+    return np.array(labels)
+
+
+# ## AR baseline (marima-tools.R)
+
+# One VAR fit of a ship and grid point with np.linalg.lstsq on the ship's
+# own lag matrix, from the largest order on. Ships with missing samples, and
+# orders with no more rows than parameters, have NaN errors.
+def referenceShip(x, order, max_order, meansAdjusted=1):
+    if len(x) - max_order <= order*x.shape[1] or not np.all(np.isfinite(x)):
+        return np.full((3, x.shape[1]), np.nan)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sd = x.std(axis=0, ddof=1)
+        if meansAdjusted:
+            x = x - x.mean(axis=0)
+        Z, Y, _ = lagDesign(x, np.array([0, len(x)]), max_order)
+        Z = Z[:, :order*x.shape[1]]
+        coef = np.linalg.lstsq(Z, Y, rcond=None)[0]
+        mse = ((Y - Z @ coef)**2).sum(axis=0)/(len(x) - 1)
+        return np.stack([mse, np.sqrt(mse), np.sqrt(mse)/sd])